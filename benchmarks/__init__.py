@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark suite for the DNS-over-TLS proxy
+
+Run it with: python -m benchmarks.run --help
+"""
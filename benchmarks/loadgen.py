@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+"""
+loadgen module
+
+Closed-loop DNS load generator: every client sends a query, waits for its
+reply and sends the next one, for UDP or TCP
+"""
+
+import json
+import random
+import struct
+import argparse
+
+import gevent
+from gevent import socket
+from gevent import time
+import dns.message
+
+from .upstream import zone_names
+
+
+QUERY_TIMEOUT = 2.0
+
+
+def percentile(values, fraction):
+    """
+    Nearest-rank percentile of the sorted list of values
+    """
+    if not values:
+        return None
+    index = min(len(values) - 1, max(0, int(round(fraction * len(values))) - 1))
+    return values[index]
+
+
+def build_queries(names):
+    return [
+        dns.message.make_query(name, rdtype).to_wire()
+        for name, rdtype in names
+    ]
+
+
+class Client:
+    """
+    Client sending queries one after another until the deadline
+
+    :param server: Address tuple of the DNS server
+    :param protocol: 'udp' or 'tcp'
+    :param queries: Queries in wire format to choose from
+    """
+
+    def __init__(self, server, protocol, queries):
+        self.server = server
+        self.protocol = protocol
+        self.queries = queries
+        self.latencies = []
+        self.errors = 0
+        self.sock = None
+
+    def _connect(self):
+        if self.protocol == 'udp':
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.settimeout(QUERY_TIMEOUT)
+        self.sock.connect(self.server)
+
+    def _recv_exactly(self, length):
+        data = b''
+        while len(data) < length:
+            chunk = self.sock.recv(length - len(data))
+            if not chunk:
+                raise OSError('Connection closed by server')
+            data += chunk
+        return data
+
+    def _query(self, msg):
+        if self.sock is None:
+            self._connect()
+        if self.protocol == 'udp':
+            self.sock.send(msg)
+            while True:
+                reply = self.sock.recv(65535)
+                if reply[:2] == msg[:2]:
+                    return reply
+        # TCP connections are reused for the next queries
+        self.sock.sendall(struct.pack('!H', len(msg)) + msg)
+        length, = struct.unpack('!H', self._recv_exactly(2))
+        return self._recv_exactly(length)
+
+    def _close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def run(self, deadline):
+        while time.time() < deadline:
+            msg = struct.pack('!H', random.randint(0, 0xFFFF)) + random.choice(self.queries)[2:]
+            start = time.time()
+            try:
+                self._query(msg)
+                self.latencies.append(time.time() - start)
+            except OSError:
+                self.errors += 1
+                # Start over with a new connection
+                self._close()
+        self._close()
+
+
+def run(server, protocol='udp', concurrency=10, duration=10.0, names=None):
+    """
+    Run the load for some time and summarize the results
+
+    :param server: Address tuple of the DNS server
+    :param protocol: 'udp' or 'tcp'
+    :param concurrency: Number of concurrent clients
+    :param duration: Seconds to run the load
+    :param names: List of (name, type) tuples to query, all the names in the
+                  fixture zone by default
+    :return: dict with the results
+    """
+    queries = build_queries(names or zone_names())
+    clients = [Client(server, protocol, queries) for _ in range(concurrency)]
+    start = time.time()
+    gevent.joinall([gevent.spawn(c.run, start + duration) for c in clients])
+    elapsed = time.time() - start
+
+    latencies = sorted(x for c in clients for x in c.latencies)
+    errors = sum(c.errors for c in clients)
+
+    def ms(value):
+        return None if value is None else round(value * 1000, 3)
+
+    return {
+        'protocol': protocol,
+        'concurrency': concurrency,
+        'duration': round(elapsed, 3),
+        'queries': len(latencies),
+        'errors': errors,
+        'qps': round(len(latencies) / elapsed, 1),
+        'p50_ms': ms(percentile(latencies, 0.5)),
+        'p99_ms': ms(percentile(latencies, 0.99)),
+        'p999_ms': ms(percentile(latencies, 0.999)),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='DNS load generator')
+    parser.add_argument('--server', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=53)
+    parser.add_argument('--protocol', choices=('udp', 'tcp'), default='udp')
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--duration', type=float, default=10.0)
+    args = parser.parse_args(argv)
+
+    result = run((args.server, args.port), args.protocol, args.concurrency, args.duration)
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
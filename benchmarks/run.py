@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+"""
+run module
+
+Reproducible benchmark of the proxy: start the local DNS-over-TLS stand-in
+and the proxy, sweep the pool sizes, protocols and concurrency levels, and
+write the results as JSON
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import ssl
+import logging
+import argparse
+import tempfile
+import platform
+import subprocess
+
+import dns.message
+
+from . import loadgen
+from .upstream import generate_certificates, HOSTNAME
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STARTUP_TIMEOUT = 10.0
+
+
+def wait_for_tls(port, cafile, timeout=STARTUP_TIMEOUT):
+    context = ssl.create_default_context(cafile=cafile)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5) as sock:
+                context.wrap_socket(sock, server_hostname=HOSTNAME).close()
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('No TLS handshake on port {} after {}s'.format(port, timeout))
+
+
+def wait_for_dns(port, timeout=STARTUP_TIMEOUT):
+    query = dns.message.make_query(HOSTNAME, 'A').to_wire()
+    deadline = time.time() + timeout
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(0.5)
+        while time.time() < deadline:
+            try:
+                sock.sendto(query, ('127.0.0.1', port))
+                sock.recv(65535)
+                return
+            except OSError:
+                time.sleep(0.1)
+    raise RuntimeError('No DNS replies on port {} after {}s'.format(port, timeout))
+
+
+def stop(process):
+    process.terminate()
+    try:
+        process.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+class Benchmark:
+    """
+    Run the proxy against the local upstream with every combination of the
+    given settings
+
+    :param args: Parsed command line arguments
+    :param workdir: Directory for the certificates
+    """
+
+    def __init__(self, args, workdir):
+        self.log = logging.getLogger(__name__)
+        self.args = args
+        self.cafile, self.certfile, self.keyfile = generate_certificates(workdir)
+        self.env = dict(os.environ, PYTHONPATH=os.path.join(ROOT, 'src'))
+
+    def start_upstream(self):
+        args = self.args
+        process = subprocess.Popen([
+            sys.executable, '-m', 'benchmarks.upstream',
+            '--port', str(args.upstream_port),
+            '--certfile', self.certfile,
+            '--keyfile', self.keyfile,
+            '--latency', str(args.latency),
+            '--jitter', str(args.jitter),
+            '--failure-rate', str(args.failure_rate),
+        ], cwd=ROOT)
+        wait_for_tls(args.upstream_port, self.cafile)
+        return process
+
+    def start_proxy(self, pool_size):
+        args = self.args
+        command = [
+            sys.executable, '-m', 'dns_tls_proxy',
+            '--nameserver', '127.0.0.1:{}:{}'.format(args.upstream_port, HOSTNAME),
+            '--port', str(args.proxy_port),
+            '--pool-size', str(pool_size),
+            '--cafile', self.cafile,
+        ] + args.proxy_args
+        process = subprocess.Popen(command, cwd=ROOT, env=self.env)
+        wait_for_dns(args.proxy_port)
+        return process
+
+    def run(self):
+        args = self.args
+        results = []
+        upstream = self.start_upstream()
+        try:
+            for pool_size in args.pool_sizes:
+                proxy = self.start_proxy(pool_size)
+                try:
+                    for protocol in args.protocols:
+                        for concurrency in args.concurrency:
+                            # Warm up the connections and handshakes
+                            loadgen.run(('127.0.0.1', args.proxy_port), protocol,
+                                        concurrency, args.warmup)
+                            result = loadgen.run(('127.0.0.1', args.proxy_port), protocol,
+                                                 concurrency, args.duration)
+                            result['pool_size'] = pool_size
+                            self.log.warning('%s', json.dumps(result))
+                            results.append(result)
+                finally:
+                    stop(proxy)
+        finally:
+            stop(upstream)
+        return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the proxy against a local DNS-over-TLS upstream.'
+                    ' Extra arguments after -- are passed to the proxy'
+    )
+    parser.add_argument('--pool-sizes', type=int, nargs='+', default=[1, 5, 20])
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 10, 50])
+    parser.add_argument('--protocols', nargs='+', choices=('udp', 'tcp'),
+                        default=['udp', 'tcp'])
+    parser.add_argument('--duration', type=float, default=10.0,
+                        help='Seconds to run every measurement')
+    parser.add_argument('--warmup', type=float, default=1.0,
+                        help='Seconds to run before every measurement')
+    parser.add_argument('--latency', type=float, default=0.01,
+                        help='Mean latency of the upstream in seconds')
+    parser.add_argument('--jitter', type=float, default=0.005,
+                        help='Maximum deviation of the upstream latency in seconds')
+    parser.add_argument('--failure-rate', type=float, default=0.0,
+                        help='Fraction of queries the upstream answers with SERVFAIL')
+    parser.add_argument('--upstream-port', type=int, default=18853)
+    parser.add_argument('--proxy-port', type=int, default=15353)
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('proxy_args', nargs=argparse.REMAINDER)
+    args = parser.parse_args(argv)
+    if args.proxy_args[:1] == ['--']:
+        args.proxy_args = args.proxy_args[1:]
+
+    logging.basicConfig(format='%(asctime)s %(message)s')
+
+    with tempfile.TemporaryDirectory() as workdir:
+        results = Benchmark(args, workdir).run()
+
+    with open(args.output, 'w') as fh:
+        json.dump({
+            'settings': {
+                'python': platform.python_version(),
+                'latency': args.latency,
+                'jitter': args.jitter,
+                'failure_rate': args.failure_rate,
+                'duration': args.duration,
+                'proxy_args': args.proxy_args,
+            },
+            'results': results,
+        }, fh, indent=2)
+    print('Results written to {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+
+"""
+upstream module
+
+Local DNS-over-TLS nameserver stand-in answering from a fixture zone, with
+configurable latency, jitter and failure rate
+"""
+
+import os
+import sys
+import struct
+import random
+import logging
+import argparse
+import subprocess
+
+import gevent
+from gevent import lock
+from gevent import ssl
+from gevent.server import StreamServer
+import dns.flags
+import dns.message
+import dns.rcode
+import dns.rdatatype
+import dns.rrset
+import dns.zone
+
+
+HOSTNAME = 'dot.bench'
+ZONE_FILE = os.path.join(os.path.dirname(__file__), 'fixtures', 'bench.zone')
+CERT_DAYS = 7
+
+
+def generate_certificates(directory, hostname=HOSTNAME):
+    """
+    Create a self-signed CA and a server certificate signed by it, using the
+    openssl command line tool
+
+    :param directory: Directory to write the files to
+    :param hostname: Name in the subjectAltName of the server certificate
+    :return: tuple (CA certificate, server certificate, server key) paths
+    """
+    ca_key = os.path.join(directory, 'ca.key')
+    ca_cert = os.path.join(directory, 'ca.pem')
+    key = os.path.join(directory, 'server.key')
+    csr = os.path.join(directory, 'server.csr')
+    cert = os.path.join(directory, 'server.pem')
+    ext = os.path.join(directory, 'server.ext')
+
+    with open(ext, 'w') as fh:
+        fh.write('subjectAltName=DNS:{}\n'.format(hostname))
+
+    commands = [
+        ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+         '-keyout', ca_key, '-out', ca_cert, '-days', str(CERT_DAYS),
+         '-subj', '/CN=dns-tls-proxy benchmark CA'],
+        ['openssl', 'req', '-newkey', 'rsa:2048', '-nodes',
+         '-keyout', key, '-out', csr, '-subj', '/CN={}'.format(hostname)],
+        ['openssl', 'x509', '-req', '-in', csr, '-CA', ca_cert, '-CAkey', ca_key,
+         '-CAcreateserial', '-out', cert, '-days', str(CERT_DAYS), '-extfile', ext],
+    ]
+    for command in commands:
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
+
+    return ca_cert, cert, key
+
+
+def zone_names(zone_file=ZONE_FILE):
+    """
+    List the (name, type) tuples with data in the fixture zone
+    """
+    zone = dns.zone.from_file(zone_file, relativize=False)
+    return [
+        (name.to_text(), dns.rdatatype.to_text(rdataset.rdtype))
+        for name, node in zone.nodes.items()
+        for rdataset in node.rdatasets
+    ]
+
+
+class Zone:
+    """
+    Answer queries from a zone file. Replies are prebuilt in wire format, so
+    answering only costs a lookup and patching the message ID.
+    """
+
+    def __init__(self, zone_file=ZONE_FILE):
+        self.zone = dns.zone.from_file(zone_file, relativize=False)
+        self.replies = dict()
+        for name, node in self.zone.nodes.items():
+            for rdataset in node.rdatasets:
+                query = dns.message.make_query(name, rdataset.rdtype)
+                reply = dns.message.make_response(query)
+                reply.flags |= dns.flags.AA
+                reply.answer.append(dns.rrset.from_rdata_list(
+                    name, rdataset.ttl, list(rdataset)))
+                wire = reply.to_wire()
+                self.replies[self._key(query.to_wire())] = wire[2:]
+
+    @staticmethod
+    def _key(msg):
+        # The question section, which starts after the 12 bytes header
+        end = msg.index(b'\x00', 12) + 5
+        return msg[12:end].lower()
+
+    def answer(self, msg, rcode=None):
+        if rcode is None:
+            reply = self.replies.get(self._key(msg))
+            if reply is not None:
+                return msg[:2] + reply
+            rcode = dns.rcode.NXDOMAIN
+
+        query = dns.message.from_wire(msg)
+        reply = dns.message.make_response(query)
+        reply.set_rcode(rcode)
+        if rcode == dns.rcode.NXDOMAIN:
+            soa = self.zone.find_rdataset(self.zone.origin, 'SOA')
+            reply.authority.append(dns.rrset.from_rdata_list(
+                self.zone.origin, soa.ttl, list(soa)))
+        return reply.to_wire()
+
+
+class DoTUpstream(StreamServer):
+    """
+    DNS-over-TLS server answering pipelined queries out of order after a
+    simulated latency
+
+    :param listener: Address to listen on
+    :param certfile: Server certificate
+    :param keyfile: Server key
+    :param zone: Zone to answer from
+    :param latency: Mean answer latency in seconds
+    :param jitter: Maximum deviation of the latency in seconds
+    :param failure_rate: Fraction of queries answered with SERVFAIL
+    """
+
+    def __init__(self, listener, certfile, keyfile, zone, latency=0.0, jitter=0.0,
+                 failure_rate=0.0):
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile, keyfile)
+        super().__init__(listener, ssl_context=context)
+        self.log = logging.getLogger(__name__)
+        self.zone = zone
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+
+    def _reply(self, sock, write_lock, msg):
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            gevent.sleep(delay)
+        rcode = dns.rcode.SERVFAIL if random.random() < self.failure_rate else None
+        reply = self.zone.answer(msg, rcode)
+        try:
+            with write_lock:
+                sock.sendall(struct.pack('!H', len(reply)) + reply)
+        except OSError:
+            pass
+
+    def handle(self, sock, address):
+        write_lock = lock.Semaphore(1)
+        buf = b''
+        while True:
+            try:
+                data = sock.recv(65535)
+            except OSError:
+                return
+            if not data:
+                return
+            buf += data
+            while len(buf) >= 2:
+                length, = struct.unpack('!H', buf[:2])
+                if len(buf) < length + 2:
+                    break
+                gevent.spawn(self._reply, sock, write_lock, buf[2:length + 2])
+                buf = buf[length + 2:]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='DNS-over-TLS nameserver stand-in')
+    parser.add_argument('--port', type=int, default=8853)
+    parser.add_argument('--certfile', required=True)
+    parser.add_argument('--keyfile', required=True)
+    parser.add_argument('--zone', default=ZONE_FILE)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Mean answer latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='Maximum deviation of the latency in seconds')
+    parser.add_argument('--failure-rate', type=float, default=0.0,
+                        help='Fraction of queries answered with SERVFAIL')
+    args = parser.parse_args(argv)
+
+    server = DoTUpstream(
+        ('127.0.0.1', args.port),
+        certfile=args.certfile,
+        keyfile=args.keyfile,
+        zone=Zone(args.zone),
+        latency=args.latency,
+        jitter=args.jitter,
+        failure_rate=args.failure_rate
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
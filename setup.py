@@ -31,12 +31,9 @@ setup(
         'gevent',
         'ConfigArgParse'
     ],
-    python_requires='>=3.4, <4',
+    python_requires='>=3.7, <4',
     classifiers=[
         'License :: OSI Approved :: MIT License',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
         'Programming Language :: Python :: 3.7',
         'Operating System :: POSIX'
     ],
@@ -0,0 +1,10 @@
+# -*- coding: utf-8 -*-
+
+"""
+__main__.py
+"""
+
+from .main import main
+
+
+main()
@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+
+"""
+blocklist module
+"""
+
+import os
+import re
+import sys
+import heapq
+import socket
+import logging
+from array import array
+from bisect import bisect_left
+
+import gevent
+from gevent import time
+from . import wire
+
+
+DEFAULT_BLOCKLIST_INTERVAL = 60.0
+DEFAULT_BLOCKED_TTL = 300
+BLOCK_MODES = ('nxdomain', 'zero')
+# Lines of the lists parsed between yields to the event loop while loading
+LOAD_BATCH = 10000
+# Addresses marking blocked names in hosts files, other ones are overrides
+BLOCK_ADDRESSES = (b'0.0.0.0', b'127.0.0.1', b'::', b'::1')
+# Names accepted in the lists, anything else like adblock rules is invalid
+HOSTNAME = re.compile(rb'[a-z0-9_-]+(\.[a-z0-9_-]+)*\.?', re.IGNORECASE)
+# Keys of the index are a fingerprint of the name in the high bits and the
+# offset of the name in the buffer of names in the low ones
+OFFSET_BITS = 32
+OFFSET_MASK = (1 << OFFSET_BITS) - 1
+# Answers to blocked names in zero mode, other types are answered NODATA
+ZERO_ANSWERS = {
+    wire.TYPE_A: bytes(4),
+    wire.TYPE_AAAA: bytes(16),
+}
+
+
+def iter_suffixes(qname):
+    """
+    Yield a name in wire format and every parent domain of it, without the
+    root
+    """
+    offset = 0
+    while qname[offset]:
+        yield qname[offset:]
+        offset += qname[offset] + 1
+
+
+def fingerprint(name):
+    """
+    Fingerprint of a name in wire format, a key of the index
+    """
+    return hash(name) & OFFSET_MASK
+
+
+def name_at(names, offset):
+    """
+    Name in wire format stored at an offset of a buffer of names
+    """
+    end = offset
+    while names[end]:
+        end += names[end] + 1
+    return bytes(names[offset:end + 1])
+
+
+def add_name(keys, names, name):
+    """
+    Append a name in wire format to the buffer of names and its key to the
+    keys, which must be sorted with sort_keys() before building an index
+    """
+    keys.append(fingerprint(name) << OFFSET_BITS | len(names))
+    names += name
+
+
+def sort_keys(keys, names):
+    """
+    Sort the keys of the names without turning all of them into Python ints
+    at once: runs of LOAD_BATCH keys are sorted in place and then merged
+    into a new array, dropping duplicated names and yielding to the event
+    loop every LOAD_BATCH keys
+
+    :return: the sorted array of keys
+    """
+    for start in range(0, len(keys), LOAD_BATCH):
+        keys[start:start + LOAD_BATCH] = array('Q', sorted(keys[start:start + LOAD_BATCH]))
+        gevent.sleep(0)
+
+    merged = array('Q')
+    view = memoryview(keys)
+    runs = [view[start:start + LOAD_BATCH] for start in range(0, len(keys), LOAD_BATCH)]
+    fingerprint_seen, names_seen = None, set()
+    for count, key in enumerate(heapq.merge(*runs), 1):
+        if key >> OFFSET_BITS != fingerprint_seen:
+            fingerprint_seen = key >> OFFSET_BITS
+            names_seen.clear()
+            merged.append(key)
+        else:
+            # Only names with the same fingerprint are compared
+            if not names_seen:
+                names_seen.add(name_at(names, merged[-1] & OFFSET_MASK))
+            name = name_at(names, key & OFFSET_MASK)
+            if name not in names_seen:
+                names_seen.add(name)
+                merged.append(key)
+        if not count % LOAD_BATCH:
+            gevent.sleep(0)
+    return merged
+
+
+class BlocklistIndex:
+    """
+    Immutable index of blocked names and overrides
+
+    Blocked names are kept back to back in wire format in a single buffer,
+    and indexed by a sorted array of 8 bytes keys: a 32 bits fingerprint of
+    the name and its offset in the buffer. Names are matched by looking up
+    every suffix of the query name, so a query costs one binary search for
+    each of its labels, and a fingerprint found is only a match if the name
+    stored is the same. Overrides are kept in a dict of the exact names.
+    """
+
+    __slots__ = ('keys', 'names', 'overrides', 'memory')
+
+    def __init__(self, keys=None, names=None, overrides=None):
+        self.keys = keys if keys is not None else array('Q')
+        self.names = names if names is not None else bytearray()
+        self.overrides = overrides if overrides is not None else dict()
+        self.memory = sys.getsizeof(self.keys) + sys.getsizeof(self.names) + \
+            sys.getsizeof(self.overrides) + sum(
+                sys.getsizeof(k) + sys.getsizeof(v) + sum(sys.getsizeof(r) for r in v)
+                for k, v in self.overrides.items()
+            )
+
+    def blocked(self, qname):
+        """
+        Check if a name or any of its parent domains is blocked
+
+        :param qname: Name in lowercased wire format
+        """
+        keys, names = self.keys, self.names
+        if not keys:
+            return False
+        for suffix in iter_suffixes(qname):
+            digest = fingerprint(suffix)
+            index = bisect_left(keys, digest << OFFSET_BITS)
+            # Different names with the same fingerprint are next to each other
+            while index < len(keys) and keys[index] >> OFFSET_BITS == digest:
+                if names.startswith(suffix, keys[index] & OFFSET_MASK):
+                    return True
+                index += 1
+        return False
+
+
+class Blocklist:
+    """
+    Block or rewrite names locally, without forwarding their queries
+
+    Lists are text files with a domain per line, blocking it and all its
+    subdomains, or in hosts file format. Hosts entries with an address like
+    0.0.0.0 block the names, and the ones with any other address override
+    the A or AAAA records of the exact names. Lines with anything else than
+    hostnames, like adblock rules, are counted as invalid and skipped.
+
+    Lists are loaded in the background, yielding to the event loop every few
+    thousand lines, and reloaded when the files change. The new index
+    replaces the previous one at once when it is complete.
+
+    :param paths: List of files with the lists
+    :param mode: Reply to blocked names: 'nxdomain', or 'zero' to answer
+                 0.0.0.0 and ::
+    :param ttl: TTL of the generated answers
+    :param interval: Seconds between checks of the files, 0 to only load
+                     them at startup
+    """
+
+    def __init__(self, paths, mode='nxdomain', ttl=DEFAULT_BLOCKED_TTL,
+                 interval=DEFAULT_BLOCKLIST_INTERVAL):
+        self.log = logging.getLogger(__name__)
+        if mode not in BLOCK_MODES:
+            raise ValueError('Unknown blocklist mode: {}'.format(mode))
+        self.paths = paths
+        self.mode = mode
+        self.ttl = ttl
+        self.interval = interval
+        self.index = BlocklistIndex()
+        self.versions = None
+        self.blocked = 0
+        self.overridden = 0
+        self.loads = 0
+        self.invalid = 0
+        self._watcher = None
+
+    def start(self):
+        self._watcher = gevent.spawn(self._watch)
+
+    def stop(self):
+        if self._watcher is not None:
+            self._watcher.kill()
+
+    def _watch(self):
+        while True:
+            versions = self._versions()
+            if versions != self.versions:
+                self.versions = versions
+                self.load()
+            if not self.interval:
+                return
+            gevent.sleep(self.interval)
+
+    def _versions(self):
+        versions = list()
+        for path in self.paths:
+            try:
+                stat = os.stat(path)
+                versions.append((stat.st_mtime, stat.st_size, stat.st_ino))
+            except OSError:
+                versions.append(None)
+        return versions
+
+    def load(self):
+        """
+        Read the lists and replace the index once they are loaded. The
+        current index is kept if any list can not be read.
+
+        :return: returns nothing
+        """
+        start = time.time()
+        keys = array('Q')
+        names = bytearray()
+        overrides = dict()
+        lines = 0
+        invalid = 0
+        for path in self.paths:
+            try:
+                with open(path, 'rb') as fh:
+                    for line in fh:
+                        if not self._parse(line, keys, names, overrides):
+                            invalid += 1
+                        lines += 1
+                        if not lines % LOAD_BATCH:
+                            gevent.sleep(0)
+            except OSError as exc:
+                self.log.error('Unable to load blocklist %s: %s', path, exc)
+                return
+        if len(names) > OFFSET_MASK:
+            self.log.error('Unable to load blocklists: %i bytes of names, up to %i supported',
+                           len(names), OFFSET_MASK)
+            return
+
+        index = BlocklistIndex(sort_keys(keys, names), names, overrides)
+        self.index = index
+        self.loads += 1
+        self.invalid = invalid
+        if invalid:
+            self.log.warning('Skipped %i invalid lines of the blocklists', invalid)
+        self.log.info(
+            'Loaded %i blocked names and %i overrides in %.03fs, using %i bytes',
+            len(index.keys), len(index.overrides), time.time() - start,
+            index.memory)
+
+    def _parse(self, line, keys, names, overrides):
+        """
+        Add the names of a line of a list to the index being built
+
+        :return: False if the line is invalid, True otherwise
+        """
+        fields = line.split(b'#', 1)[0].split()
+        if not fields:
+            return True
+        try:
+            for name in fields[1:] or fields:
+                if HOSTNAME.fullmatch(name) is None:
+                    raise ValueError('Not a hostname: {!r}'.format(name))
+            if len(fields) == 1:
+                add_name(keys, names, wire.encode_name(fields[0]))
+            elif fields[0] in BLOCK_ADDRESSES:
+                for name in fields[1:]:
+                    add_name(keys, names, wire.encode_name(name))
+            else:
+                address = fields[0].decode('ascii')
+                if ':' in address:
+                    record = (wire.TYPE_AAAA, socket.inet_pton(socket.AF_INET6, address))
+                else:
+                    record = (wire.TYPE_A, socket.inet_pton(socket.AF_INET, address))
+                for name in fields[1:]:
+                    overrides.setdefault(wire.encode_name(name), list()).append(record)
+        except (ValueError, OSError, UnicodeError) as exc:
+            self.log.debug('Invalid blocklist line %r: %s', line, exc)
+            return False
+        return True
+
+    def reply(self, request):
+        """
+        Local reply to a query for a blocked or overridden name
+
+        :param request: DNS query in wire format
+        :return: the reply in wire format or None to forward the query
+        """
+        index = self.index
+        if not index.keys and not index.overrides:
+            return None
+        try:
+            qname, qtype, _, _ = wire.read_question(request)
+        except wire.PARSE_ERRORS:
+            return None
+
+        records = index.overrides.get(qname)
+        if records is not None:
+            self.overridden += 1
+            answers = [r for r in records if r[0] == qtype]
+            return wire.local_reply(request, wire.RCODE_NOERROR, answers, self.ttl)
+
+        if not index.blocked(qname):
+            return None
+        self.blocked += 1
+        if self.mode == 'nxdomain':
+            return wire.local_reply(request, wire.RCODE_NXDOMAIN)
+        answers = [(qtype, ZERO_ANSWERS[qtype])] if qtype in ZERO_ANSWERS else []
+        return wire.local_reply(request, wire.RCODE_NOERROR, answers, self.ttl)
+
+    def stats(self):
+        index = self.index
+        return {
+            'names': len(index.keys),
+            'overrides': len(index.overrides),
+            'memory_bytes': index.memory,
+            'blocked': self.blocked,
+            'overridden': self.overridden,
+            'loads': self.loads,
+            'invalid': self.invalid,
+        }
@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+
+"""
+cache module
+"""
+
+import struct
+import logging
+from collections import OrderedDict
+
+from gevent import time
+from . import wire
+from .snapshot import Snapshot, write_snapshot
+
+
+DEFAULT_CACHE_SIZE = 0
+DEFAULT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+MAX_CACHE_TTL = 86400
+# TTL of expired replies served when the nameservers fail, as recommended
+# by RFC 8767
+STALE_REPLY_TTL = 30
+
+
+class CacheEntry:
+    """
+    Cached DNS reply in wire format along with the offsets of its TTL fields
+    """
+
+    __slots__ = ('wire', 'ttl_offsets', 'stored_at', 'expires_at',
+                 'prefetch_at', 'prefetching')
+
+    def __init__(self, wire, ttl_offsets, stored_at, expires_at, prefetch_at):
+        self.wire = wire
+        self.ttl_offsets = ttl_offsets
+        self.stored_at = stored_at
+        self.expires_at = expires_at
+        self.prefetch_at = prefetch_at
+        self.prefetching = False
+
+    def reply(self, msg_id, elapsed=0, ttl=None):
+        """
+        Copy of the reply for a query
+
+        :param msg_id: Message ID of the query, in wire format
+        :param elapsed: Seconds to decrement the TTLs by
+        :param ttl: Value to set the TTLs to instead
+        :return: The reply in wire format
+        """
+        reply = bytearray(self.wire)
+        reply[:2] = msg_id
+        if ttl is not None:
+            for offset in self.ttl_offsets:
+                wire.TTL.pack_into(reply, offset, ttl)
+        elif elapsed:
+            for offset in self.ttl_offsets:
+                value, = wire.TTL.unpack_from(reply, offset)
+                wire.TTL.pack_into(reply, offset, max(value - elapsed, 0))
+        return bytes(reply)
+
+
+class ResponseCache:
+    """
+    In-memory LRU cache of DNS replies, honouring the TTL of the records
+
+    Replies are stored in wire format. On a hit the message ID and TTLs are
+    patched directly in a copy of the stored bytes.
+
+    Expired replies can be kept for stale_ttl seconds more, to be served
+    when the nameservers fail following RFC 8767. Replies queried after
+    the prefetch fraction of their TTL has passed are due to be refreshed
+    in the background, so popular names do not expire.
+
+    :param max_entries: Maximum number of cached replies
+    :param max_bytes: Maximum size of all cached replies
+    :param max_ttl: Upper bound for the time a reply is cached
+    :param stale_ttl: Seconds expired replies are kept to be served stale,
+                      0 disables serve-stale
+    :param prefetch: Fraction of the TTL after which replies still queried
+                     are refreshed, 0 disables prefetching
+
+    Replies can be saved to a snapshot file and restored after a restart.
+    The snapshot is memory-mapped and replies are only read from it on a
+    miss, skipping the expired ones.
+    """
+
+    def __init__(self, max_entries, max_bytes=DEFAULT_CACHE_MAX_BYTES,
+                 max_ttl=MAX_CACHE_TTL, stale_ttl=0, prefetch=0):
+        self.log = logging.getLogger(__name__)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_ttl = max_ttl
+        self.stale_ttl = stale_ttl
+        self.prefetch = prefetch
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stale_hits = 0
+        self.prefetches = 0
+        self.restored = 0
+        self._entries = OrderedDict()
+        self._snapshot = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, msg_id):
+        """
+        Look up a cached reply
+
+        :param key: Cache key of the query
+        :param msg_id: Message ID of the query, in wire format
+        :return: The reply in wire format or None if not cached
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._restore(key)
+        now = time.time()
+        if entry is None or entry.expires_at <= now:
+            if entry is not None and entry.expires_at + self.stale_ttl <= now:
+                self._remove(key)
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry.reply(msg_id, elapsed=int(now - entry.stored_at))
+
+    def get_stale(self, key, msg_id):
+        """
+        Look up an expired reply to serve when the nameservers fail, with
+        its TTLs set to STALE_REPLY_TTL
+
+        :param key: Cache key of the query
+        :param msg_id: Message ID of the query, in wire format
+        :return: The reply in wire format or None if not cached
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._restore(key)
+        if entry is None or entry.expires_at + self.stale_ttl <= time.time():
+            return None
+
+        self.stale_hits += 1
+        return entry.reply(msg_id, ttl=STALE_REPLY_TTL)
+
+    def prefetch_due(self, key):
+        """
+        Check if a cached reply which has just been served must be refreshed
+        in the background. It is only due once, until it is stored again.
+
+        :param key: Cache key of the query
+        :return: True if the caller must refresh the reply
+        """
+        entry = self._entries.get(key)
+        if entry is None or entry.prefetching or entry.prefetch_at is None \
+                or entry.prefetch_at > time.time():
+            return False
+        entry.prefetching = True
+        self.prefetches += 1
+        return True
+
+    def prefetch_failed(self, key):
+        """
+        Let a reply whose refresh did not store a new one be prefetched
+        again
+
+        :param key: Cache key of the query
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            entry.prefetching = False
+
+    def put(self, key, reply):
+        """
+        Store a reply if it is cacheable
+
+        :param key: Cache key of the query
+        :param reply: DNS reply in wire format
+        :return: True if the reply was stored
+        """
+        try:
+            ttl_offsets, ttl = wire.ttl_info(reply)
+        except wire.PARSE_ERRORS as exc:
+            self.log.debug('Reply not cacheable: %s', exc)
+            return False
+
+        if not ttl or len(reply) > self.max_bytes:
+            return False
+
+        now = time.time()
+        ttl = min(ttl, self.max_ttl)
+        prefetch_at = now + ttl * self.prefetch if self.prefetch else None
+        return self._store(key, CacheEntry(
+            bytes(reply), ttl_offsets, now, now + ttl, prefetch_at))
+
+    def _store(self, key, entry):
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = entry
+        self.size_bytes += len(entry.wire)
+
+        while len(self._entries) > self.max_entries or self.size_bytes > self.max_bytes:
+            _, entry = self._entries.popitem(last=False)
+            self.size_bytes -= len(entry.wire)
+            self.evictions += 1
+        return True
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.size_bytes -= len(entry.wire)
+
+    def _items(self):
+        return self._entries.items()
+
+    def save_snapshot(self, path):
+        """
+        Write the cached replies which can still be served to a snapshot,
+        along with the ones of the loaded snapshot not restored yet
+
+        :param path: Path of the snapshot file
+        :return: returns nothing
+        """
+        now = time.time()
+        entries = [
+            (key, entry.stored_at, entry.expires_at, entry.wire)
+            for key, entry in self._items()
+            if entry.expires_at + self.stale_ttl > now
+        ]
+        if self._snapshot is not None:
+            keys = set(item[0] for item in entries)
+            entries.extend(
+                item for item in self._snapshot
+                if item[0] not in keys and item[2] + self.stale_ttl > now
+            )
+        write_snapshot(path, entries)
+        self.log.info('Saved %i cached replies to snapshot %s', len(entries), path)
+
+    def load_snapshot(self, path):
+        """
+        Open a snapshot to restore the cached replies from it on demand
+
+        :param path: Path of the snapshot file
+        :return: returns nothing
+        """
+        try:
+            snapshot = Snapshot(path)
+        except FileNotFoundError:
+            self.log.info('No cache snapshot found at %s', path)
+            return
+        except (OSError, ValueError, struct.error) as exc:
+            self.log.warning('Unable to load cache snapshot %s: %s', path, exc)
+            return
+
+        if snapshot.expires_at + self.stale_ttl <= time.time():
+            self.log.info('Cache snapshot %s has expired', path)
+            snapshot.close()
+            return
+        self.log.info('Using cache snapshot %s of %i replies', path, len(snapshot))
+        self._snapshot = snapshot
+
+    def _restore(self, key):
+        """
+        Read the reply of a key missing from the cache from the snapshot
+
+        :return: the restored CacheEntry or None
+        """
+        snapshot = self._snapshot
+        if snapshot is None:
+            return None
+        now = time.time()
+        if snapshot.expires_at + self.stale_ttl <= now:
+            self.log.info('Closing expired cache snapshot')
+            self._snapshot = None
+            snapshot.close()
+            return None
+
+        found = snapshot.lookup(key)
+        if found is None:
+            return None
+        stored_at, expires_at, reply = found
+        if expires_at + self.stale_ttl <= now:
+            return None
+        try:
+            ttl_offsets, _ = wire.ttl_info(reply)
+        except wire.PARSE_ERRORS as exc:
+            self.log.debug('Snapshot reply not usable: %s', exc)
+            return None
+
+        prefetch_at = None
+        if self.prefetch:
+            prefetch_at = stored_at + (expires_at - stored_at) * self.prefetch
+        entry = CacheEntry(bytes(reply), ttl_offsets, stored_at, expires_at, prefetch_at)
+        self._store(key, entry)
+        self.restored += 1
+        return entry
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'bytes': self.size_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'stale_hits': self.stale_hits,
+            'prefetches': self.prefetches,
+            'restored': self.restored,
+        }
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+"""
+circuit_breaker module
+"""
+
+import logging
+from random import uniform
+
+from gevent import time
+
+
+CLOSED = 0
+HALF_OPEN = 1
+OPEN = 2
+STATE_NAMES = ('closed', 'half_open', 'open')
+
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_ERROR_RATE = 0.5
+DEFAULT_BACKOFF = 1.0
+DEFAULT_MAX_BACKOFF = 60.0
+# Outcomes of the last queries used to compute the error rate
+ERROR_WINDOW = 20
+# Fraction of the backoff added or removed at random, so the processes and
+# nameservers do not probe in lockstep
+BACKOFF_JITTER = 0.2
+# Seconds after which a probe without outcome, e.g. cancelled, is retried
+PROBE_TIMEOUT = 5.0
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker of the connections and queries to a nameserver
+
+    The circuit opens after failure_threshold consecutive failures, or when
+    the error rate of the last ERROR_WINDOW outcomes reaches error_rate, and
+    no query is sent to the nameserver while it is open. Once the backoff
+    passes it turns half-open and a single probe query is let through: a
+    success closes the circuit, a failure opens it again with twice the
+    backoff, up to max_backoff.
+
+    The generation of the breaker changes with every transition and probe,
+    and queries take the current one when they start. Only the outcome of
+    the query holding the generation of the probe decides a half-open
+    circuit, so replies and failures of queries sent before it opened are
+    only counted.
+
+    Checking the state only compares a timestamp, the window of outcomes is
+    a ring buffer with a running count of failures.
+
+    :param address: Address tuple of the nameserver
+    :param failure_threshold: Consecutive failures which open the circuit
+    :param error_rate: Fraction of failed outcomes which opens the circuit
+    :param backoff: Seconds the circuit stays open the first time
+    :param max_backoff: Maximum seconds the circuit stays open
+    """
+
+    def __init__(self, address, failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+                 error_rate=DEFAULT_ERROR_RATE, backoff=DEFAULT_BACKOFF,
+                 max_backoff=DEFAULT_MAX_BACKOFF):
+        self.log = logging.getLogger(__name__)
+        self.address = address
+        self.failure_threshold = failure_threshold
+        self.error_rate = error_rate
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.state = CLOSED
+        self.open_until = 0.0
+        self.probe_ts = None
+        self.generation = 0
+        self.consecutive_failures = 0
+        self.opens_in_row = 0
+        self._window = bytearray(ERROR_WINDOW)
+        self._window_index = 0
+        self._window_count = 0
+        self._window_failures = 0
+        self.transitions = [0] * len(STATE_NAMES)
+
+    @property
+    def state_name(self):
+        return STATE_NAMES[self.state]
+
+    def closed(self):
+        return self.state == CLOSED
+
+    def try_probe(self):
+        """
+        Take the single probe of a circuit whose backoff has passed
+
+        :return: True if the caller must send the probe query
+        """
+        now = time.time()
+        if self.state == OPEN:
+            if now < self.open_until:
+                return False
+            self._transition(HALF_OPEN)
+        elif self.state != HALF_OPEN:
+            return False
+        if self.probe_ts is not None and now - self.probe_ts < PROBE_TIMEOUT:
+            return False
+        self.probe_ts = now
+        self.generation += 1
+        return True
+
+    def record_success(self, generation=None):
+        """
+        Track a successful query
+
+        :param generation: Generation of the breaker when the query started,
+                           None for the current one
+        """
+        self.consecutive_failures = 0
+        self._record(0)
+        if self.state == HALF_OPEN and self._is_probe(generation):
+            self.opens_in_row = 0
+            self._reset_window()
+            self._transition(CLOSED)
+
+    def record_failure(self, generation=None):
+        """
+        Track a failed connection or query
+
+        :param generation: Generation of the breaker when the query started,
+                           None for the current one
+        """
+        self.consecutive_failures += 1
+        self._record(1)
+        if self.state == HALF_OPEN:
+            if self._is_probe(generation):
+                self._open()
+        elif self.state == CLOSED and (
+                self.consecutive_failures >= self.failure_threshold
+                or (self._window_count == ERROR_WINDOW
+                    and self._window_failures >= self.error_rate * ERROR_WINDOW)):
+            self._open()
+
+    def _is_probe(self, generation):
+        return generation is None or generation == self.generation
+
+    def _record(self, failed):
+        index = self._window_index
+        if self._window_count == ERROR_WINDOW:
+            self._window_failures -= self._window[index]
+        else:
+            self._window_count += 1
+        self._window[index] = failed
+        self._window_failures += failed
+        self._window_index = (index + 1) % ERROR_WINDOW
+
+    def _reset_window(self):
+        self._window[:] = bytes(ERROR_WINDOW)
+        self._window_index = 0
+        self._window_count = 0
+        self._window_failures = 0
+
+    def _open(self):
+        backoff = min(self.backoff * 2 ** self.opens_in_row, self.max_backoff)
+        backoff *= uniform(1 - BACKOFF_JITTER, 1 + BACKOFF_JITTER)
+        self.opens_in_row += 1
+        self.open_until = time.time() + backoff
+        self.log.warning('Opening circuit of nameserver %s for %.1fs after %i consecutive'
+                         ' and %i recent failures', self.address, backoff,
+                         self.consecutive_failures, self._window_failures)
+        self._transition(OPEN)
+
+    def _transition(self, state):
+        if state != OPEN:
+            self.log.warning('Circuit of nameserver %s is %s',
+                             self.address, STATE_NAMES[state].replace('_', '-'))
+        self.state = state
+        self.probe_ts = None
+        self.generation += 1
+        self.transitions[state] += 1
@@ -1,87 +1,219 @@
 import logging
-from random import choice
+from random import randint
+import gevent
 from gevent import time
 from gevent import lock
 from gevent import queue
 from gevent import socket
 from gevent import ssl
 from .socket_io import SocketIO
+from .deadline import DeadlineExceeded
+from .selection import RandomPolicy, address_name
+from .tcp_dns import TCPDNS
+from .circuit_breaker import CircuitBreaker
+from . import wire
 
 
 DEFAULT_CONNECTION_TIMEOUT = 1.0
 DEFAULT_NETWORK_TIMEOUT = 1.0
-BLACKLIST_TIME = 10
+DEFAULT_HEALTH_CHECK_INTERVAL = 30
+DEFAULT_ACQUIRE_TIMEOUT = 1.0
+DEFAULT_MAX_WAITING = 100
+HEALTH_CHECK_TIMEOUT = 2.0
+# Idle connections to every nameserver probed at most by every health check
+HEALTH_CHECK_PROBES = 2
+TLS_VERSIONS = {
+    '1.2': ssl.TLSVersion.TLSv1_2,
+    '1.3': ssl.TLSVersion.TLSv1_3,
+}
+
+
+class PoolExhausted(Exception):
+    """ raised when no connection to the nameserver can be taken without
+    waiting longer than allowed, so the request is shed.
+    """
+
+
+class NoUpstreamAvailable(Exception):
+    """ raised when the circuits of all the nameservers are open and none
+    of them is due to be probed, so the request can not be forwarded.
+    """
+
+
+class UpstreamPool(object):
+    """ connections to a single nameserver.
+
+    :param address: address tuple of the nameserver
+    :param size: maximum number of connections in use plus idle
+    :param min_idle: idle connections kept open in advance
+    :param max_idle: idle connections above this are closed when returned
+    :param breaker: CircuitBreaker of the nameserver
+    """
+
+    def __init__(self, address, size, min_idle=0, max_idle=None, breaker=None):
+        self.address = address
+        self.size = size
+        self.min_idle = min(min_idle, size)
+        self.max_idle = size if max_idle is None else max_idle
+        self.semaphore = lock.BoundedSemaphore(size)
+        self.idle = queue.LifoQueue()
+        self.waiting = 0
+        self.filling = False
+        self.breaker = breaker if breaker is not None else CircuitBreaker(address)
+        self.shed = 0
+
+    @property
+    def in_use(self):
+        return self.size - self.semaphore.counter
+
+    def full(self):
+        return self.semaphore.counter == 0
 
 
 class TCPConnectionPool(object):
+    """ pool of connections to the nameservers, keeping a separate sub-pool
+    for each nameserver. The nameserver is selected first and then a warm
+    connection to it is taken.
+    """
 
-    def __init__(self, addresses, size=5):
+    pipelining = False
+
+    def __init__(self, addresses, size=5, policy=None, min_idle=0, max_idle=None,
+                 health_check_interval=DEFAULT_HEALTH_CHECK_INTERVAL,
+                 acquire_timeout=DEFAULT_ACQUIRE_TIMEOUT,
+                 max_waiting=DEFAULT_MAX_WAITING, breaker_options=None):
         self.log = logging.getLogger(__name__)
         self._addresses = addresses
-        self._semaphore = lock.BoundedSemaphore(size)
-        self._socket_queue = queue.LifoQueue(size)
+        self.policy = policy if policy is not None else RandomPolicy()
+        self._upstreams = {
+            address: UpstreamPool(address, size, min_idle, max_idle,
+                                  CircuitBreaker(address, **(breaker_options or {})))
+            for address in addresses
+        }
         self.connection_timeout = DEFAULT_CONNECTION_TIMEOUT
         self.network_timeout = DEFAULT_NETWORK_TIMEOUT
         self.size = size
-        self._blacklist = list()
-        self._bl_semaphore = lock.BoundedSemaphore(1)
+        self.acquire_timeout = acquire_timeout
+        self.max_waiting = max_waiting
+        self.health_check_interval = health_check_interval
+        self.health_checks = 0
+        self.health_check_failures = 0
+
+    def start(self):
+        """ open min_idle connections to every nameserver and start the
+            background health checks of idle connections.
+        """
+        for address in self._addresses:
+            gevent.spawn(self.fill, address)
+        if self.health_check_interval > 0:
+            gevent.spawn(self._health_check_loop)
 
-    def _create_tcp_socket(self):
+    def _create_tcp_socket(self, address):
         """ tcp socket factory.
         """
         sock = socket.socket(
             socket.AF_INET, socket.SOCK_STREAM)
         return sock
 
-    def _create_socket(self):
+    def _create_socket(self, address, deadline=None, generation=None):
         """ might be overriden and super for wrapping into a ssl socket
             or set tcp/socket options
+
+        :param deadline: Deadline of the request the connection is opened
+                         for, it limits the connection timeout
+        :param generation: generation of the circuit breaker when the
+                           connection was requested, None for the current one
         """
         try:
-            sock = self._create_tcp_socket()
+            sock = self._create_tcp_socket(address)
         except Exception as exc:
             self.log.error('Error creating socket: %s', exc)
             raise
 
         try:
-            address = self.get_address()
-        except Exception:
-            raise
-
-        try:
-            sock.settimeout(self.connection_timeout)
+            if deadline is not None:
+                deadline.check('connection to %s:%s' % address[:2])
+                sock.settimeout(deadline.timeout(self.connection_timeout))
+            else:
+                sock.settimeout(self.connection_timeout)
             self.log.debug('Connecting to host: %s', address[:2])
+            connect_ts = time.time()
             sock.connect(address[:2])
             self.after_connect(sock, address)
             sock.settimeout(self.network_timeout)
             # Use the improved SocketIO methods
-            sock = SocketIO(sock)
+            sock = SocketIO(sock, address=address, connect_time=time.time() - connect_ts)
             return sock
+        except gevent.GreenletExit:
+            sock.close()
+            raise
         except Exception as exc:
             sock.close()
+            if deadline is not None and deadline.expired():
+                # Out of time for this request, not a failure of the nameserver
+                raise DeadlineExceeded('Deadline exceeded connecting to %s:%s: %s'
+                                       % (address[0], address[1], exc))
             self.log.warning('Error connecting to socket %s: %s', address, exc)
-            self.add_blacklist(address)
+            self._upstreams[address].breaker.record_failure(generation)
             raise
 
-    def get_socket(self):
-        """ get a socket from the pool. This blocks until one is available.
+    def get_socket(self, address=None, deadline=None):
+        """ get a socket from the pool. This blocks until one is available,
+        for at most acquire_timeout seconds. PoolExhausted is raised when
+        the wait times out or max_waiting requests are already waiting.
+
+        :param address: nameserver to connect to, selected by the policy if
+                        not given
+        :param deadline: Deadline of the request, DeadlineExceeded is raised
+                         if it passes while waiting
         """
-        self._semaphore.acquire()
+        if address is None:
+            address = self.get_address()
+        upstream = self._upstreams[address]
+        generation = upstream.breaker.generation
+
+        if self.max_waiting is not None and upstream.full() \
+                and upstream.waiting >= self.max_waiting:
+            self.count_shed(address)
+            raise PoolExhausted('Too many requests waiting for a connection to %s:%s'
+                                % address[:2])
+
+        timeout = self.acquire_timeout
+        if deadline is not None:
+            timeout = deadline.timeout(timeout)
+        upstream.waiting += 1
+        try:
+            acquired = upstream.semaphore.acquire(timeout=timeout)
+        finally:
+            upstream.waiting -= 1
+        if not acquired:
+            if deadline is not None and deadline.expired():
+                raise DeadlineExceeded('Deadline exceeded waiting for a connection to %s:%s'
+                                       % address[:2])
+            self.count_shed(address)
+            raise PoolExhausted('Timeout waiting for a connection to %s:%s' % address[:2])
+
         try:
-            return self._socket_queue.get(block=False)
+            return upstream.idle.get(block=False)
         except queue.Empty:
             try:
-                return self._create_socket()
-            except Exception:
-                self._semaphore.release()
+                return self._create_socket(address, deadline, generation)
+            except BaseException:
+                # Also when the request is cancelled, e.g. a hedged query
+                upstream.semaphore.release()
                 raise
 
     def return_socket(self, sock):
         """ return a socket to the pool.
         """
+        upstream = self._upstreams[sock.address]
+        if upstream.idle.qsize() >= upstream.max_idle:
+            self.log.debug('Closing socket #%s above max idle connections', sock.fileno())
+            self.release_socket(sock)
+            return
         self.log.debug('Returning socket #%s to connection pool', sock.fileno())
-        self._socket_queue.put(sock)
-        self._semaphore.release()
+        upstream.idle.put(sock)
+        upstream.semaphore.release()
 
     def release_socket(self, sock):
         """ call when the socket is no more usable.
@@ -91,61 +223,288 @@ class TCPConnectionPool(object):
             sock.close()
         except Exception:
             pass
-        self._semaphore.release()
+        upstream = self._upstreams[sock.address]
+        upstream.semaphore.release()
+        if upstream.idle.qsize() < upstream.min_idle:
+            gevent.spawn(self.fill, upstream.address)
+
+    def fill(self, address):
+        """ open connections to the nameserver until it has min_idle idle
+            connections, without waiting for a free slot.
+        """
+        upstream = self._upstreams[address]
+        if upstream.filling:
+            return
+        upstream.filling = True
+        try:
+            while (upstream.idle.qsize() < upstream.min_idle
+                   and upstream.idle.qsize() < upstream.semaphore.counter
+                   and upstream.breaker.closed()):
+                if not upstream.semaphore.acquire(blocking=False):
+                    return
+                try:
+                    sock = self._create_socket(address)
+                except Exception:
+                    return
+                else:
+                    upstream.idle.put(sock)
+                finally:
+                    upstream.semaphore.release()
+        finally:
+            upstream.filling = False
+
+    def _health_check_loop(self):
+        while True:
+            gevent.sleep(self.health_check_interval)
+            for address in self._addresses:
+                try:
+                    self.health_check(address)
+                except Exception as exc:
+                    self.log.error('Unexpected error checking connections to %s: %s', address, exc)
+
+    def health_check(self, address):
+        """ probe the HEALTH_CHECK_PROBES connections to the nameserver
+            which have been idle for the longest time, replacing the broken
+            ones before a client query uses them. The probed connections are
+            taken out of the pool without holding their slots, so requests
+            never wait for the probes, and the working ones are put back on
+            top of the idle ones.
+        """
+        upstream = self._upstreams[address]
+        idle = list()
+        while True:
+            try:
+                idle.append(upstream.idle.get(block=False))
+            except queue.Empty:
+                break
+        # The most recently used connections are on top of the idle stack
+        keep = max(0, len(idle) - HEALTH_CHECK_PROBES)
+        socks = idle[keep:]
+        for sock in reversed(idle[:keep]):
+            upstream.idle.put(sock)
+
+        if socks:
+            self.log.debug('Checking %s idle connections to %s', len(socks), address)
+            probes = [gevent.spawn(self.probe, sock) for sock in socks]
+            gevent.joinall(probes)
+            for sock, probe in zip(socks, probes):
+                self.health_checks += 1
+                if not probe.value:
+                    self.health_check_failures += 1
+                    self.log.info('Idle connection #%s to %s is broken, replacing it',
+                                  sock.fileno(), address)
+                    sock.close()
+                elif upstream.idle.qsize() >= upstream.max_idle:
+                    sock.close()
+                else:
+                    upstream.idle.put(sock)
+
+        self.fill(address)
+
+    def probe(self, sock):
+        """ send a cheap query through the socket, announcing the RFC 7828
+            edns-tcp-keepalive option, and check the reply.
+
+        :return: True if the connection works
+        """
+        msg_id = randint(0, 0xFFFF)
+        tcp_dns = TCPDNS(sock)
+        try:
+            with gevent.Timeout(HEALTH_CHECK_TIMEOUT, OSError('health check timeout')):
+                tcp_dns.send(wire.build_query(msg_id, keepalive=True))
+                wire.validate_reply(tcp_dns.recv(), msg_id)
+        except (OSError,) + wire.PARSE_ERRORS as exc:
+            self.log.debug('Health check of socket #%s failed: %s', sock.fileno(), exc)
+            return False
+        return True
+
+    def stats(self):
+        values = {
+            'health_checks': self.health_checks,
+            'health_check_failures': self.health_check_failures,
+        }
+        for address, upstream in self._upstreams.items():
+            name = address_name(address)
+            values['{} in_use'.format(name)] = upstream.in_use
+            values['{} idle'.format(name)] = upstream.idle.qsize()
+            values['{} waiting'.format(name)] = upstream.waiting
+            values['{} circuit_state'.format(name)] = upstream.breaker.state
+            values['{} circuit_opened'.format(name)] = upstream.breaker.transitions[-1]
+            values['{} shed'.format(name)] = upstream.shed
+        return values
+
+    @property
+    def upstreams(self):
+        """ sub-pools of every nameserver.
+        """
+        return list(self._upstreams.values())
 
     def after_connect(self, sock, address):
         pass
 
-    def get_address(self):
-        self.expire_blacklist()
-        blacklist = [x['address'] for x in self._blacklist]
-        available = [x for x in self._addresses if x not in blacklist]
-        self.log.debug('Blacklisted addresses: %s', blacklist)
+    def get_address(self, prefer_free=True, exclude=()):
+        """ select one of the nameservers whose circuit is closed using the
+        policy. A nameserver whose circuit is due to be probed is selected
+        instead, for a single request.
+
+        :param prefer_free: skip nameservers without free connection slots
+                            unless all of them are saturated
+        :param exclude: nameservers not to select, e.g. the one already
+                        queried when hedging
+        """
+        available = list()
+        for address in self._addresses:
+            if address in exclude:
+                continue
+            breaker = self._upstreams[address].breaker
+            if breaker.closed():
+                available.append(address)
+            elif breaker.try_probe():
+                self.log.info('Probing nameserver %s', address)
+                return address
         self.log.debug('Available addresses: %s', available)
-        if len(available):
-            return choice(available)
+        if len(available) and prefer_free:
+            # Avoid waiting for a saturated nameserver while others are free
+            free = [x for x in available if not self._upstreams[x].full()]
+            return self.policy.select(free or available)
+        elif len(available):
+            return self.policy.select(available)
         else:
-            raise RuntimeError('All addresses are currently blacklisted')
-
-    def add_blacklist(self, address):
-        self.log.warning('Adding address %s to blacklist', address)
-        item = {'address': address, 'timestamp': time.time()}
-        self._blacklist.append(item)
-
-    def expire_blacklist(self):
-        self._bl_semaphore.acquire()
-        new_blacklist = list()
-        now = time.time()
-        for item in self._blacklist:
-            self.log.debug('Checking blacklist expiration for %s', item)
-            if now - item['timestamp'] < BLACKLIST_TIME:
-                new_blacklist.append(item)
-            else:
-                self.log.warning('Removing address %s from blacklist', item['address'])
-        self._blacklist = new_blacklist
-        self._bl_semaphore.release()
+            raise NoUpstreamAvailable('All nameservers are unavailable, their circuits are open')
+
+    def start_query(self, address):
+        """ call when a query is sent to the nameserver at address.
+
+        :return: generation of the circuit breaker of the nameserver, to be
+                 given to finish_query
+        """
+        self.policy.start(address)
+        return self._upstreams[address].breaker.generation
+
+    def finish_query(self, address, rtt=None, cancelled=False, generation=None):
+        """ call when the query is done, with its round-trip time in seconds
+            or None if it failed.
+
+        :param cancelled: the query was abandoned by the proxy, e.g. a hedged
+                          query, which is not a failure of the nameserver
+        :param generation: generation returned by start_query
+        """
+        self.policy.finish(address, rtt)
+        breaker = self._upstreams[address].breaker
+        if rtt is not None:
+            breaker.record_success(generation)
+        elif not cancelled:
+            breaker.record_failure(generation)
+            self.policy.backoff(address, self.network_timeout)
+
+    def query_timeout(self, address):
+        """ timeout of a query to the nameserver at address, adapted to its
+            measured round-trip times and capped by the network timeout.
+            Probes of a circuit which is not closed get the whole network
+            timeout, as the adaptive one may be why it opened.
+        """
+        if not self._upstreams[address].breaker.closed():
+            return self.network_timeout
+        return self.policy.query_timeout(address, self.network_timeout)
+
+    def hedge_delay(self, address):
+        """ time to wait for the reply of the nameserver at address before
+            hedging the query to another one, None to not hedge it.
+        """
+        return self.policy.hedge_delay(address)
+
+    def count_shed(self, address):
+        """ call when a request to the nameserver at address is shed.
+        """
+        self._upstreams[address].shed += 1
 
 
 class TLSConnectionPool(TCPConnectionPool):
     """
     TLSConnectionPool creates connections wrapped with TLS
 
+    TLS 1.2 and 1.3 are supported. The last TLS session of every nameserver
+    is kept and reused by new connections to it, so reconnecting takes an
+    abbreviated handshake without the certificate exchange.
+
     :param addresses: list of tuples (address, port, hostname)
     :param port: port
-    :param size: size of the connection pool
+    :param size: size of the connection pool of each nameserver
+    :param policy: SelectionPolicy to choose among the nameservers
+    :param min_idle: idle connections kept open to each nameserver
+    :param max_idle: maximum idle connections kept open to each nameserver
+    :param health_check_interval: seconds between checks of idle connections
+    :param acquire_timeout: seconds to wait for a free connection, None to
+                            wait forever
+    :param max_waiting: requests waiting for a connection to each nameserver
+                        before new ones are shed, None for no limit
+    :param tls_min_version: minimum TLS version, '1.2' or '1.3'
+    :param cafile: file with CA certificates to trust instead of the system ones
+    :param breaker_options: dict of CircuitBreaker arguments for every
+                            nameserver
     """
 
-    def __init__(self, addresses, size=5):
-        super().__init__(addresses=addresses, size=size)
+    def __init__(self, addresses, size=5, policy=None, min_idle=0, max_idle=None,
+                 health_check_interval=DEFAULT_HEALTH_CHECK_INTERVAL,
+                 acquire_timeout=DEFAULT_ACQUIRE_TIMEOUT,
+                 max_waiting=DEFAULT_MAX_WAITING,
+                 tls_min_version='1.2', cafile=None, breaker_options=None):
+        super().__init__(addresses=addresses, size=size, policy=policy,
+                         min_idle=min_idle, max_idle=max_idle,
+                         health_check_interval=health_check_interval,
+                         acquire_timeout=acquire_timeout,
+                         max_waiting=max_waiting,
+                         breaker_options=breaker_options)
         self.log = logging.getLogger(__name__)
-        self.context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
+        self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        self.context.minimum_version = TLS_VERSIONS[tls_min_version]
         self.context.verify_mode = ssl.CERT_REQUIRED
-        self.context.load_default_certs()
+        self.context.check_hostname = True
+        if cafile:
+            self.context.load_verify_locations(cafile=cafile)
+        else:
+            self.context.load_default_certs()
+        self._sessions = dict()
+        self.full_handshakes = 0
+        self.resumed_handshakes = 0
+
+    def _create_tcp_socket(self, address):
+        sock = super()._create_tcp_socket(address)
+        return self.context.wrap_socket(
+            sock,
+            server_hostname=address[2],
+            session=self._sessions.get(address)
+        )
 
-    def _create_tcp_socket(self):
-        sock = super()._create_tcp_socket()
-        return self.context.wrap_socket(sock)
+    def _save_session(self, sock, address):
+        try:
+            session = sock.session
+        except (OSError, ValueError):
+            return
+        if session is not None and session.has_ticket:
+            self._sessions[address] = session
 
     def after_connect(self, sock, address):
         super().after_connect(sock, address)
-        ssl.match_hostname(sock.getpeercert(), address[2])
+        if sock.session_reused:
+            self.resumed_handshakes += 1
+        else:
+            self.full_handshakes += 1
+        self.log.debug('Connected to %s using %s, session reused: %s',
+                       address, sock.version(), sock.session_reused)
+        self._save_session(sock, address)
+
+    def return_socket(self, sock):
+        # TLS 1.3 session tickets are only received after the handshake
+        self._save_session(sock.sock, sock.address)
+        super().return_socket(sock)
+
+    def release_socket(self, sock):
+        self._save_session(sock.sock, sock.address)
+        super().release_socket(sock)
+
+    def stats(self):
+        values = super().stats()
+        values['tls_full_handshakes'] = self.full_handshakes
+        values['tls_resumed_handshakes'] = self.resumed_handshakes
+        return values
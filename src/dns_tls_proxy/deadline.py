@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+"""
+deadline module
+"""
+
+from gevent import time
+
+
+DEFAULT_REQUEST_TIMEOUT = 3.0
+
+
+class DeadlineExceeded(OSError):
+    """
+    The time budget of a request ran out
+    """
+
+
+class Deadline:
+    """
+    Point in time by which a request must be answered
+
+    A single deadline is created for every request and handed down to the
+    pool, the pipelined connections and the socket reads and writes, so
+    waiting and retrying stop once the budget of the request is spent.
+    """
+
+    __slots__ = ('expires_at',)
+
+    def __init__(self, timeout=DEFAULT_REQUEST_TIMEOUT, expires_at=None):
+        """
+        Construct a new 'Deadline' object
+
+        :param timeout: Seconds from now until the deadline
+        :param expires_at: Absolute time of the deadline, instead of timeout
+        :return: returns nothing
+        """
+        self.expires_at = expires_at if expires_at is not None else time.time() + timeout
+
+    def __repr__(self):
+        return '<Deadline in {:.3f}s>'.format(self.expires_at - time.time())
+
+    def remaining(self):
+        """
+        Seconds left until the deadline, 0 once it is exceeded
+        """
+        return max(0.0, self.expires_at - time.time())
+
+    def expired(self):
+        return time.time() >= self.expires_at
+
+    def timeout(self, timeout=None):
+        """
+        Seconds to wait for an operation, capped by the time left
+
+        :param timeout: Maximum seconds for the operation, None for no limit
+        """
+        remaining = self.remaining()
+        if timeout is None:
+            return remaining
+        return min(timeout, remaining)
+
+    def limit(self, timeout):
+        """
+        Deadline of a step of the request which must not take longer than
+        timeout seconds, nor outlive this deadline
+        """
+        return Deadline(expires_at=min(self.expires_at, time.time() + timeout))
+
+    def check(self, what='request'):
+        """
+        Raise DeadlineExceeded if the deadline has passed
+
+        :param what: Description of the operation for the error message
+        """
+        if self.expired():
+            raise DeadlineExceeded('Deadline exceeded while waiting for {}'.format(what))
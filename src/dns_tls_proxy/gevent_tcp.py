@@ -5,27 +5,135 @@ server_tcp module
 """
 
 import logging
+from gevent import socket
+from gevent import lock
+from gevent.pool import Pool
 from gevent.server import StreamServer
 from .request_handler import RequestHandlerTCP
+from .socket_io import SocketIO, reuse_port_socket
+from .tcp_dns import TCPDNS
+from .deadline import Deadline, DeadlineExceeded, DEFAULT_REQUEST_TIMEOUT
+from . import wire
+
+
+# Seconds without queries before closing a client connection
+DEFAULT_TCP_IDLE_TIMEOUT = 10.0
+# Queries of a single connection handled at once, reading more waits
+TCP_MAX_PENDING = 100
 
 
 class ServerTCP(StreamServer):
+    """
+    TCP listener keeping client connections open for many queries
 
-    def __init__(self, listener, conn_pool, stats_queue=None):
+    Following RFC 7766, queries read from a connection are handled
+    concurrently and every reply is written as soon as it is ready, so
+    replies may be sent out of order. Connections without queries for
+    idle_timeout seconds are closed.
+    """
+
+    def __init__(self, listener, conn_pool, stats=None, cache=None,
+                 inflight=None, reuse_port=False, strict=False, max_handlers=None,
+                 timeout=DEFAULT_REQUEST_TIMEOUT, hedging=None,
+                 idle_timeout=DEFAULT_TCP_IDLE_TIMEOUT, blocklist=None):
         super().__init__(listener)
         self.log = logging.getLogger(__name__)
+        self.handlers = Pool(max_handlers) if max_handlers else None
         self.conn_pool = conn_pool
-        self.stats_queue = stats_queue
+        self.stats = stats
+        self.cache = cache
+        self.inflight = inflight
+        self.reuse_port = reuse_port
+        self.strict = strict
+        self.timeout = timeout
+        self.hedging = hedging
+        self.idle_timeout = idle_timeout
+        self.blocklist = blocklist
+
+    def get_listener(self, address, backlog=None, family=None):
+        if not self.reuse_port:
+            return super().get_listener(address, backlog=backlog, family=family)
+        sock = reuse_port_socket(address, family, socket.SOCK_STREAM)
+        sock.listen(backlog or self.backlog)
+        sock.setblocking(0)
+        return sock
+
+    def do_handle(self, source, address):
+        # Close new connections at once while max_handlers requests are
+        # running, no query has been read yet
+        if self.handlers is not None and self.handlers.full():
+            self.shed(source, address)
+            return
+        super().do_handle(source, address)
+
+    def shed(self, source, address):
+        self.log.info('Closing TCP connection from %s, too many requests in progress', address)
+        if self.stats:
+            self.stats.record_shed('TCP')
+        self.do_close(source, address)
 
     def handle(self, source, address):
-        self.log.info('New TCP request received from %s', address)
+        self.log.info('New TCP connection received from %s', address)
+
+        tcp_dns = TCPDNS(SocketIO(source))
+        write_lock = lock.Semaphore(1)
+        requests = Pool(TCP_MAX_PENDING)
+        try:
+            while True:
+                try:
+                    request = tcp_dns.recv(deadline=Deadline(self.idle_timeout))
+                except (DeadlineExceeded, socket.timeout):
+                    if len(requests):
+                        continue
+                    self.log.info('Closing idle TCP connection from %s', address)
+                    break
+                except OSError as exc:
+                    self.log.debug('TCP connection from %s closed: %s', address, exc)
+                    break
+
+                requests.wait_available()
+                if self.handlers is not None and self.handlers.full():
+                    self.refuse(tcp_dns, write_lock, request, address)
+                    continue
+                greenlet = requests.spawn(self.handle_request, tcp_dns, write_lock,
+                                          request, address)
+                if self.handlers is not None:
+                    self.handlers.add(greenlet)
+        finally:
+            # Send the replies of the queries in progress before closing
+            requests.join(timeout=self.timeout)
+            requests.kill()
 
+    def handle_request(self, tcp_dns, write_lock, request, address):
         request_handler = RequestHandlerTCP(
             address=address,
-            socket=source,
+            socket=tcp_dns.sock.sock,
             conn_pool=self.conn_pool,
-            stats_queue=self.stats_queue
+            stats=self.stats,
+            data=request,
+            tcp_dns=tcp_dns,
+            write_lock=write_lock,
+            cache=self.cache,
+            inflight=self.inflight,
+            strict=self.strict,
+            timeout=self.timeout,
+            hedging=self.hedging,
+            blocklist=self.blocklist
         )
-        result = request_handler.proxy_request()
+        try:
+            return request_handler.proxy_request()
+        except Exception as exc:
+            self.log.info('Error handling TCP request from %s: %s', address, exc)
 
-        return result
+    def refuse(self, tcp_dns, write_lock, request, address):
+        self.log.info('Refusing TCP request from %s, too many requests in progress', address)
+        if self.stats:
+            self.stats.record_shed('TCP')
+        reply = wire.error_reply(request, wire.RCODE_REFUSED)
+        if reply is None:
+            return
+        try:
+            with write_lock:
+                tcp_dns.send(reply)
+        except OSError as exc:
+            self.log.info('Error refusing request from %s: %s', address, exc)
@@ -5,17 +5,68 @@ server_udp module
 """
 
 import logging
+import gevent
+from gevent import event
+from gevent import queue
+from gevent import socket
+from gevent.pool import Pool
 from gevent.server import DatagramServer
 from .request_handler import RequestHandlerUDP
+from .socket_io import reuse_port_socket
+from .deadline import DEFAULT_REQUEST_TIMEOUT
+from . import wire
+
+
+# Datagrams read at most every time the socket is readable
+DEFAULT_UDP_BATCH_SIZE = 64
+DEFAULT_UDP_WORKERS = 1000
+MAX_DATAGRAM_LEN = 65535
 
 
 class ServerUDP(DatagramServer):
 
-    def __init__(self, listener, conn_pool, stats_queue=None):
-        super().__init__(listener)
+    def __init__(self, listener, conn_pool, stats=None, cache=None,
+                 inflight=None, reuse_port=False, strict=False, max_handlers=None,
+                 timeout=DEFAULT_REQUEST_TIMEOUT, hedging=None, blocklist=None):
+        self.handlers = Pool(max_handlers) if max_handlers else None
+        super().__init__(
+            listener,
+            spawn=self.handlers.spawn if self.handlers is not None else 'default'
+        )
         self.log = logging.getLogger(__name__)
         self.conn_pool = conn_pool
-        self.stats_queue = stats_queue
+        self.stats = stats
+        self.cache = cache
+        self.inflight = inflight
+        self.reuse_port = reuse_port
+        self.strict = strict
+        self.timeout = timeout
+        self.hedging = hedging
+        self.blocklist = blocklist
+
+    def get_listener(self, address, family=None):
+        if not self.reuse_port:
+            return super().get_listener(address, family=family)
+        return reuse_port_socket(address, family, socket.SOCK_DGRAM)
+
+    def do_handle(self, data, address):
+        # Answer at once instead of queueing once max_handlers are running
+        if self.handlers is not None and self.handlers.full():
+            self.shed(data, address)
+            return
+        super().do_handle(data, address)
+
+    def shed(self, data, address):
+        self.log.info('Refusing UDP request from %s, too many requests in progress', address)
+        if self.stats:
+            self.stats.record_shed('UDP')
+        reply = wire.error_reply(data, wire.RCODE_REFUSED)
+        if reply is None:
+            return
+        try:
+            self.socket.sendto(reply, address)
+        except OSError as exc:
+            self.log.info('Error refusing request from %s: %s', address, exc)
 
     def handle(self, data, address):
         self.log.info('New UDP request received from %s', address)
@@ -25,8 +76,182 @@ class ServerUDP(DatagramServer):
             socket=self.socket,
             conn_pool=self.conn_pool,
             data=data,
-            stats_queue=self.stats_queue
+            stats=self.stats,
+            cache=self.cache,
+            inflight=self.inflight,
+            strict=self.strict,
+            timeout=self.timeout,
+            hedging=self.hedging,
+            blocklist=self.blocklist
         )
         result = request_handler.proxy_request()
 
         return result
+
+
+class BatchStats:
+    """
+    Counters of the batched UDP listener, the average batch size is the
+    datagrams per batch. Deferred replies are the ones written by the
+    flusher because the socket buffer was full.
+    """
+
+    __slots__ = ('requests', 'batches', 'datagrams', 'replies', 'deferred')
+
+    def __init__(self, requests):
+        self.requests = requests
+        self.batches = 0
+        self.datagrams = 0
+        self.replies = 0
+        self.deferred = 0
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'datagrams': self.datagrams,
+            'replies': self.replies,
+            'deferred': self.deferred,
+            'queued': self.requests.qsize(),
+        }
+
+
+class BatchedServerUDP(ServerUDP):
+    """
+    High-throughput UDP listener handling datagrams in batches
+
+    Every time the socket is readable up to batch_size datagrams are read
+    with non-blocking reads into a reused buffer. The queries are queued for
+    a fixed pool of worker greenlets instead of spawning one greenlet for
+    each. Replies are written at once with non-blocking writes. When the
+    socket buffer is full they are queued and written by a flusher greenlet
+    once the socket is writable, so the workers never wait for it.
+    """
+
+    def __init__(self, listener, conn_pool, stats=None, cache=None,
+                 inflight=None, reuse_port=False, strict=False, max_handlers=None,
+                 timeout=DEFAULT_REQUEST_TIMEOUT, hedging=None,
+                 batch_size=DEFAULT_UDP_BATCH_SIZE, blocklist=None):
+        super().__init__(
+            listener,
+            conn_pool=conn_pool,
+            stats=stats,
+            cache=cache,
+            inflight=inflight,
+            reuse_port=reuse_port,
+            strict=strict,
+            timeout=timeout,
+            hedging=hedging,
+            blocklist=blocklist
+        )
+        self.size = max_handlers or DEFAULT_UDP_WORKERS
+        self.batch_size = batch_size
+        self.requests = queue.Queue()
+        self.replies = list()
+        self._has_replies = event.Event()
+        self._buffer = bytearray(MAX_DATAGRAM_LEN)
+        self._view = memoryview(self._buffer)
+        self._greenlets = list()
+        self.batch_stats = BatchStats(self.requests)
+
+    def start(self):
+        super().start()
+        self._greenlets = [gevent.spawn(self._work) for _ in range(self.size)]
+        self._greenlets.append(gevent.spawn(self._flush_loop))
+
+    def close(self):
+        gevent.killall(self._greenlets)
+        self._greenlets = list()
+        super().close()
+
+    def do_read(self):
+        batch = list()
+        for _ in range(self.batch_size):
+            try:
+                length, address = self._socket.recvfrom_into(self._view)
+            except BlockingIOError:
+                break
+            # Copied, the buffer is reused before the query is handled
+            batch.append((self._view[:length].tobytes(), address))
+        if not batch:
+            return None
+        self.batch_stats.batches += 1
+        self.batch_stats.datagrams += len(batch)
+        return batch, None
+
+    def do_handle(self, batch, _):
+        for data, address in batch:
+            # Requests waiting for a worker beyond the number of workers
+            # would not be answered in time
+            if self.requests.qsize() >= self.size:
+                self.shed(data, address)
+            else:
+                self.requests.put((data, address))
+
+    def _work(self):
+        while True:
+            data, address = self.requests.get()
+            try:
+                self.handle(data, address)
+            except Exception as exc:
+                self.log.error('Unexpected error handling UDP request from %s: %s', address, exc)
+
+    def handle(self, data, address):
+        self.log.info('New UDP request received from %s', address)
+
+        request_handler = RequestHandlerUDP(
+            address=address,
+            socket=self,
+            conn_pool=self.conn_pool,
+            data=data,
+            stats=self.stats,
+            cache=self.cache,
+            inflight=self.inflight,
+            strict=self.strict,
+            timeout=self.timeout,
+            hedging=self.hedging,
+            blocklist=self.blocklist
+        )
+        return request_handler.proxy_request()
+
+    def sendto(self, data, address):
+        """
+        Write a reply without blocking, or queue it for the flusher while
+        the socket buffer is full
+        """
+        # Replies already queued go first
+        if not self.replies and self._send(data, address):
+            return
+        self.replies.append((data, address))
+        self._has_replies.set()
+
+    def _send(self, data, address):
+        """
+        Write a reply without blocking. Replies which can not be sent to
+        their address are logged and dropped.
+
+        :return: False if the socket buffer is full, True otherwise
+        """
+        try:
+            self._socket.sendto(data, address)
+        except BlockingIOError:
+            return False
+        except OSError as exc:
+            self.log.info('Error sending reply to %s: %s', address, exc)
+        self.batch_stats.replies += 1
+        return True
+
+    def _flush_loop(self):
+        while True:
+            self._has_replies.wait()
+            self._has_replies.clear()
+            # Only this greenlet waits until the socket is writable while the
+            # workers keep queueing replies
+            socket.wait_write(self._socket.fileno())
+            replies = self.replies
+            sent = 0
+            while sent < len(replies) and self._send(*replies[sent]):
+                sent += 1
+            self.batch_stats.deferred += sent
+            del replies[:sent]
+            if replies:
+                self._has_replies.set()
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+"""
+hedging module
+"""
+
+import logging
+
+
+# Hedged queries which can be sent in a burst after a quiet period
+HEDGE_BUDGET_BURST = 10
+
+
+class HedgeBudget:
+    """
+    Budget of hedged queries, to cap the extra load sent to the nameservers
+
+    Every request forwarded upstream earns a fraction of a hedged query,
+    and every hedged query spends a whole one, so at most that fraction of
+    extra queries is sent on average. Unspent budget is kept up to a small
+    burst.
+    """
+
+    def __init__(self, ratio, burst=HEDGE_BUDGET_BURST):
+        """
+        Construct a new 'HedgeBudget' object
+
+        :param ratio: Hedged queries allowed per forwarded request, e.g. 0.05
+                      for at most 5% extra queries
+        :param burst: Maximum number of hedged queries saved up
+        :return: returns nothing
+        """
+        self.log = logging.getLogger(__name__)
+        self.ratio = ratio
+        self.burst = burst
+        self.balance = 0.0
+        self.hedged = 0
+        self.won = 0
+        self.denied = 0
+
+    def deposit(self):
+        """
+        Earn budget for a request forwarded upstream
+        """
+        self.balance = min(self.burst, self.balance + self.ratio)
+
+    def withdraw(self):
+        """
+        Spend budget for a hedged query
+
+        :return: True if the hedged query can be sent
+        """
+        if self.balance < 1:
+            self.denied += 1
+            return False
+        self.balance -= 1
+        self.hedged += 1
+        return True
+
+    def stats(self):
+        return {
+            'hedged': self.hedged,
+            'won': self.won,
+            'denied': self.denied,
+        }
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+"""
+histogram module
+"""
+
+from array import array
+
+# Every power of two range of values is split in this many linear buckets,
+# giving a relative error of at most 1 / SUB_BUCKETS
+SUB_BUCKET_BITS = 4
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+# Values are recorded with microsecond resolution
+UNITS_PER_SECOND = 1000000
+# Longer durations, about 134 seconds, are recorded as this value
+MAX_VALUE = (1 << 27) - 1
+
+PERCENTILES = (0.5, 0.9, 0.99)
+
+
+def bucket_index(value):
+    """
+    Index of the log-linear bucket holding an integer value
+    """
+    if value < SUB_BUCKETS:
+        return value
+    shift = value.bit_length() - SUB_BUCKET_BITS - 1
+    return (shift + 1) * SUB_BUCKETS + (value >> shift) - SUB_BUCKETS
+
+
+def bucket_upper(index):
+    """
+    Highest integer value held by a bucket
+    """
+    if index < SUB_BUCKETS:
+        return index
+    shift = index // SUB_BUCKETS - 1
+    mantissa = SUB_BUCKETS + index % SUB_BUCKETS
+    return ((mantissa + 1) << shift) - 1
+
+
+NUM_BUCKETS = bucket_index(MAX_VALUE) + 1
+EMPTY_COUNTS = array('Q', bytes(8 * NUM_BUCKETS))
+
+
+class Histogram:
+    """
+    Compact log-linear histogram of durations, in the style of HdrHistogram
+
+    Counters are kept in a preallocated array of a few hundred buckets, so
+    recording a duration only increments integers in place. Percentiles are
+    reported as the upper bound of their bucket.
+    """
+
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.counts = array('Q', EMPTY_COUNTS)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def __len__(self):
+        return self.count
+
+    def record(self, seconds):
+        """
+        Record a duration
+
+        :param seconds: Duration in seconds
+        """
+        value = min(max(0, int(seconds * UNITS_PER_SECOND)), MAX_VALUE)
+        self.counts[bucket_index(value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """
+        Add the values recorded in another histogram to this one
+        """
+        counts = self.counts
+        for index, count in enumerate(other.counts):
+            if count:
+                counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def reset(self):
+        """
+        Forget every recorded duration, reusing the counters
+        """
+        self.counts[:] = EMPTY_COUNTS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def percentile(self, fraction):
+        """
+        Value below which the given fraction of the durations fall
+
+        :param fraction: Fraction between 0 and 1
+        :return: Duration in seconds, 0 if the histogram is empty
+        """
+        if not self.count:
+            return 0
+        rank = max(1, int(round(fraction * self.count)))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bucket_upper(index), self.max) / UNITS_PER_SECOND
+        return self.max / UNITS_PER_SECOND
+
+    def cumulative(self, bounds):
+        """
+        Number of durations below every bound, as in Prometheus histograms.
+        Durations are counted by the upper bound of their bucket.
+
+        :param bounds: Sorted list of durations in seconds
+        :return: list of counts, one for every bound
+        """
+        counts = [0] * len(bounds)
+        limits = [b * UNITS_PER_SECOND for b in bounds]
+        for index, count in enumerate(self.counts):
+            if not count:
+                continue
+            upper = bucket_upper(index)
+            for i, limit in enumerate(limits):
+                if upper <= limit:
+                    counts[i] += count
+                    break
+        total = 0
+        for i, count in enumerate(counts):
+            total += count
+            counts[i] = total
+        return counts
+
+    def summary(self):
+        """
+        Count, average, percentiles and maximum in milliseconds
+        """
+        values = {'count': self.count}
+        if self.count:
+            values['avg_ms'] = round(self.total / self.count / 1000, 2)
+        for fraction in PERCENTILES:
+            key = 'p{}_ms'.format(int(fraction * 100))
+            values[key] = round(self.percentile(fraction) * 1000, 2)
+        values['max_ms'] = round(self.max / 1000, 2)
+        return values
+
+    def to_dict(self):
+        return {
+            'counts': {str(k): v for k, v in enumerate(self.counts) if v},
+            'count': self.count,
+            'total': self.total,
+            'max': self.max,
+        }
+
+    @classmethod
+    def from_dict(cls, values):
+        histogram = cls()
+        for index, count in values['counts'].items():
+            histogram.counts[int(index)] = count
+        histogram.count = values['count']
+        histogram.total = values['total']
+        histogram.max = values['max']
+        return histogram
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+"""
+inflight module
+"""
+
+import logging
+from gevent import event
+
+
+class InflightTable:
+    """
+    Single-flight table to coalesce identical queries in flight
+
+    The first request for a key is the leader and goes upstream. Identical
+    requests arriving meanwhile wait for the leader to finish and reuse its
+    reply.
+    """
+
+    def __init__(self):
+        self.log = logging.getLogger(__name__)
+        self.leaders = 0
+        self.coalesced = 0
+        self._inflight = dict()
+
+    def __len__(self):
+        return len(self._inflight)
+
+    def join(self, key):
+        """
+        Join the flight for a key
+
+        :param key: Key identifying the query
+        :return: tuple (leader, result), leader is True when the caller must
+                 forward the query itself and then call finish()
+        """
+        result = self._inflight.get(key)
+        if result is not None:
+            self.coalesced += 1
+            return False, result
+
+        result = event.AsyncResult()
+        self._inflight[key] = result
+        self.leaders += 1
+        return True, result
+
+    def finish(self, key, reply):
+        """
+        Hand the reply of the leader to every waiting request
+
+        :param key: Key identifying the query
+        :param reply: Reply in wire format, or None if the leader failed
+        """
+        result = self._inflight.pop(key, None)
+        if result is not None:
+            result.set(reply)
+
+    def stats(self):
+        return {
+            'inflight': len(self._inflight),
+            'leaders': self.leaders,
+            'coalesced': self.coalesced,
+        }
@@ -10,7 +10,22 @@ import configargparse
 from . import __project_name__, __version__
 from . import logger
 from .portnumber import PortNumber
-from .proxy import Proxy
+from .proxy import Proxy, DEFAULT_MAX_HANDLERS
+from .cache import DEFAULT_CACHE_SIZE, DEFAULT_CACHE_MAX_BYTES
+from .snapshot import DEFAULT_SNAPSHOT_INTERVAL
+from .shared_cache import DEFAULT_SLOT_SIZE
+from .blocklist import BLOCK_MODES, DEFAULT_BLOCKLIST_INTERVAL, DEFAULT_BLOCKED_TTL
+from .circuit_breaker import (
+    DEFAULT_FAILURE_THRESHOLD, DEFAULT_ERROR_RATE, DEFAULT_BACKOFF,
+    DEFAULT_MAX_BACKOFF
+)
+from .selection import POLICIES
+from .deadline import DEFAULT_REQUEST_TIMEOUT
+from .gevent_tcp import DEFAULT_TCP_IDLE_TIMEOUT
+from .connection_pool import (
+    DEFAULT_HEALTH_CHECK_INTERVAL, DEFAULT_ACQUIRE_TIMEOUT, DEFAULT_MAX_WAITING,
+    TLS_VERSIONS
+)
 
 
 def main():
@@ -33,12 +48,20 @@ def main():
     group.add_argument(
         '-n', '--nameserver',
         dest='nameservers',
-        metavar='<nameserver>:<port>:<CN-verify>',
+        metavar='<nameserver>:<port>:<CN-verify>[:<weight>]',
         action='append',
         env_var='NAMESERVERS',
         help='Set the nameservers to forward DNS over TLS queries.'
              ' Use it multiple times to add more nameservers'
     )
+    parser.add_argument(
+        '--upstream-policy',
+        default='random',
+        env_var='UPSTREAM_POLICY',
+        choices=sorted(POLICIES),
+        help='Policy to select the nameserver to forward each query to.'
+             ' Weights are used by the weighted policy'
+    )
     parser.add_argument(
         '-l', '--logfile',
         env_var='LOGFILE',
@@ -89,7 +112,250 @@ def main():
         default=5,
         env_var='POOL_SIZE',
         type=int,
-        help='Size of the nameservers connection pool'
+        help='Size of the connection pool of each nameserver'
+    )
+    parser.add_argument(
+        '--pool-min-idle',
+        default=0,
+        env_var='POOL_MIN_IDLE',
+        type=int,
+        help='Idle connections kept open to each nameserver'
+    )
+    parser.add_argument(
+        '--pool-max-idle',
+        default=None,
+        env_var='POOL_MAX_IDLE',
+        type=int,
+        help='Maximum idle connections kept open to each nameserver,'
+             ' defaults to the pool size'
+    )
+    parser.add_argument(
+        '--request-timeout',
+        default=DEFAULT_REQUEST_TIMEOUT,
+        env_var='REQUEST_TIMEOUT',
+        type=float,
+        help='Seconds to answer every request, including retries, before'
+             ' replying SERVFAIL'
+    )
+    parser.add_argument(
+        '--udp-batch-size',
+        default=0,
+        env_var='UDP_BATCH_SIZE',
+        type=int,
+        help='Use the batched UDP listener, reading up to this many datagrams'
+             ' at once. 0 uses the default UDP listener'
+    )
+    parser.add_argument(
+        '--tcp-idle-timeout',
+        default=DEFAULT_TCP_IDLE_TIMEOUT,
+        env_var='TCP_IDLE_TIMEOUT',
+        type=float,
+        help='Seconds without queries before closing client TCP connections'
+    )
+    parser.add_argument(
+        '--hedge-budget',
+        default=0,
+        env_var='HEDGE_BUDGET',
+        type=float,
+        help='Percentage of extra queries allowed to hedge slow queries to'
+             ' another nameserver, 0 disables hedging'
+    )
+    parser.add_argument(
+        '--pool-acquire-timeout',
+        default=DEFAULT_ACQUIRE_TIMEOUT,
+        env_var='POOL_ACQUIRE_TIMEOUT',
+        type=float,
+        help='Seconds to wait for a free nameserver connection before'
+             ' replying SERVFAIL'
+    )
+    parser.add_argument(
+        '--pool-max-waiting',
+        default=DEFAULT_MAX_WAITING,
+        env_var='POOL_MAX_WAITING',
+        type=int,
+        help='Requests waiting for a connection to each nameserver before'
+             ' replying SERVFAIL to new ones'
+    )
+    parser.add_argument(
+        '--max-handlers',
+        default=DEFAULT_MAX_HANDLERS,
+        env_var='MAX_HANDLERS',
+        type=int,
+        help='Requests handled at once by every listener, new ones are'
+             ' refused above it. 0 disables the limit'
+    )
+    parser.add_argument(
+        '--health-check-interval',
+        default=DEFAULT_HEALTH_CHECK_INTERVAL,
+        env_var='HEALTH_CHECK_INTERVAL',
+        type=float,
+        help='Seconds between health checks of idle nameserver connections,'
+             ' 0 disables them'
+    )
+    parser.add_argument(
+        '--circuit-failures',
+        default=DEFAULT_FAILURE_THRESHOLD,
+        env_var='CIRCUIT_FAILURES',
+        type=int,
+        help='Consecutive failures of a nameserver which open its circuit,'
+             ' so it is not queried until a probe query succeeds'
+    )
+    parser.add_argument(
+        '--circuit-error-rate',
+        default=DEFAULT_ERROR_RATE,
+        env_var='CIRCUIT_ERROR_RATE',
+        type=float,
+        help='Fraction of the last 20 queries to a nameserver which must fail'
+             ' to open its circuit'
+    )
+    parser.add_argument(
+        '--circuit-backoff',
+        default=DEFAULT_BACKOFF,
+        env_var='CIRCUIT_BACKOFF',
+        type=float,
+        help='Seconds the circuit of a nameserver stays open before a probe'
+             ' query, doubled every time the probe fails'
+    )
+    parser.add_argument(
+        '--circuit-max-backoff',
+        default=DEFAULT_MAX_BACKOFF,
+        env_var='CIRCUIT_MAX_BACKOFF',
+        type=float,
+        help='Maximum seconds the circuit of a nameserver stays open'
+    )
+    parser.add_argument(
+        '--tls-min-version',
+        default='1.2',
+        env_var='TLS_MIN_VERSION',
+        choices=sorted(TLS_VERSIONS),
+        help='Minimum TLS version to use with the nameservers'
+    )
+    parser.add_argument(
+        '--cafile',
+        env_var='CAFILE',
+        help='File with the CA certificates to verify the nameservers,'
+             ' instead of the system CA store'
+    )
+    parser.add_argument(
+        '--pipelining',
+        action='store_true',
+        env_var='PIPELINING',
+        help='Send many queries at once over each nameserver connection'
+    )
+    parser.add_argument(
+        '--cache-size',
+        default=DEFAULT_CACHE_SIZE,
+        env_var='CACHE_SIZE',
+        type=int,
+        help='Number of DNS replies to cache, 0 disables caching'
+    )
+    parser.add_argument(
+        '--cache-max-bytes',
+        default=DEFAULT_CACHE_MAX_BYTES,
+        env_var='CACHE_MAX_BYTES',
+        type=int,
+        help='Maximum memory in bytes used by cached DNS replies'
+    )
+    parser.add_argument(
+        '--cache-stale-ttl',
+        default=0,
+        env_var='CACHE_STALE_TTL',
+        type=int,
+        help='Seconds expired DNS replies are kept to answer with them when'
+             ' the nameservers fail, 0 disables serving stale replies'
+    )
+    parser.add_argument(
+        '--cache-prefetch',
+        default=0,
+        env_var='CACHE_PREFETCH',
+        type=float,
+        help='Fraction of the TTL after which cached DNS replies still'
+             ' queried are refreshed in the background, e.g. 0.9. 0 disables'
+             ' prefetching'
+    )
+    parser.add_argument(
+        '--cache-snapshot',
+        default=None,
+        env_var='CACHE_SNAPSHOT',
+        help='File to save the cached DNS replies to at shutdown and'
+             ' periodically, to restore them after a restart. Every worker'
+             ' process appends its index to the file name'
+    )
+    parser.add_argument(
+        '--cache-snapshot-interval',
+        default=DEFAULT_SNAPSHOT_INTERVAL,
+        env_var='CACHE_SNAPSHOT_INTERVAL',
+        type=float,
+        help='Seconds between snapshots of the cache, 0 only saves it at'
+             ' shutdown'
+    )
+    parser.add_argument(
+        '--cache-shared',
+        action='store_true',
+        env_var='CACHE_SHARED',
+        help='Keep the DNS replies cache in shared memory, used by all the'
+             ' worker processes'
+    )
+    parser.add_argument(
+        '--cache-slot-size',
+        default=DEFAULT_SLOT_SIZE,
+        env_var='CACHE_SLOT_SIZE',
+        type=int,
+        help='Bytes of every entry of the shared cache, bigger DNS replies'
+             ' are not cached'
+    )
+    parser.add_argument(
+        '--blocklist',
+        dest='blocklists',
+        action='append',
+        env_var='BLOCKLISTS',
+        help='File of domains to block, one per line or in hosts file format.'
+             ' Hosts entries with other addresses than 0.0.0.0 override the'
+             ' names. Use it multiple times to add more files'
+    )
+    parser.add_argument(
+        '--blocklist-mode',
+        default='nxdomain',
+        env_var='BLOCKLIST_MODE',
+        choices=BLOCK_MODES,
+        help='Reply to blocked names with NXDOMAIN, or with 0.0.0.0 and ::'
+    )
+    parser.add_argument(
+        '--blocklist-ttl',
+        default=DEFAULT_BLOCKED_TTL,
+        env_var='BLOCKLIST_TTL',
+        type=int,
+        help='TTL of the replies to blocked and overridden names'
+    )
+    parser.add_argument(
+        '--blocklist-interval',
+        default=DEFAULT_BLOCKLIST_INTERVAL,
+        env_var='BLOCKLIST_INTERVAL',
+        type=float,
+        help='Seconds between checks for changes of the blocklist files, 0'
+             ' disables reloading them'
+    )
+    parser.add_argument(
+        '--workers',
+        default=1,
+        env_var='WORKERS',
+        type=int,
+        help='Number of worker processes listening on the same port'
+    )
+    parser.add_argument(
+        '--strict-validation',
+        dest='strict',
+        action='store_true',
+        env_var='STRICT_VALIDATION',
+        help='Fully parse DNS messages instead of only checking their headers'
+    )
+
+    parser.add_argument(
+        '--metrics-port',
+        env_var='METRICS_PORT',
+        type=PortNumber,
+        help='Port to expose Prometheus metrics on at /metrics. With several'
+             ' workers, every worker uses the next port'
     )
 
     args = parser.parse_args()
@@ -101,6 +367,9 @@ def main():
     if not (args.udp or args.tcp):
         parser.error('At least one listener must be enabled using --tcp and/or --udp')
 
+    if args.metrics_port and not args.stats:
+        parser.error('Stats must be enabled to expose metrics')
+
     if args.debug:
         loglevel = logging.DEBUG
     elif args.verbose:
@@ -113,8 +382,11 @@ def main():
     nameservers = list()
     for arg_nameserver in args.nameservers:
         for nameserver in arg_nameserver.split(','):
-            ip, port, cn = nameserver.split(':')
-            nameservers.append((ip, int(port), cn))
+            ip, port, cn, *weight = nameserver.split(':')
+            if weight:
+                nameservers.append((ip, int(port), cn, int(weight[0])))
+            else:
+                nameservers.append((ip, int(port), cn))
 
     proxy = Proxy(
         nameservers=nameservers,
@@ -122,6 +394,39 @@ def main():
         tcp=args.tcp,
         udp=args.udp,
         stats=args.stats,
-        pool_size=args.pool_size
+        pool_size=args.pool_size,
+        pool_min_idle=args.pool_min_idle,
+        pool_max_idle=args.pool_max_idle,
+        health_check_interval=args.health_check_interval,
+        tls_min_version=args.tls_min_version,
+        cafile=args.cafile,
+        pipelining=args.pipelining,
+        cache_size=args.cache_size,
+        cache_max_bytes=args.cache_max_bytes,
+        workers=args.workers,
+        strict=args.strict,
+        policy=args.upstream_policy,
+        metrics_port=args.metrics_port,
+        pool_acquire_timeout=args.pool_acquire_timeout,
+        pool_max_waiting=args.pool_max_waiting,
+        max_handlers=args.max_handlers,
+        request_timeout=args.request_timeout,
+        hedge_budget=args.hedge_budget,
+        tcp_idle_timeout=args.tcp_idle_timeout,
+        udp_batch_size=args.udp_batch_size,
+        cache_stale_ttl=args.cache_stale_ttl,
+        cache_prefetch=args.cache_prefetch,
+        cache_snapshot=args.cache_snapshot,
+        cache_snapshot_interval=args.cache_snapshot_interval,
+        cache_shared=args.cache_shared,
+        cache_slot_size=args.cache_slot_size,
+        blocklists=args.blocklists,
+        blocklist_mode=args.blocklist_mode,
+        blocklist_ttl=args.blocklist_ttl,
+        blocklist_interval=args.blocklist_interval,
+        circuit_failures=args.circuit_failures,
+        circuit_error_rate=args.circuit_error_rate,
+        circuit_backoff=args.circuit_backoff,
+        circuit_max_backoff=args.circuit_max_backoff
     )
     proxy.start()
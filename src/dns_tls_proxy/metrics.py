@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+"""
+metrics module
+"""
+
+import re
+import logging
+
+from gevent.pywsgi import WSGIServer
+from .histogram import UNITS_PER_SECOND
+from .selection import address_name
+from .circuit_breaker import STATE_NAMES
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+METRICS_PATH = '/metrics'
+PREFIX = 'dns_tls_proxy'
+# Upper bounds in seconds of the exported histogram buckets
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0)
+# Exported name and label of the latency histograms of every group
+HISTOGRAMS = (
+    ('listener', 'request_duration_seconds', 'listener',
+     'Time to answer client requests'),
+    ('upstream', 'upstream_rtt_seconds', 'upstream',
+     'Round-trip time of queries to the nameservers'),
+    ('rcode', 'response_duration_seconds', 'rcode',
+     'Time to answer client requests by response code'),
+    ('stage', 'stage_duration_seconds', 'stage',
+     'Time spent in every stage of the requests'),
+)
+METRIC_NAME = re.compile(r'^[a-z_][a-z0-9_]*$')
+
+
+def escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+class Metrics:
+    """
+    Render the stats in the Prometheus text exposition format
+
+    Metrics are read straight from the Stats store and the registered
+    sources when scraped, so the request path does not pay for them.
+
+    :param stats: Stats object of this process
+    """
+
+    def __init__(self, stats):
+        self.log = logging.getLogger(__name__)
+        self.stats = stats
+
+    def render(self):
+        lines = list()
+
+        def metric(name, kind, help_text, samples):
+            name = '{}_{}'.format(PREFIX, name)
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for labels, value, suffix in samples:
+                label_text = ','.join('{}="{}"'.format(k, escape(v)) for k, v in labels)
+                lines.append('{}{}{} {}'.format(
+                    name, suffix, '{' + label_text + '}' if label_text else '', value))
+
+        listeners = self.stats.listeners
+        metric('requests_total', 'counter', 'Requests answered',
+               [((('listener', k),), v.count, '') for k, v in listeners.items()])
+        metric('retries_total', 'counter', 'Requests retried with another connection',
+               [((('listener', k),), v.retries, '') for k, v in listeners.items()])
+        metric('servfails_total', 'counter', 'SERVFAIL replies generated by the proxy',
+               [((('listener', k),), v.servfails, '') for k, v in listeners.items()])
+        metric('shed_total', 'counter', 'Requests shed because of overload',
+               [((('listener', k),), v.shed, '') for k, v in listeners.items()])
+        metric('responses_total', 'counter', 'Replies sent by response code',
+               [((('rcode', k),), v, '') for k, v in sorted(self.stats.rcodes.items())])
+
+        pool = self.stats.sources.get('pool')
+        if pool is not None:
+            upstreams = [(address_name(x.address), x) for x in pool.upstreams]
+            metric('circuit_state', 'gauge',
+                   'State of the circuit breaker of the nameserver: 0 closed, 1 half-open, 2 open',
+                   [((('upstream', n),), x.breaker.state, '') for n, x in upstreams])
+            metric('circuit_transitions_total', 'counter',
+                   'Transitions of the circuit breaker of the nameserver to every state',
+                   [((('upstream', n), ('state', state)), x.breaker.transitions[i], '')
+                    for n, x in upstreams for i, state in enumerate(STATE_NAMES)])
+            metric('pool_in_use', 'gauge', 'Connections to the nameserver in use',
+                   [((('upstream', n),), x.in_use, '') for n, x in upstreams])
+            metric('pool_idle', 'gauge', 'Idle connections to the nameserver',
+                   [((('upstream', n),), x.idle.qsize(), '') for n, x in upstreams])
+            metric('pool_waiting', 'gauge', 'Requests waiting for a connection',
+                   [((('upstream', n),), x.waiting, '') for n, x in upstreams])
+            metric('pool_shed_total', 'counter', 'Requests shed waiting for a connection',
+                   [((('upstream', n),), x.shed, '') for n, x in upstreams])
+
+        for group, name, label, help_text in HISTOGRAMS:
+            samples = list()
+            for key, histogram in sorted(self.stats.histogram_totals(group).items()):
+                counts = histogram.cumulative(BUCKETS)
+                for bound, count in zip(BUCKETS, counts):
+                    samples.append((((label, key), ('le', bound)), count, '_bucket'))
+                samples.append((((label, key), ('le', '+Inf')), histogram.count, '_bucket'))
+                samples.append((((label, key),), histogram.total / UNITS_PER_SECOND, '_sum'))
+                samples.append((((label, key),), histogram.count, '_count'))
+            metric(name, 'histogram', help_text, samples)
+
+        # Other numeric values reported by the sources, like the cache hits
+        for source_name, source in sorted(self.stats.sources.items()):
+            for key, value in source.stats().items():
+                name = '{}_{}'.format(source_name, key)
+                if isinstance(value, (int, float)) and METRIC_NAME.match(name):
+                    metric(name, 'untyped', '{} {}'.format(source_name, key),
+                           [((), value, '')])
+
+        return '\n'.join(lines) + '\n'
+
+    def application(self, environ, start_response):
+        if environ.get('PATH_INFO') != METRICS_PATH:
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return [b'Not Found\n']
+        try:
+            body = self.render().encode()
+        except Exception as exc:
+            self.log.error('Unable to render metrics: %s', exc)
+            start_response('500 Internal Server Error', [('Content-Type', 'text/plain')])
+            return [b'Internal Server Error\n']
+        start_response('200 OK', [('Content-Type', CONTENT_TYPE)])
+        return [body]
+
+
+class MetricsServer(WSGIServer):
+    """
+    HTTP server exposing the metrics of the proxy for Prometheus
+
+    :param listener: Address to listen on
+    :param stats: Stats object of this process
+    """
+
+    def __init__(self, listener, stats):
+        self.metrics = Metrics(stats)
+        super().__init__(listener, self.metrics.application, log=None)
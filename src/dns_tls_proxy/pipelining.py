@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+
+"""
+pipelining module
+"""
+
+import logging
+import struct
+from collections import defaultdict
+from random import randint
+
+import gevent
+from gevent import event
+from gevent import time
+from gevent import lock
+from gevent import socket
+from .tcp_dns import TCPDNS
+from .connection_pool import PoolExhausted
+from .deadline import Deadline, DeadlineExceeded
+
+
+PIPELINE_QUERY_TIMEOUT = 5.0
+PIPELINE_MAX_PENDING = 100
+# Connections with queries pending but no replies for this long are broken
+PIPELINE_READ_TIMEOUT = 60.0
+MAX_MESSAGE_ID = 0xFFFF
+MESSAGE_ID = struct.Struct('!H')
+
+
+class PipelinedConnection:
+    """
+    Multiplex many DNS queries over a single upstream connection following
+    RFC 7766: queries are written back to back and replies may arrive out of
+    order. A reader greenlet matches every reply to its waiting request by
+    DNS message ID.
+
+    The ID of every query is rewritten to one which is unique on this
+    connection, so clients using colliding IDs can share it safely. Queries
+    sent while the connection is busy writing are batched in a single write,
+    which may take until the latest deadline of them.
+
+    A connection without replies is only broken when queries have been
+    pending for PIPELINE_READ_TIMEOUT, the reader goes back to waiting
+    whenever all of them time out.
+    """
+
+    def __init__(self, sock, conn_pool, timeout=PIPELINE_QUERY_TIMEOUT):
+        """
+        Construct a new 'PipelinedConnection' object
+
+        :param sock: Connected socket to the nameserver, taken from conn_pool
+        :param conn_pool: Pool tracking the queries, where the socket is
+                          released once it is broken
+        :param timeout: Seconds to wait for the reply to a query
+        :return: returns nothing
+        """
+        self.log = logging.getLogger(__name__)
+        self.sock = sock
+        self.tcp_dns = TCPDNS(sock)
+        self.timeout = timeout
+        self.closed = False
+        self._conn_pool = conn_pool
+        self._pending = dict()
+        self._next_id = randint(0, MAX_MESSAGE_ID)
+        self._write_lock = lock.Semaphore(1)
+        self._outgoing = list()
+        self._outgoing_deadline = None
+        self._queued = 0
+        self._written = 0
+        self._has_pending = event.Event()
+        self._reader = gevent.spawn(self._read_loop)
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    def _allocate_id(self):
+        if len(self._pending) > MAX_MESSAGE_ID:
+            raise OSError('No free message IDs on sock #%s' % self.sock.fileno())
+        msg_id = self._next_id
+        while msg_id in self._pending:
+            msg_id = (msg_id + 1) & MAX_MESSAGE_ID
+        self._next_id = (msg_id + 1) & MAX_MESSAGE_ID
+        return msg_id
+
+    def query(self, msg, deadline=None):
+        """
+        Send a DNS query through the connection and wait for its reply
+
+        :param msg: The DNS query in wire format
+        :param deadline: Deadline to get the reply, it caps the timeout
+        :return: The DNS reply, with the original message ID of the query
+        """
+        if self.closed:
+            raise OSError('Pipelined connection is closed')
+
+        orig_id = msg[:2]
+        msg_id = self._allocate_id()
+        result = event.AsyncResult()
+        self._pending[msg_id] = result
+        self._has_pending.set()
+
+        query = bytearray(msg)
+        MESSAGE_ID.pack_into(query, 0, msg_id)
+
+        rtt = None
+        cancelled = False
+        generation = self._conn_pool.start_query(self.sock.address)
+        query_ts = time.time()
+        try:
+            self._write(query, deadline)
+            timeout = deadline.timeout(self.timeout) if deadline is not None else self.timeout
+            reply = result.get(timeout=timeout)
+            rtt = time.time() - query_ts
+        except gevent.Timeout:
+            raise OSError('Timeout waiting for reply #%s on sock #%s'
+                          % (msg_id, self.sock.fileno()))
+        except gevent.GreenletExit:
+            cancelled = True
+            raise
+        except Exception as exc:
+            self.close(exc)
+            raise
+        finally:
+            self._pending.pop(msg_id, None)
+            self._conn_pool.finish_query(self.sock.address, rtt, cancelled, generation)
+
+        return orig_id + reply[2:]
+
+    def _write(self, query, deadline):
+        """
+        Queue a query and write it. Queries queued while another greenlet is
+        writing are written together by the next one, with a single write
+        bounded by the latest of their deadlines, so a query running out of
+        time does not break the connection for the others.
+        """
+        if deadline is None:
+            deadline = Deadline(self.timeout)
+        self._outgoing.append(query)
+        if self._outgoing_deadline is None \
+                or deadline.expires_at > self._outgoing_deadline.expires_at:
+            self._outgoing_deadline = deadline
+        self._queued += 1
+        position = self._queued
+        with self._write_lock:
+            if self._written >= position:
+                # Already written along with the queries of another greenlet
+                return
+            if self.closed:
+                raise OSError('Pipelined connection is closed')
+            queries, deadline = self._outgoing, self._outgoing_deadline
+            self._outgoing, self._outgoing_deadline = list(), None
+            try:
+                self.tcp_dns.send_many(queries, deadline=deadline)
+            except gevent.GreenletExit:
+                # Cancelled, e.g. a hedged query, with a partial message or
+                # the queries of other greenlets left unwritten
+                self.close('query cancelled while writing')
+                raise
+            self._written += len(queries)
+
+    def _read_loop(self):
+        # Time since when queries are pending without any reply
+        waiting_ts = time.time()
+        while not self.closed:
+            if not self._pending:
+                self._has_pending.clear()
+                self._has_pending.wait()
+                waiting_ts = time.time()
+                continue
+
+            try:
+                reply = self.tcp_dns.recv_view(deadline=Deadline(self.timeout))
+            except (DeadlineExceeded, socket.timeout) as exc:
+                # A partial reply stays buffered for the next read, and the
+                # queries time out on their own, so only fail them all once
+                # they keep going unanswered
+                if self._pending and time.time() - waiting_ts >= PIPELINE_READ_TIMEOUT:
+                    self.log.info('No replies on pipelined sock #%s for %.0fs',
+                                  self.sock.fileno(), time.time() - waiting_ts)
+                    self.close(exc)
+                    return
+                continue
+            except Exception as exc:
+                self.log.info('Error reading from pipelined sock #%s: %s',
+                              self.sock.fileno(), exc)
+                self.close(exc)
+                return
+
+            waiting_ts = time.time()
+            if len(reply) < 2:
+                self.log.warning('Received too short reply on sock #%s',
+                                 self.sock.fileno())
+                continue
+
+            msg_id, = MESSAGE_ID.unpack_from(reply)
+            result = self._pending.pop(msg_id, None)
+            if result is None:
+                self.log.info('Discarding unexpected reply #%s on sock #%s',
+                              msg_id, self.sock.fileno())
+                continue
+            # Copy the reply out of the read buffer before reading the next
+            result.set(bytes(reply))
+
+    def close(self, exc=None):
+        """
+        Mark the connection as broken and fail every pending query
+        """
+        if self.closed:
+            return
+        self.closed = True
+        error = OSError('Pipelined connection broken: %s' % exc)
+        for result in self._pending.values():
+            result.set_exception(error)
+        self._pending.clear()
+        self._has_pending.set()
+        self._conn_pool.release_socket(self.sock)
+
+
+class PipelinedConnectionPool:
+    """
+    Pipelined connections on top of a connection pool
+
+    The nameserver is selected first by the policy of the underlying pool,
+    then the least loaded connection to it is used. Connections are taken
+    from the underlying pool and kept for as long as they work. New
+    connections to a nameserver are only opened when every existing one
+    already has PIPELINE_MAX_PENDING queries in flight. Once the pool is
+    full and every connection is that busy, PoolExhausted is raised.
+
+    :param conn_pool: TCPConnectionPool used to open the connections
+    :param max_pending: in-flight queries per connection before opening another
+    """
+
+    pipelining = True
+
+    def __init__(self, conn_pool, max_pending=PIPELINE_MAX_PENDING):
+        self.log = logging.getLogger(__name__)
+        self.conn_pool = conn_pool
+        self.size = conn_pool.size
+        self.max_pending = max_pending
+        self._connections = defaultdict(list)
+        self._connect_locks = defaultdict(lambda: lock.Semaphore(1))
+
+    def _least_loaded(self, address):
+        connections = [x for x in self._connections[address] if not x.closed]
+        self._connections[address] = connections
+        if not connections:
+            return None
+        conn = min(connections, key=lambda x: x.pending)
+        if conn.pending < self.max_pending:
+            return conn
+        if len(connections) >= self.size:
+            self.conn_pool.count_shed(address)
+            raise PoolExhausted('All pipelined connections to %s:%s are busy' % address[:2])
+        return None
+
+    def get_connection(self, deadline=None, address=None):
+        """ get the least loaded connection to the selected nameserver,
+            opening a new one if all of them are busy and its pool is not
+            full yet. PoolExhausted is raised when the request must be shed.
+
+        :param deadline: Deadline of the request to open a new connection
+        :param address: nameserver to use, selected by the policy if not given
+        """
+        if address is None:
+            address = self.conn_pool.get_address(prefer_free=False)
+        conn = self._least_loaded(address)
+        if conn is not None:
+            return conn
+
+        with self._connect_locks[address]:
+            # Another greenlet may have opened a connection meanwhile
+            conn = self._least_loaded(address)
+            if conn is not None:
+                return conn
+
+            sock = self.conn_pool.get_socket(address, deadline)
+            self.log.debug('Opening pipelined connection on sock #%s', sock.fileno())
+            conn = PipelinedConnection(sock, self.conn_pool)
+            self._connections[address].append(conn)
+            return conn
+
+    def query(self, msg, deadline=None):
+        return self.get_connection(deadline).query(msg, deadline)
+
+    def get_address(self, prefer_free=False, exclude=()):
+        return self.conn_pool.get_address(prefer_free, exclude)
+
+    def query_timeout(self, address):
+        return self.conn_pool.query_timeout(address)
+
+    def hedge_delay(self, address):
+        return self.conn_pool.hedge_delay(address)
+
+    def stats(self):
+        return self.conn_pool.stats()
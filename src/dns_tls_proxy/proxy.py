@@ -9,10 +9,31 @@ import logging
 import gevent
 from gevent import signal
 
-from .gevent_tcp import ServerTCP
-from .gevent_udp import ServerUDP
-from .connection_pool import TLSConnectionPool
+from .gevent_tcp import ServerTCP, DEFAULT_TCP_IDLE_TIMEOUT
+from .gevent_udp import ServerUDP, BatchedServerUDP
+from .connection_pool import (
+    TLSConnectionPool, DEFAULT_HEALTH_CHECK_INTERVAL, DEFAULT_ACQUIRE_TIMEOUT,
+    DEFAULT_MAX_WAITING
+)
+from .pipelining import PipelinedConnectionPool
+from .cache import ResponseCache, DEFAULT_CACHE_MAX_BYTES
+from .shared_cache import SharedResponseCache, DEFAULT_SLOT_SIZE
+from .inflight import InflightTable
+from .hedging import HedgeBudget
+from .blocklist import Blocklist, DEFAULT_BLOCKLIST_INTERVAL, DEFAULT_BLOCKED_TTL
+from .snapshot import DEFAULT_SNAPSHOT_INTERVAL
 from .stats import Stats
+from .metrics import MetricsServer
+from .supervisor import Supervisor
+from .selection import POLICIES
+from .deadline import DEFAULT_REQUEST_TIMEOUT
+from .circuit_breaker import (
+    DEFAULT_FAILURE_THRESHOLD, DEFAULT_ERROR_RATE, DEFAULT_BACKOFF,
+    DEFAULT_MAX_BACKOFF
+)
+
+
+DEFAULT_MAX_HANDLERS = 1000
 
 
 class Proxy:
@@ -22,12 +43,91 @@ class Proxy:
     """
 
     def __init__(self, nameservers, port=53, tcp=True, udp=False, stats=False,
-                 pool_size=5):
+                 pool_size=5, pipelining=False, cache_size=0,
+                 cache_max_bytes=DEFAULT_CACHE_MAX_BYTES, workers=1,
+                 strict=False, policy='random', pool_min_idle=0,
+                 pool_max_idle=None,
+                 health_check_interval=DEFAULT_HEALTH_CHECK_INTERVAL,
+                 tls_min_version='1.2', cafile=None, metrics_port=None,
+                 pool_acquire_timeout=DEFAULT_ACQUIRE_TIMEOUT,
+                 pool_max_waiting=DEFAULT_MAX_WAITING,
+                 max_handlers=DEFAULT_MAX_HANDLERS,
+                 request_timeout=DEFAULT_REQUEST_TIMEOUT, hedge_budget=0,
+                 tcp_idle_timeout=DEFAULT_TCP_IDLE_TIMEOUT, udp_batch_size=0,
+                 cache_stale_ttl=0, cache_prefetch=0, cache_snapshot=None,
+                 cache_snapshot_interval=DEFAULT_SNAPSHOT_INTERVAL,
+                 cache_shared=False, cache_slot_size=DEFAULT_SLOT_SIZE,
+                 blocklists=None, blocklist_mode='nxdomain',
+                 blocklist_ttl=DEFAULT_BLOCKED_TTL,
+                 blocklist_interval=DEFAULT_BLOCKLIST_INTERVAL,
+                 circuit_failures=DEFAULT_FAILURE_THRESHOLD,
+                 circuit_error_rate=DEFAULT_ERROR_RATE,
+                 circuit_backoff=DEFAULT_BACKOFF,
+                 circuit_max_backoff=DEFAULT_MAX_BACKOFF):
         """
         Construct a new 'Proxy' object
 
         :param nameservers: List of nameserver to forward DNS-over-TLS queries
         :param port: Listen on this port
+        :param pipelining: Multiplex queries over the nameserver connections
+        :param cache_size: Number of cached replies, 0 disables the cache
+        :param cache_max_bytes: Maximum memory used by cached replies
+        :param cache_stale_ttl: Seconds expired replies are kept to answer
+                                when the nameservers fail, 0 disables it
+        :param cache_prefetch: Fraction of the TTL after which cached replies
+                               still queried are refreshed, 0 disables it
+        :param cache_snapshot: File to save the cached replies to, and
+                               restore them from after a restart. Every
+                               worker process uses its own file, unless the
+                               cache is shared.
+        :param cache_snapshot_interval: Seconds between snapshots of the
+                                        cache, 0 only saves it at shutdown
+        :param cache_shared: Keep the cache in shared memory, used by all the
+                             worker processes
+        :param cache_slot_size: Bytes of every entry of the shared cache,
+                                bigger replies are not cached
+        :param blocklists: Files of names to block or override, answered
+                           without querying the nameservers
+        :param blocklist_mode: Reply to blocked names, 'nxdomain' or 'zero'
+        :param blocklist_ttl: TTL of the replies to blocked names
+        :param blocklist_interval: Seconds between checks for changes of the
+                                   blocklists, 0 disables reloading them
+        :param circuit_failures: Consecutive failures of a nameserver which
+                                 open its circuit
+        :param circuit_error_rate: Fraction of failed recent queries to a
+                                   nameserver which opens its circuit
+        :param circuit_backoff: Seconds the circuit of a nameserver stays
+                                open the first time, doubled every time the
+                                probe fails
+        :param circuit_max_backoff: Maximum seconds the circuit of a
+                                    nameserver stays open
+        :param workers: Number of worker processes sharing the port
+        :param strict: Fully parse every DNS message with dnspython
+        :param policy: Name of the policy to select among the nameservers
+        :param pool_min_idle: Idle connections kept open to each nameserver
+        :param pool_max_idle: Maximum idle connections to each nameserver
+        :param health_check_interval: Seconds between checks of idle
+                                      connections, 0 disables them
+        :param tls_min_version: Minimum TLS version to use with nameservers
+        :param cafile: CA certificates to verify the nameservers instead of
+                       the system store
+        :param metrics_port: Port of the Prometheus metrics endpoint, every
+                             worker process uses the next one
+        :param pool_acquire_timeout: Seconds to wait for a free connection to
+                                     a nameserver before shedding the request
+        :param pool_max_waiting: Requests waiting for a connection to each
+                                 nameserver before shedding new ones
+        :param max_handlers: Requests handled at once by every listener,
+                             new ones are refused above it
+        :param request_timeout: Seconds to answer every request, including
+                                retries
+        :param hedge_budget: Percentage of extra queries allowed to hedge
+                             slow ones to another nameserver, 0 disables
+                             hedging
+        :param tcp_idle_timeout: Seconds without queries before closing a
+                                 client TCP connection
+        :param udp_batch_size: Datagrams read at once by the batched UDP
+                               listener, 0 to use the default UDP listener
         :return: returns nothing
         """
         self.log = logging.getLogger(__name__)
@@ -40,23 +140,160 @@ class Proxy:
         self.udp = udp
         self.servers = []
         self.pool_size = pool_size
+        self.pool_min_idle = pool_min_idle
+        self.pool_max_idle = pool_max_idle
+        self.pool_acquire_timeout = pool_acquire_timeout
+        self.pool_max_waiting = pool_max_waiting
+        self.max_handlers = max_handlers
+        self.request_timeout = request_timeout
+        self.tcp_idle_timeout = tcp_idle_timeout
+        self.udp_batch_size = udp_batch_size
+        self.health_check_interval = health_check_interval
+        self.tls_min_version = tls_min_version
+        self.cafile = cafile
+        self.pipelining = pipelining
+        self.workers = workers
+        self.strict = strict
+        self.policy = policy
+        self.metrics_port = metrics_port
+        self.breaker_options = {
+            'failure_threshold': circuit_failures,
+            'error_rate': circuit_error_rate,
+            'backoff': circuit_backoff,
+            'max_backoff': circuit_max_backoff,
+        }
         self.stats = Stats() if stats else False
+        self.inflight = InflightTable()
+        if self.stats:
+            self.stats.register('inflight', self.inflight)
+        self.hedging = None
+        if hedge_budget > 0:
+            self.log.info('Hedging slow queries with up to %s%% extra queries', hedge_budget)
+            self.hedging = HedgeBudget(hedge_budget / 100)
+            if self.stats:
+                self.stats.register('hedging', self.hedging)
+        self.blocklist = None
+        if blocklists:
+            self.log.info('Using blocklists: %s', blocklists)
+            self.blocklist = Blocklist(
+                blocklists,
+                mode=blocklist_mode,
+                ttl=blocklist_ttl,
+                interval=blocklist_interval
+            )
+            if self.stats:
+                self.stats.register('blocklist', self.blocklist)
+        self.cache = None
+        self.cache_shared = cache_shared
+        if cache_size > 0 and cache_shared:
+            self.log.info('Using shared cache of %i entries of %i bytes',
+                          cache_size, cache_slot_size)
+            self.cache = SharedResponseCache(
+                cache_size,
+                cache_slot_size,
+                stale_ttl=cache_stale_ttl,
+                prefetch=cache_prefetch
+            )
+        elif cache_size > 0:
+            self.log.info('Using cache of %i entries', cache_size)
+            self.cache = ResponseCache(
+                cache_size,
+                cache_max_bytes,
+                stale_ttl=cache_stale_ttl,
+                prefetch=cache_prefetch
+            )
+        if self.cache is not None and self.stats:
+            self.stats.register('cache', self.cache)
+        self.cache_snapshot = cache_snapshot if self.cache is not None else None
+        self.cache_snapshot_interval = cache_snapshot_interval
+        self.cache_snapshot_owner = True
 
     def _sig_term(self, signum, frame):
         self.log.warning('Received SIGTERM signal')
         raise SystemExit('Received SIGTERM signal')
 
+    def save_cache(self):
+        """
+        Write the cached replies to the snapshot file
+        :return: returns nothing
+        """
+        try:
+            self.cache.save_snapshot(self.cache_snapshot)
+        except OSError as exc:
+            self.log.error('Unable to save cache snapshot: %s', exc)
+
+    def _save_cache_loop(self):
+        while True:
+            gevent.sleep(self.cache_snapshot_interval)
+            self.save_cache()
+
     def start(self):
         """
         Start the proxy service
         :return: returns nothing
         """
+        if self.workers > 1:
+            self.log.info('Starting %i DNS TLS proxy workers...', self.workers)
+            supervisor = Supervisor(
+                target=self.serve,
+                workers=self.workers,
+                stats=bool(self.stats)
+            )
+            supervisor.run()
+        else:
+            self.serve()
+
+    def serve(self, publish_stats=None, worker=0):
+        """
+        Run the proxy service in this process
+
+        :param publish_stats: Function to hand the stats to a supervisor
+                              process instead of logging them
+        :param worker: Index of the worker process
+        :return: returns nothing
+        """
         self.log.info('Starting DNS TLS proxy service...')
+        reuse_port = publish_stats is not None
+        if self.stats:
+            self.stats.publish = publish_stats
+
+        if self.cache_snapshot:
+            if self.cache_shared:
+                # The first worker saves the cache shared by all of them
+                self.cache_snapshot_owner = worker == 0
+            elif publish_stats is not None:
+                self.cache_snapshot = '{}.{}'.format(self.cache_snapshot, worker)
+            self.cache.load_snapshot(self.cache_snapshot)
+            if self.cache_snapshot_owner and self.cache_snapshot_interval > 0:
+                gevent.spawn(self._save_cache_loop)
+
+        self.log.info('Using %s nameserver selection policy', self.policy)
+        policy = POLICIES[self.policy]()
+        if self.stats:
+            self.stats.register('upstreams', policy)
 
         self.conn_pool = TLSConnectionPool(
             addresses=self.nameservers,
-            size=self.pool_size
+            size=self.pool_size,
+            policy=policy,
+            min_idle=self.pool_min_idle,
+            max_idle=self.pool_max_idle,
+            health_check_interval=self.health_check_interval,
+            acquire_timeout=self.pool_acquire_timeout,
+            max_waiting=self.pool_max_waiting,
+            tls_min_version=self.tls_min_version,
+            cafile=self.cafile,
+            breaker_options=self.breaker_options
         )
+        self.conn_pool.start()
+        if self.stats:
+            self.stats.register('pool', self.conn_pool)
+        if self.pipelining:
+            self.log.info('Using pipelined connections to nameservers')
+            self.conn_pool = PipelinedConnectionPool(self.conn_pool)
+
+        if self.blocklist is not None:
+            self.blocklist.start()
 
         signal.signal(signal.SIGTERM, self._sig_term)
 
@@ -68,16 +305,63 @@ class Proxy:
                     server = ServerTCP(
                         listener=':{}'.format(self.port),
                         conn_pool=self.conn_pool,
-                        stats_queue=self.stats.queue() if self.stats else None
+                        stats=self.stats or None,
+                        cache=self.cache,
+                        inflight=self.inflight,
+                        reuse_port=reuse_port,
+                        strict=self.strict,
+                        max_handlers=self.max_handlers,
+                        timeout=self.request_timeout,
+                        hedging=self.hedging,
+                        idle_timeout=self.tcp_idle_timeout,
+                        blocklist=self.blocklist
                     )
                     self.servers.append(server)
                     server.start()
-                if self.udp:
+                if self.udp and self.udp_batch_size > 0:
+                    self.log.info('Starting batched UDP listener on port %i...', self.port)
+                    server = BatchedServerUDP(
+                        listener=':{}'.format(self.port),
+                        conn_pool=self.conn_pool,
+                        stats=self.stats or None,
+                        cache=self.cache,
+                        inflight=self.inflight,
+                        reuse_port=reuse_port,
+                        strict=self.strict,
+                        max_handlers=self.max_handlers,
+                        timeout=self.request_timeout,
+                        hedging=self.hedging,
+                        batch_size=self.udp_batch_size,
+                        blocklist=self.blocklist
+                    )
+                    if self.stats:
+                        self.stats.register('udp_batches', server.batch_stats)
+                    self.servers.append(server)
+                    server.start()
+                elif self.udp:
                     self.log.info('Starting UDP listener on port %i...', self.port)
                     server = ServerUDP(
                         listener=':{}'.format(self.port),
                         conn_pool=self.conn_pool,
-                        stats_queue=self.stats.queue() if self.stats else None
+                        stats=self.stats or None,
+                        cache=self.cache,
+                        inflight=self.inflight,
+                        reuse_port=reuse_port,
+                        strict=self.strict,
+                        max_handlers=self.max_handlers,
+                        timeout=self.request_timeout,
+                        hedging=self.hedging,
+                        blocklist=self.blocklist
+                    )
+                    self.servers.append(server)
+                    server.start()
+
+                if self.metrics_port and self.stats:
+                    metrics_port = self.metrics_port + worker
+                    self.log.info('Starting metrics endpoint on port %i...', metrics_port)
+                    server = MetricsServer(
+                        listener=':{}'.format(metrics_port),
+                        stats=self.stats
                     )
                     self.servers.append(server)
                     server.start()
@@ -87,8 +371,8 @@ class Proxy:
                 sys.exit(1)
 
             if self.stats:
-                self.log.info('Starting stats collector...')
-                gevent.spawn(self.stats.collector())
+                self.log.info('Starting stats reporter...')
+                self.stats.start()
 
             gevent.wait()
 
@@ -103,3 +387,5 @@ class Proxy:
             for server in self.servers:
                 self.log.info('Stoping listener %s...', server)
                 server.stop()
+            if self.cache_snapshot and self.cache_snapshot_owner:
+                self.save_cache()
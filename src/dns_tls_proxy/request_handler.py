@@ -4,12 +4,17 @@
 request_handler module
 """
 
+import copy
 import logging
+import gevent
 from gevent import time
 import dns.message
-import dns.rcode
 from .tcp_dns import TCPDNS
-from .socket_io import SocketIO
+from .connection_pool import PoolExhausted, NoUpstreamAvailable
+from .deadline import Deadline, DEFAULT_REQUEST_TIMEOUT
+from .selection import address_name
+from .stats import STAGES, POOL_WAIT, CONNECT, UPSTREAM_RTT, CLIENT_WRITE
+from . import wire
 
 
 PROXY_REQUEST_TRIES = 3
@@ -17,14 +22,29 @@ PROXY_REQUEST_TRIES = 3
 
 class RequestHandler:
 
-    def __init__(self, address, socket, conn_pool, stats_queue):
+    def __init__(self, address, socket, conn_pool, stats, cache=None,
+                 inflight=None, strict=False, timeout=DEFAULT_REQUEST_TIMEOUT,
+                 hedging=None, blocklist=None):
         self.log = logging.getLogger(__name__)
         self.address = address
         self.socket = socket
         self.conn_pool = conn_pool
+        self.cache = cache
+        self.inflight = inflight
         self.reply = None
-        self.stats_queue = stats_queue
-        self.dns_query = None
+        self.stats = stats
+        self.strict = strict
+        self.timeout = timeout
+        self.hedging = hedging
+        self.blocklist = blocklist
+        self.deadline = None
+        self.request = None
+        self.upstream = None
+        self.timings = [None] * len(STAGES)
+        self.retries = 0
+        self.servfail = False
+        self.shed = False
+        self.unavailable = False
 
     def get_request(self):
         raise NotImplementedError
@@ -32,11 +52,44 @@ class RequestHandler:
     def send_reply(self):
         raise NotImplementedError
 
-    def stats(self):
-        self.stats_queue.put({
-            'listener': self.proto,
-            'response_time': self.end_ts - self.start_ts
-        })
+    def record_stats(self):
+        rcode = None
+        if self.reply is not None and len(self.reply) >= wire.HEADER_LEN:
+            rcode = self.reply[3] & wire.RCODE_MASK
+        self.stats.record(
+            self.proto,
+            self.end_ts - self.start_ts,
+            rcode=rcode,
+            upstream=self.upstream,
+            timings=self.timings,
+            retries=self.retries,
+            servfail=self.servfail,
+            shed=self.shed
+        )
+
+    def add_timing(self, stage, elapsed):
+        """
+        Account the time spent in a stage of the request, adding up the time
+        of all the tries
+        """
+        previous = self.timings[stage]
+        self.timings[stage] = elapsed if previous is None else previous + elapsed
+
+    def track_connection(self, sock, wait_ts):
+        """
+        Account the time spent getting a connection to the nameserver,
+        splitting the wait for the pool from the connection setup when the
+        connection was opened for this request
+
+        :param sock: SocketIO connected to the nameserver
+        :param wait_ts: Time when the request started waiting for it
+        """
+        elapsed = time.time() - wait_ts
+        if sock.connect_time is not None and sock.connected_ts >= wait_ts:
+            self.add_timing(CONNECT, sock.connect_time)
+            elapsed = max(0, elapsed - sock.connect_time)
+        self.add_timing(POOL_WAIT, elapsed)
+        self.upstream = address_name(sock.address)
 
     def parse_dns_message(self, msg):
         try:
@@ -48,108 +101,452 @@ class RequestHandler:
             self.log.info('Original DNS message: %s', msg)
             return False
 
-    def reply_servfail(self):
-        reply = dns.message.Message(self.dns_query.id)
-        reply.set_rcode(dns.rcode.SERVFAIL)
-        self.log.warn('Reply to client with rcode SERVFAIL')
-        return reply.to_wire()
-
-    def proxy_request(self, **options):
-        self.start_ts = time.time()
+    def validate_query(self, msg):
+        """
+        Check the query received from the client is a valid DNS message,
+        working directly on the wire format unless strict validation is on
 
-        request = self.get_request()
-        self.dns_query = self.parse_dns_message(request)
-        if not self.dns_query:
-            return self.reply_servfail()
+        :return: True if the query is valid
+        """
+        if self.strict:
+            return bool(self.parse_dns_message(msg))
+        try:
+            wire.validate_query(msg)
+        except wire.PARSE_ERRORS as exc:
+            self.log.warning('Received bad DNS query: %s', exc)
+            self.log.info('Original DNS message: %s', msg)
+            return False
+        return True
+
+    def validate_reply(self, msg):
+        """
+        Check the reply received from the nameserver is a valid DNS message
+        answering the query, working directly on the wire format unless strict
+        validation is on
+
+        :return: True if the reply is valid
+        """
+        if self.strict:
+            return bool(self.parse_dns_message(msg))
+        try:
+            wire.validate_reply(msg, wire.HEADER.unpack_from(self.request)[0])
+        except wire.PARSE_ERRORS as exc:
+            self.log.warning('Received bad DNS reply: %s', exc)
+            self.log.info('Original DNS message: %s', msg)
+            return False
+        return True
 
-        success = False
-        try_count = 0
-        while not success and try_count < PROXY_REQUEST_TRIES:
-            try_count += 1
+    def reply_servfail(self):
+        self.log.warning('Reply to client with rcode SERVFAIL')
+        self.servfail = True
+        return wire.error_reply(self.request, wire.RCODE_SERVFAIL)
+
+    def shed_request(self, exc, wait_ts):
+        """
+        Give up on the request because the nameserver connections are
+        exhausted, so it is answered at once instead of retried
+        """
+        self.log.info('Shedding request from %s: %s', self.address, exc)
+        self.add_timing(POOL_WAIT, time.time() - wait_ts)
+        self.shed = True
+
+    def no_upstream(self, exc):
+        """
+        Give up on the request because the circuits of all the nameservers
+        are open, so it is answered at once instead of retried
+        """
+        self.log.info('No nameserver available for request from %s: %s', self.address, exc)
+        self.unavailable = True
+
+    def query(self, request, address=None):
+        """
+        Forward the request once to a nameserver
+
+        :param address: Nameserver to query, selected by the policy if not given
+        :return: The reply received from the nameserver, None on errors
+        """
+        if self.conn_pool.pipelining:
+            return self.query_pipelined(request, address)
+        return self.query_pooled(request, address)
+
+    def query_pooled(self, request, address=None):
+        """
+        Forward the request using a dedicated connection from the pool
+
+        :param address: Nameserver to query, selected by the policy if not given
+        :return: The reply received from the nameserver, None on errors
+        """
+        wait_ts = time.time()
+        try:
+            sock = self.conn_pool.get_socket(address, deadline=self.deadline)
+        except PoolExhausted as exc:
+            self.shed_request(exc, wait_ts)
+            return None
+        except NoUpstreamAvailable as exc:
+            self.no_upstream(exc)
+            return None
+        except OSError as exc:
+            self.log.info('Unable to connect to nameserver: %s', exc)
+            return None
+        except Exception as exc:
+            self.log.error('Unexpected error connecting to nameserver: %s', exc)
+            return None
 
-            try:
-                sock = self.conn_pool.get_socket()
-            except OSError as exc:
-                self.log.info('Unable to connect to nameserver, reconnecting...')
-                continue
-            except Exception as exc:
-                self.log.error('Unexpected error connecting to nameserver: %s', exc)
-                continue
+        self.track_connection(sock, wait_ts)
 
-            # Use TCP DNS application protocol
-            tcp_dns = TCPDNS(sock)
+        # Use TCP DNS application protocol
+        tcp_dns = TCPDNS(sock)
+        attempt = self.deadline.limit(self.conn_pool.query_timeout(sock.address))
 
+        rtt = None
+        cancelled = False
+        generation = self.conn_pool.start_query(sock.address)
+        query_ts = time.time()
+        try:
             # Send DNS request to nameserver
             try:
-                tcp_dns.send(request)
+                tcp_dns.send(request, deadline=attempt)
             except OSError as exc:
-                self.log.info('Error sending request to nameserver (connection broken), reconnecting...')
+                self.log.info('Error sending request to nameserver: %s', exc)
                 self.conn_pool.release_socket(sock)
-                continue
+                return None
             except Exception as exc:
                 self.log.error('Unexpected error sending request to nameserver: %s', exc)
                 self.conn_pool.release_socket(sock)
-                continue
+                return None
 
             # Get DNS reply from nameserver
             try:
-                self.reply = tcp_dns.recv()
+                reply = tcp_dns.recv(deadline=attempt)
             except OSError as exc:
-                self.log.info('Error reading reply from nameserver (connection broken), reconnecting...')
+                self.log.info('Error reading reply from nameserver: %s', exc)
                 self.conn_pool.release_socket(sock)
-                continue
+                return None
             except Exception as exc:
                 self.log.error('Unexpected error receiving reply from nameserver: %s', exc)
                 self.conn_pool.release_socket(sock)
-                continue
+                return None
+
+            rtt = time.time() - query_ts
+            self.add_timing(UPSTREAM_RTT, rtt)
+        except gevent.GreenletExit:
+            # Cancelled hedged query, the reply is still due on this connection
+            self.conn_pool.release_socket(sock)
+            cancelled = True
+            raise
+        finally:
+            self.conn_pool.finish_query(sock.address, rtt, cancelled, generation)
+
+        # We are done with the connecton, return it to the pool
+        self.conn_pool.return_socket(sock)
+        return reply
+
+    def query_pipelined(self, request, address=None):
+        """
+        Forward the request through a pipelined connection shared with other
+        requests
+
+        :param address: Nameserver to query, selected by the policy if not given
+        :return: The reply received from the nameserver, None on errors
+        """
+        wait_ts = time.time()
+        try:
+            conn = self.conn_pool.get_connection(self.deadline, address)
+            self.track_connection(conn.sock, wait_ts)
+            attempt = self.deadline.limit(self.conn_pool.query_timeout(conn.sock.address))
+            query_ts = time.time()
+            reply = conn.query(request, attempt)
+            self.add_timing(UPSTREAM_RTT, time.time() - query_ts)
+        except PoolExhausted as exc:
+            self.shed_request(exc, wait_ts)
+            return None
+        except NoUpstreamAvailable as exc:
+            self.no_upstream(exc)
+            return None
+        except OSError as exc:
+            self.log.info('Error forwarding request through pipelined connection: %s', exc)
+            return None
+        except Exception as exc:
+            self.log.error('Unexpected error forwarding request to nameserver: %s', exc)
+            return None
+        return reply
+
+    def attempt(self):
+        """
+        Copy of the handler to send one of the hedged queries of the request,
+        keeping the timings and nameserver of that query apart
+        """
+        attempt = copy.copy(self)
+        attempt.timings = [None] * len(STAGES)
+        attempt.upstream = None
+        attempt.shed = False
+        attempt.unavailable = False
+        return attempt
+
+    def commit(self, attempt, reply):
+        """
+        Account the timings and nameserver of the hedged query whose reply is
+        used, or of the primary one if none replied
+
+        :return: the reply
+        """
+        for stage, elapsed in enumerate(attempt.timings):
+            if elapsed is not None:
+                self.add_timing(stage, elapsed)
+        if attempt.upstream is not None:
+            self.upstream = attempt.upstream
+        # A shed query does not shed the request another query answered
+        if reply is None:
+            self.shed = self.shed or attempt.shed
+            self.unavailable = self.unavailable or attempt.unavailable
+        return reply
+
+    def query_hedged(self, request):
+        """
+        Forward the request to a nameserver and, if it has not replied after
+        its hedge delay, also to another one while the hedge budget allows it.
+        The first valid reply wins and the other query is cancelled. Only the
+        timings of the winning query are accounted.
+
+        :return: The reply received from the nameservers, None on errors
+        """
+        self.hedging.deposit()
+        try:
+            address = self.conn_pool.get_address()
+        except NoUpstreamAvailable as exc:
+            self.no_upstream(exc)
+            return None
+        except Exception as exc:
+            self.log.error('Unable to select a nameserver: %s', exc)
+            return None
 
-            # We are done with the connecton, return it to the pool
-            self.conn_pool.return_socket(sock)
-            success = True
+        primary_attempt = self.attempt()
+        primary = gevent.spawn(primary_attempt.query, request, address)
+        primary.join(timeout=self.conn_pool.hedge_delay(address))
+        if primary.ready():
+            return self.commit(primary_attempt, primary.value)
 
-        if not success:
-            self.log.error('Unable to forward request to any nameserver after %s tries', try_count)
-            self.reply = self.reply_servfail()
+        try:
+            hedge_address = self.conn_pool.get_address(exclude=(address,))
+        except Exception:
+            hedge_address = None
+        if hedge_address is None or not self.hedging.withdraw():
+            primary.join()
+            return self.commit(primary_attempt, primary.value)
+
+        self.log.debug('Hedging request from %s to %s', self.address, address_name(hedge_address))
+        hedge_attempt = self.attempt()
+        hedge = gevent.spawn(hedge_attempt.query, request, hedge_address)
+        attempts = {primary: primary_attempt, hedge: hedge_attempt}
+        reply = winner = None
+        try:
+            for greenlet in gevent.iwait(attempts):
+                if greenlet.value is None:
+                    continue
+                if reply is None:
+                    reply, winner = greenlet.value, greenlet
+                if self.validate_reply(greenlet.value):
+                    reply, winner = greenlet.value, greenlet
+                    break
+        finally:
+            gevent.killall(list(attempts))
+
+        if winner is None:
+            # Neither replied, the request is given up if either query was
+            self.shed = hedge_attempt.shed
+            self.unavailable = hedge_attempt.unavailable
+            return self.commit(primary_attempt, None)
+        if winner is hedge:
+            self.hedging.won += 1
+        return self.commit(attempts[winner], reply)
+
+    def request_key(self, request):
+        """
+        Key identifying the query for the cache and the single-flight table
+
+        :return: the key or None if the query can not be shared
+        """
+        if self.cache is None and self.inflight is None:
+            return None
+        try:
+            return wire.question_key(request)
+        except wire.PARSE_ERRORS as exc:
+            self.log.debug('Unable to build key for query: %s', exc)
+            return None
 
-        elif not self.parse_dns_message(self.reply):
+    def proxy_request(self, **options):
+        self.start_ts = time.time()
+        self.deadline = Deadline(self.timeout)
+
+        request = self.request = self.get_request()
+        if not self.validate_query(request):
             self.reply = self.reply_servfail()
+            if self.reply is None:
+                return None
+            return self.finish_request()
+
+        if self.blocklist is not None:
+            self.reply = self.blocklist.reply(request)
+            if self.reply is not None:
+                self.log.debug('Local reply from blocklist for %s', self.address)
+                return self.finish_request()
+
+        key = self.request_key(request)
+
+        if key is not None and self.cache is not None:
+            self.reply = self.cache.get(key, request[:2])
+            if self.reply is not None:
+                self.log.debug('Reply found in cache for %s', self.address)
+                if self.cache.prefetch_due(key):
+                    gevent.spawn(self.prefetch, request, key)
+                return self.finish_request()
+
+        if key is not None and self.inflight is not None:
+            leader, result = self.inflight.join(key)
+            if leader:
+                try:
+                    self.forward_request(request, key)
+                finally:
+                    self.inflight.finish(key, self.reply)
+                return self.finish_request()
+
+            try:
+                reply = result.get(timeout=self.deadline.remaining())
+            except gevent.Timeout:
+                reply = None
+            if reply is not None:
+                self.log.debug('Reusing reply of identical query in flight for %s', self.address)
+                self.reply = request[:2] + reply[2:]
+                return self.finish_request()
+
+        self.forward_request(request, key)
+        return self.finish_request()
+
+    def forward_request(self, request, key=None, stale=True):
+        """
+        Forward the request to the nameservers, retrying on errors while
+        the deadline of the request allows it, and leave the reply to send
+        to the client in self.reply
+
+        :param stale: Answer with a stale reply from the cache on errors
+        :return: True if the reply was stored in the cache
+        """
+        try_count = 0
+        while self.reply is None and not self.shed and not self.unavailable \
+                and try_count < PROXY_REQUEST_TRIES and not self.deadline.expired():
+            try_count += 1
+            if self.hedging is not None:
+                self.reply = self.query_hedged(request)
+            else:
+                self.reply = self.query(request)
+        self.retries += max(0, try_count - 1)
+
+        if self.shed or self.unavailable:
+            self.reply = stale and self.stale_reply(request, key) or self.reply_servfail()
+
+        elif self.reply is None:
+            self.log.error('Unable to forward request to any nameserver after %s tries in %.03fs',
+                           try_count, time.time() - self.start_ts)
+            self.reply = stale and self.stale_reply(request, key) or self.reply_servfail()
+
+        elif not self.validate_reply(self.reply):
+            self.reply = stale and self.stale_reply(request, key) or self.reply_servfail()
+
+        elif self.reply[3] & wire.RCODE_MASK == wire.RCODE_SERVFAIL:
+            self.reply = stale and self.stale_reply(request, key) or self.reply
+
+        elif key is not None and self.cache is not None:
+            return self.cache.put(key, self.reply)
+        return False
+
+    def stale_reply(self, request, key):
+        """
+        Expired reply from the cache to answer with when the nameservers
+        fail, following RFC 8767
+
+        :return: the reply or None if there is none
+        """
+        if key is None or self.cache is None:
+            return None
+        reply = self.cache.get_stale(key, request[:2])
+        if reply is not None:
+            self.log.info('Replying to %s with stale reply from cache', self.address)
+        return reply
+
+    def prefetch(self, request, key):
+        """
+        Refresh a cached reply which is still being queried before it
+        expires, with a handler of its own, so its clients never wait for
+        the nameservers
+        """
+        handler = RequestHandler(
+            address=self.address,
+            socket=None,
+            conn_pool=self.conn_pool,
+            stats=None,
+            cache=self.cache,
+            strict=self.strict,
+            timeout=self.timeout,
+            hedging=self.hedging
+        )
+        handler.start_ts = time.time()
+        handler.deadline = Deadline(self.timeout)
+        handler.request = request
+        self.log.debug('Prefetching reply for %s', self.address)
+        cached = False
+        try:
+            cached = handler.forward_request(request, key, stale=False)
+        except Exception as exc:
+            self.log.error('Unexpected error prefetching reply: %s', exc)
+        if not cached:
+            # Retry on the next hit instead of waiting for the reply to expire
+            self.cache.prefetch_failed(key)
 
+    def finish_request(self):
         # Send DNS reply to client
+        write_ts = time.time()
         result = self.send_reply()
+        self.add_timing(CLIENT_WRITE, time.time() - write_ts)
 
         self.end_ts = time.time()
-        if self.stats_queue:
-            self.stats()
+        if self.stats:
+            self.record_stats()
 
         return result
 
 
 class RequestHandlerTCP(RequestHandler):
 
-    def __init__(self, address, socket, conn_pool, stats_queue):
+    def __init__(self, address, socket, conn_pool, stats, data, tcp_dns,
+                 write_lock, cache=None, inflight=None, strict=False,
+                 timeout=DEFAULT_REQUEST_TIMEOUT, hedging=None, blocklist=None):
         super().__init__(
             address=address,
             socket=socket,
             conn_pool=conn_pool,
-            stats_queue=stats_queue
+            stats=stats,
+            cache=cache,
+            inflight=inflight,
+            strict=strict,
+            timeout=timeout,
+            hedging=hedging,
+            blocklist=blocklist
         )
         self.proto = 'TCP'
+        self.data = data
+        self.tcp_dns = tcp_dns
+        self.write_lock = write_lock
 
     def get_request(self):
-        self.tcp_dns = TCPDNS(self.socket)
-        try:
-            request = self.tcp_dns.recv()
-        except Exception as exc:
-            self.log.error('Error receiving request from client #%s: %s',
-                           self.socket.fileno(), exc)
-            raise
-        else:
-            return request
+        return self.data
 
     def send_reply(self):
         try:
             self.log.info('Sending reply to client %s', self.address)
-            self.tcp_dns.send(self.reply)
+            # Replies to the queries of the connection are written as they
+            # complete, one at a time
+            with self.write_lock:
+                self.tcp_dns.send(self.reply)
         except Exception as exc:
             self.log.error('Error sending reply to client: %s', exc)
             raise
@@ -157,12 +554,20 @@ class RequestHandlerTCP(RequestHandler):
 
 class RequestHandlerUDP(RequestHandler):
 
-    def __init__(self, address, socket, conn_pool, stats_queue, data):
+    def __init__(self, address, socket, conn_pool, stats, data, cache=None,
+                 inflight=None, strict=False, timeout=DEFAULT_REQUEST_TIMEOUT,
+                 hedging=None, blocklist=None):
         super().__init__(
             address=address,
             socket=socket,
             conn_pool=conn_pool,
-            stats_queue=stats_queue
+            stats=stats,
+            cache=cache,
+            inflight=inflight,
+            strict=strict,
+            timeout=timeout,
+            hedging=hedging,
+            blocklist=blocklist
         )
         self.proto = 'UDP'
         self.data = data
@@ -173,8 +578,7 @@ class RequestHandlerUDP(RequestHandler):
     def send_reply(self):
         try:
             self.log.info('Sending reply to client %s', self.address)
-            socketio = SocketIO(self.socket)
-            socketio.sendto(self.reply, self.address)
+            self.socket.sendto(self.reply, self.address)
         except Exception as exc:
             self.log.error('Error sending reply to client: %s', exc)
             raise
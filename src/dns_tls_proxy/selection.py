@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+
+"""
+selection module
+"""
+
+import logging
+from collections import defaultdict
+from itertools import count
+from random import choice, choices, sample
+from .histogram import Histogram
+
+
+EWMA_ALPHA = 0.3
+DEFAULT_WEIGHT = 1
+# Adaptive query timeouts are a multiple of the RTT percentile of the
+# nameserver, measured over the last one or two windows of samples
+TIMEOUT_PERCENTILE = 0.99
+TIMEOUT_FACTOR = 2
+MIN_TIMEOUT = 0.2
+TIMEOUT_MIN_SAMPLES = 20
+TIMEOUT_UPDATE_SAMPLES = 50
+RTT_WINDOW = 1000
+# Hedged queries are sent once a query takes longer than this percentile
+HEDGE_PERCENTILE = 0.95
+
+
+def address_name(address):
+    return '{}:{}'.format(address[0], address[1])
+
+
+class SelectionPolicy:
+    """
+    Base policy to select the nameserver for the next connection or query
+
+    Every query forwarded to a nameserver is tracked by calling start() and
+    then finish() with its round-trip time, so policies can adapt to the
+    measured latency and load of each nameserver. The round-trip times also
+    give the adaptive timeout and hedge delay of the queries to every
+    nameserver.
+    """
+
+    name = None
+
+    def __init__(self):
+        self.log = logging.getLogger(__name__)
+        self.inflight = defaultdict(lambda: 0)
+        self.queries = defaultdict(lambda: 0)
+        self.rtt = dict()
+        self.rtt_windows = dict()
+        self.timeouts = dict()
+        self.hedge_delays = dict()
+
+    def select(self, available):
+        """
+        Select one of the available nameservers
+
+        :param available: List of address tuples with a closed circuit
+        :return: the selected address tuple
+        """
+        raise NotImplementedError
+
+    def start(self, address):
+        self.inflight[address] += 1
+        self.queries[address] += 1
+
+    def finish(self, address, rtt=None):
+        """
+        Track the end of a query
+
+        :param address: Address tuple of the nameserver
+        :param rtt: Round-trip time in seconds, None if the query failed
+        """
+        self.inflight[address] -= 1
+        if rtt is None:
+            return
+        previous = self.rtt.get(address)
+        if previous is None:
+            self.rtt[address] = rtt
+        else:
+            self.rtt[address] = previous + EWMA_ALPHA * (rtt - previous)
+        self._record_rtt(address, rtt)
+
+    def _record_rtt(self, address, rtt):
+        windows = self.rtt_windows.get(address)
+        if windows is None:
+            windows = self.rtt_windows[address] = [Histogram(), Histogram()]
+        current, previous = windows
+        current.record(rtt)
+        if current.count % TIMEOUT_UPDATE_SAMPLES == 0 \
+                or current.count + previous.count == TIMEOUT_MIN_SAMPLES:
+            recent = Histogram()
+            recent.merge(current)
+            recent.merge(previous)
+            self.timeouts[address] = max(
+                MIN_TIMEOUT, TIMEOUT_FACTOR * recent.percentile(TIMEOUT_PERCENTILE))
+            self.hedge_delays[address] = recent.percentile(HEDGE_PERCENTILE)
+        if current.count >= RTT_WINDOW:
+            previous.reset()
+            windows.reverse()
+
+    def backoff(self, address, limit):
+        """
+        Track a failed query to the nameserver, most of the time one which
+        ran out of its timeout: the adaptive timeout is doubled, up to limit,
+        and the recent round-trip times are dropped. So the timeout follows a
+        nameserver which got slower, instead of timing out all its queries
+        until the circuit opens, and grows back to limit while no query
+        succeeds.
+
+        :param address: Address tuple of the nameserver
+        :param limit: Maximum timeout, the default one
+        """
+        timeout = self.timeouts.get(address)
+        if timeout is None:
+            return
+        self.timeouts[address] = min(limit, TIMEOUT_FACTOR * timeout)
+        self.rtt_windows.pop(address, None)
+
+    def query_timeout(self, address, default):
+        """
+        Adaptive timeout of a query to the nameserver, derived from the
+        percentiles of its recent round-trip times
+
+        :param address: Address tuple of the nameserver
+        :param default: Timeout until there are enough measurements, it also
+                        caps the adaptive timeout
+        :return: the timeout in seconds
+        """
+        timeout = self.timeouts.get(address)
+        if timeout is None:
+            return default
+        return min(timeout, default)
+
+    def hedge_delay(self, address):
+        """
+        Time to wait for the reply of the nameserver before hedging the
+        query, the percentile HEDGE_PERCENTILE of its recent round-trip times
+
+        :param address: Address tuple of the nameserver
+        :return: the delay in seconds, None until there are enough measurements
+        """
+        return self.hedge_delays.get(address)
+
+    def stats(self):
+        values = dict()
+        for address in sorted(self.queries):
+            name = address_name(address)
+            values['{} queries'.format(name)] = self.queries[address]
+            values['{} inflight'.format(name)] = self.inflight[address]
+            if address in self.rtt:
+                values['{} rtt_ms'.format(name)] = round(self.rtt[address] * 1000, 2)
+            if address in self.timeouts:
+                values['{} timeout_ms'.format(name)] = round(self.timeouts[address] * 1000, 2)
+            if address in self.hedge_delays:
+                values['{} hedge_ms'.format(name)] = round(self.hedge_delays[address] * 1000, 2)
+        return values
+
+
+class RandomPolicy(SelectionPolicy):
+    """
+    Select a random nameserver
+    """
+
+    name = 'random'
+
+    def select(self, available):
+        return choice(available)
+
+
+class RoundRobinPolicy(SelectionPolicy):
+    """
+    Select the nameservers in turns
+    """
+
+    name = 'round-robin'
+
+    def __init__(self):
+        super().__init__()
+        self._counter = count()
+
+    def select(self, available):
+        return available[next(self._counter) % len(available)]
+
+
+class WeightedPolicy(SelectionPolicy):
+    """
+    Select a random nameserver with probability proportional to its weight,
+    given as the optional fourth element of the address tuple
+    """
+
+    name = 'weighted'
+
+    def select(self, available):
+        weights = [x[3] if len(x) > 3 else DEFAULT_WEIGHT for x in available]
+        return choices(available, weights=weights)[0]
+
+
+class EwmaPolicy(SelectionPolicy):
+    """
+    Power of two choices using the EWMA of the round-trip time weighted by
+    the number of queries in flight: two random nameservers are compared and
+    the one with the lowest expected latency is selected. Nameservers without
+    measurements yet are preferred, so all of them get probed.
+    """
+
+    name = 'ewma'
+
+    def _cost(self, address):
+        rtt = self.rtt.get(address)
+        if rtt is None:
+            return 0
+        return rtt * (self.inflight[address] + 1)
+
+    def select(self, available):
+        if len(available) == 1:
+            return available[0]
+        first, second = sample(available, 2)
+        if self._cost(second) < self._cost(first):
+            return second
+        return first
+
+
+POLICIES = {
+    policy.name: policy
+    for policy in (RandomPolicy, RoundRobinPolicy, WeightedPolicy, EwmaPolicy)
+}
@@ -0,0 +1,433 @@
+# -*- coding: utf-8 -*-
+
+"""
+shared_cache module
+"""
+
+import os
+import mmap
+import struct
+import multiprocessing
+
+from gevent import time
+from .cache import ResponseCache, CacheEntry, MAX_CACHE_TTL, STALE_REPLY_TTL
+from .snapshot import encode_key, decode_key, key_hash
+
+
+DEFAULT_SLOT_SIZE = 1024
+# Slots of every bucket, a new reply replaces the one expiring first
+BUCKET_WAYS = 4
+# Locks shared by the buckets to serialize writers across processes
+LOCK_STRIPES = 64
+# Seconds the lock of a stripe is held before checking if it was left by a
+# worker which died holding it
+STALE_LOCK_TIMEOUT = 1.0
+# Times a read is retried while a writer updates the bucket
+READ_RETRIES = 8
+# Time the lock of a stripe was taken and pid of the process holding it,
+# both 0 while it is free, and the number of times it was taken
+STRIPE = struct.Struct('=dII')
+MAX_TAKEN = 0xFFFFFFFF
+# Sequence number of a bucket, odd while it is being written
+SEQUENCE = struct.Struct('=Q')
+# Key hash, stored, expiry and prefetch times, key length, reply length,
+# number of TTL offsets and prefetching flag. Empty slots have no key.
+SLOT_HEADER = struct.Struct('=QdddHHHBx')
+PREFETCHING_OFFSET = SLOT_HEADER.size - 2
+
+
+def _alive(pid):
+    """
+    Check if the process with a pid is running
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+class SharedResponseCache(ResponseCache):
+    """
+    Cache of DNS replies in a shared memory hash table, so every worker
+    process answers from the replies fetched by any of them
+
+    The table is an anonymous shared memory mapping created before the
+    workers are forked, made of buckets of BUCKET_WAYS fixed-size slots.
+    Writers hold a lock shared by a stripe of buckets and bump the sequence
+    number of the bucket before and after writing, as in a seqlock. Readers
+    take no lock: they copy the bucket and retry if its sequence number was
+    odd or has changed meanwhile. Hits do not take any lock, and writers
+    never wait for one: a write or a prefetch whose stripe is busy is
+    skipped.
+
+    A worker killed while writing leaves the lock of the stripe held and
+    the bucket half written. Writers record their pid when they take the
+    lock, and a lock held for longer than STALE_LOCK_TIMEOUT by a process
+    which is gone is released by the next writer. So is a lock held without
+    owner that long, left by a worker which died right after taking it. A
+    writer finding the sequence number of a bucket odd drops the slots of
+    the bucket before writing.
+
+    Replies which do not fit in a slot, along with their key and TTL
+    offsets, are not cached.
+
+    :param max_entries: Number of slots of the table
+    :param slot_size: Size in bytes of every slot
+    :param max_ttl: Upper bound for the time a reply is cached
+    :param stale_ttl: Seconds expired replies are kept to be served stale,
+                      0 disables serve-stale
+    :param prefetch: Fraction of the TTL after which replies still queried
+                     are refreshed, 0 disables prefetching
+    """
+
+    def __init__(self, max_entries, slot_size=DEFAULT_SLOT_SIZE,
+                 max_ttl=MAX_CACHE_TTL, stale_ttl=0, prefetch=0):
+        super().__init__(max_entries, max_entries * slot_size, max_ttl,
+                         stale_ttl, prefetch)
+        self.slot_size = slot_size - slot_size % 8
+        self.buckets = max(1, -(-max_entries // BUCKET_WAYS))
+        self.bucket_size = SEQUENCE.size + BUCKET_WAYS * self.slot_size
+        self._locks = [multiprocessing.Lock()
+                       for _ in range(min(LOCK_STRIPES, self.buckets))]
+        # Serializes the recoveries of stale locks
+        self._recovery_lock = multiprocessing.Lock()
+        # Stripes seen locked without owner, with the time they were first
+        # seen, by this process
+        self._unowned = dict()
+        self._buckets_base = len(self._locks) * STRIPE.size
+        self.size_bytes = self._buckets_base + self.buckets * self.bucket_size
+        self._map = mmap.mmap(-1, self.size_bytes)
+        self.oversized = 0
+        self.contended = 0
+        self.recovered = 0
+
+    def __len__(self):
+        return sum(1 for _ in self._items())
+
+    def get(self, key, msg_id):
+        """
+        Look up a cached reply
+
+        :param key: Cache key of the query
+        :param msg_id: Message ID of the query, in wire format
+        :return: The reply in wire format or None if not cached
+        """
+        entry = self._find(key)
+        if entry is None:
+            entry = self._restore(key)
+        now = time.time()
+        if entry is None or entry.expires_at <= now:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return entry.reply(msg_id, elapsed=int(now - entry.stored_at))
+
+    def get_stale(self, key, msg_id):
+        """
+        Look up an expired reply to serve when the nameservers fail, with
+        its TTLs set to STALE_REPLY_TTL
+
+        :param key: Cache key of the query
+        :param msg_id: Message ID of the query, in wire format
+        :return: The reply in wire format or None if not cached
+        """
+        entry = self._find(key)
+        if entry is None:
+            entry = self._restore(key)
+        if entry is None or entry.expires_at + self.stale_ttl <= time.time():
+            return None
+
+        self.stale_hits += 1
+        return entry.reply(msg_id, ttl=STALE_REPLY_TTL)
+
+    def prefetch_due(self, key):
+        """
+        Check if a cached reply which has just been served must be refreshed
+        in the background. It is only due once for all the processes, until
+        it is stored again.
+
+        :param key: Cache key of the query
+        :return: True if the caller must refresh the reply
+        """
+        if not self.prefetch:
+            return False
+        data = encode_key(key)
+        digest = key_hash(data)
+        entry = self._find_hashed(data, digest)
+        if entry is None or entry.prefetching or entry.prefetch_at is None \
+                or entry.prefetch_at > time.time():
+            return False
+
+        base = self._bucket(digest)
+        stripe = self._acquire(digest)
+        if stripe is None:
+            return False
+        try:
+            sequence = self._begin_write(base)
+            offset = self._slot(base, digest, data)
+            due = offset is not None and not self._map[offset + PREFETCHING_OFFSET]
+            if due:
+                self._map[offset + PREFETCHING_OFFSET] = 1
+            SEQUENCE.pack_into(self._map, base, sequence)
+        finally:
+            self._release(stripe)
+        if due:
+            self.prefetches += 1
+        return due
+
+    def prefetch_failed(self, key):
+        """
+        Let a reply whose refresh did not store a new one be prefetched
+        again, by any of the processes
+
+        :param key: Cache key of the query
+        """
+        data = encode_key(key)
+        digest = key_hash(data)
+        base = self._bucket(digest)
+        stripe = self._acquire(digest)
+        if stripe is None:
+            return
+        try:
+            sequence = self._begin_write(base)
+            offset = self._slot(base, digest, data)
+            if offset is not None:
+                self._map[offset + PREFETCHING_OFFSET] = 0
+            SEQUENCE.pack_into(self._map, base, sequence)
+        finally:
+            self._release(stripe)
+
+    def _store(self, key, entry):
+        data = encode_key(key)
+        ttl_offsets = struct.pack('={}H'.format(len(entry.ttl_offsets)), *entry.ttl_offsets)
+        if SLOT_HEADER.size + len(data) + len(entry.wire) + len(ttl_offsets) > self.slot_size:
+            self.oversized += 1
+            return False
+
+        digest = key_hash(data)
+        base = self._bucket(digest)
+        stripe = self._acquire(digest)
+        if stripe is None:
+            return False
+        try:
+            sequence = self._begin_write(base)
+            offset = self._slot(base, digest, data)
+            if offset is None:
+                offset = self._victim(base)
+            SLOT_HEADER.pack_into(
+                self._map, offset, digest, entry.stored_at, entry.expires_at,
+                entry.prefetch_at or 0, len(data), len(entry.wire),
+                len(entry.ttl_offsets), 0)
+            offset += SLOT_HEADER.size
+            for chunk in (data, entry.wire, ttl_offsets):
+                self._map[offset:offset + len(chunk)] = chunk
+                offset += len(chunk)
+            SEQUENCE.pack_into(self._map, base, sequence)
+        finally:
+            self._release(stripe)
+        return True
+
+    def _acquire(self, digest):
+        """
+        Take the lock of the stripe of a key without waiting for it, so the
+        event loop is never blocked, recovering it if it was left by a
+        worker which died
+
+        :return: the stripe or None if its lock is busy
+        """
+        stripe = digest % self.buckets % len(self._locks)
+        if not self._locks[stripe].acquire(block=False) and not self._recover(stripe):
+            self.contended += 1
+            return None
+        offset = stripe * STRIPE.size
+        _, _, taken = STRIPE.unpack_from(self._map, offset)
+        STRIPE.pack_into(self._map, offset, time.time(), os.getpid(), (taken + 1) & MAX_TAKEN)
+        return stripe
+
+    def _recover(self, stripe):
+        """
+        Take the busy lock of a stripe if it was left by a worker which died
+
+        The owner is cleared and the times the lock was taken increased
+        before releasing it, and recoveries are serialized, so a lock which
+        is taken again meanwhile is never released.
+
+        :return: True if the lock was recovered and is now held
+        """
+        offset = stripe * STRIPE.size
+        state = STRIPE.unpack_from(self._map, offset)
+        locked_at, owner, taken = state
+        now = time.time()
+        if owner:
+            self._unowned.pop(stripe, None)
+            if now - locked_at < STALE_LOCK_TIMEOUT or _alive(owner):
+                return False
+        else:
+            # Taken by a worker which died before setting itself as owner,
+            # unless it was taken again since it was first seen
+            seen_taken, seen_at = self._unowned.get(stripe, (None, None))
+            if seen_taken != taken:
+                self._unowned[stripe] = (taken, now)
+                return False
+            if now - seen_at < STALE_LOCK_TIMEOUT:
+                return False
+
+        if not self._recovery_lock.acquire(block=False):
+            return False
+        try:
+            if STRIPE.unpack_from(self._map, offset) != state:
+                return False
+            self.log.warning('Releasing shared cache lock left by worker %s', owner or 'unknown')
+            self.recovered += 1
+            self._unowned.pop(stripe, None)
+            STRIPE.pack_into(self._map, offset, 0.0, 0, (taken + 1) & MAX_TAKEN)
+            try:
+                self._locks[stripe].release()
+            except ValueError:
+                # Released by its owner meanwhile
+                pass
+        finally:
+            self._recovery_lock.release()
+        return self._locks[stripe].acquire(block=False)
+
+    def _release(self, stripe):
+        """
+        Release the lock of a stripe taken by this process, unless it was
+        recovered by another one meanwhile
+        """
+        offset = stripe * STRIPE.size
+        _, owner, taken = STRIPE.unpack_from(self._map, offset)
+        if owner != os.getpid():
+            self.log.warning('Shared cache lock was released by another worker')
+            return
+        STRIPE.pack_into(self._map, offset, 0.0, 0, taken)
+        try:
+            self._locks[stripe].release()
+        except ValueError:
+            pass
+
+    def _begin_write(self, base):
+        """
+        Make the sequence number of a bucket odd before writing it, the lock
+        of the bucket must be held
+
+        :return: the sequence number to set once written
+        """
+        sequence, = SEQUENCE.unpack_from(self._map, base)
+        if sequence & 1:
+            # Half written by a worker which died holding the lock
+            self.log.warning('Dropping shared cache bucket left half written')
+            self._map[base + SEQUENCE.size:base + self.bucket_size] = \
+                bytes(self.bucket_size - SEQUENCE.size)
+            sequence += 1
+        SEQUENCE.pack_into(self._map, base, sequence + 1)
+        return sequence + 2
+
+    def _bucket(self, digest):
+        return self._buckets_base + (digest % self.buckets) * self.bucket_size
+
+    def _slot(self, base, digest, data):
+        """
+        Offset of the slot holding a key, the lock of the bucket must be held
+        """
+        for way in range(BUCKET_WAYS):
+            offset = base + SEQUENCE.size + way * self.slot_size
+            slot_hash, _, _, _, key_len, _, _, _ = SLOT_HEADER.unpack_from(self._map, offset)
+            start = offset + SLOT_HEADER.size
+            if key_len and slot_hash == digest and self._map[start:start + key_len] == data:
+                return offset
+        return None
+
+    def _victim(self, base):
+        """
+        Offset of the slot to replace with a new key: an empty one or else
+        the one expiring first. The lock of the bucket must be held.
+        """
+        victim, earliest = None, None
+        for way in range(BUCKET_WAYS):
+            offset = base + SEQUENCE.size + way * self.slot_size
+            _, _, expires_at, _, key_len, _, _, _ = SLOT_HEADER.unpack_from(self._map, offset)
+            if not key_len:
+                return offset
+            if earliest is None or expires_at < earliest:
+                victim, earliest = offset, expires_at
+        if earliest + self.stale_ttl > time.time():
+            self.evictions += 1
+        return victim
+
+    def _read(self, base):
+        """
+        Consistent copy of a bucket, without locking
+
+        :return: the bucket bytes or None if writers kept updating it
+        """
+        snapshot = self._map
+        for _ in range(READ_RETRIES):
+            sequence, = SEQUENCE.unpack_from(snapshot, base)
+            if sequence & 1:
+                continue
+            bucket = snapshot[base:base + self.bucket_size]
+            if SEQUENCE.unpack_from(snapshot, base)[0] == sequence:
+                return bucket
+        self.contended += 1
+        return None
+
+    def _entries_of(self, bucket):
+        """
+        Read the entries of a bucket copy, as tuples (key bytes, hash,
+        CacheEntry)
+        """
+        for way in range(BUCKET_WAYS):
+            offset = SEQUENCE.size + way * self.slot_size
+            slot_hash, stored_at, expires_at, prefetch_at, key_len, reply_len, \
+                ttl_count, prefetching = SLOT_HEADER.unpack_from(bucket, offset)
+            if not key_len:
+                continue
+            start = offset + SLOT_HEADER.size
+            data = bucket[start:start + key_len]
+            start += key_len
+            reply = bucket[start:start + reply_len]
+            start += reply_len
+            ttl_offsets = struct.unpack_from('={}H'.format(ttl_count), bucket, start)
+            entry = CacheEntry(reply, ttl_offsets, stored_at, expires_at, prefetch_at or None)
+            entry.prefetching = bool(prefetching)
+            yield data, slot_hash, entry
+
+    def _find(self, key):
+        data = encode_key(key)
+        return self._find_hashed(data, key_hash(data))
+
+    def _find_hashed(self, data, digest):
+        bucket = self._read(self._bucket(digest))
+        if bucket is None:
+            return None
+        for slot_data, slot_hash, entry in self._entries_of(bucket):
+            if slot_hash == digest and slot_data == data:
+                return entry
+        return None
+
+    def _items(self):
+        for index in range(self.buckets):
+            bucket = self._read(self._buckets_base + index * self.bucket_size)
+            if bucket is None:
+                continue
+            for data, _, entry in self._entries_of(bucket):
+                yield decode_key(data), entry
+
+    def stats(self):
+        # Only counters of this process, which add up across workers
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'stale_hits': self.stale_hits,
+            'prefetches': self.prefetches,
+            'restored': self.restored,
+            'oversized': self.oversized,
+            'contended': self.contended,
+            'recovered': self.recovered,
+        }
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+"""
+snapshot module
+"""
+
+import os
+import mmap
+import struct
+import hashlib
+
+
+DEFAULT_SNAPSHOT_INTERVAL = 300.0
+SNAPSHOT_MAGIC = b'DNSCACHE'
+SNAPSHOT_VERSION = 1
+# Magic, version, number of entries, number of index slots and latest expiry
+FILE_HEADER = struct.Struct('!8sHxxIId')
+# Hash of the key and offset of its entry, 0 for empty slots
+INDEX_SLOT = struct.Struct('!QQ')
+# Stored and expiry times, length of the key and length of the reply
+ENTRY_HEADER = struct.Struct('!ddHH')
+# Fields of the cache key following the qname
+KEY_FIELDS = struct.Struct('!HH??')
+
+
+def encode_key(key):
+    """
+    Serialize a cache key, see wire.question_key
+
+    :param key: tuple (qname, qtype, qclass, DO bit, CD bit)
+    :return: the key in bytes
+    """
+    qname, qtype, qclass, do_bit, cd_bit = key
+    return qname + KEY_FIELDS.pack(qtype, qclass, do_bit, cd_bit)
+
+
+def decode_key(data):
+    """
+    Read a key serialized with encode_key
+    """
+    split = len(data) - KEY_FIELDS.size
+    return (data[:split],) + KEY_FIELDS.unpack_from(data, split)
+
+
+def key_hash(data):
+    """
+    Hash of a serialized key which is stable across processes, unlike hash()
+    """
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'big')
+
+
+def write_snapshot(path, entries):
+    """
+    Write cached replies to a snapshot file
+
+    The file holds a header, an open addressing hash table of the keys and
+    the entries. It is written to a temporary file first and renamed, so a
+    snapshot being read is never modified.
+
+    :param path: Path of the snapshot file
+    :param entries: List of tuples (key, stored at, expires at, reply)
+    :return: returns nothing
+    """
+    slots = 1
+    while slots < 2 * len(entries):
+        slots <<= 1
+    index = bytearray(slots * INDEX_SLOT.size)
+    chunks = [b'', index]
+    offset = FILE_HEADER.size + len(index)
+    latest = 0.0
+
+    for key, stored_at, expires_at, reply in entries:
+        data = encode_key(key)
+        digest = key_hash(data)
+        slot = digest & (slots - 1)
+        while INDEX_SLOT.unpack_from(index, slot * INDEX_SLOT.size)[1]:
+            slot = (slot + 1) & (slots - 1)
+        INDEX_SLOT.pack_into(index, slot * INDEX_SLOT.size, digest, offset)
+        chunks.append(ENTRY_HEADER.pack(stored_at, expires_at, len(data), len(reply)))
+        chunks.append(data)
+        chunks.append(reply)
+        offset += ENTRY_HEADER.size + len(data) + len(reply)
+        latest = max(latest, expires_at)
+
+    chunks[0] = FILE_HEADER.pack(
+        SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(entries), slots, latest)
+    temp_path = '{}.tmp'.format(path)
+    with open(temp_path, 'wb') as fh:
+        fh.writelines(chunks)
+    os.replace(temp_path, path)
+
+
+class Snapshot:
+    """
+    Snapshot of cached replies, memory-mapped to be read lazily
+
+    Opening a snapshot only reads its header, entries are looked up in the
+    hash table of the file when queried, so the startup time does not grow
+    with the size of the snapshot.
+
+    :param path: Path of the snapshot file
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as fh:
+            self._map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, self.count, self.slots, self.expires_at = \
+                FILE_HEADER.unpack_from(self._map)
+            if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+                raise ValueError('Unknown snapshot format')
+            if not self.slots or self.slots & (self.slots - 1) or \
+                    len(self._map) < FILE_HEADER.size + self.slots * INDEX_SLOT.size:
+                raise ValueError('Truncated snapshot')
+        except (ValueError, struct.error):
+            self._map.close()
+            raise
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        """
+        Read every entry of the snapshot, as tuples (key, stored at,
+        expires at, reply)
+        """
+        snapshot = self._map
+        offset = FILE_HEADER.size + self.slots * INDEX_SLOT.size
+        for _ in range(self.count):
+            stored_at, expires_at, key_len, reply_len = \
+                ENTRY_HEADER.unpack_from(snapshot, offset)
+            start = offset + ENTRY_HEADER.size
+            offset = start + key_len + reply_len
+            key = decode_key(snapshot[start:start + key_len])
+            yield key, stored_at, expires_at, snapshot[start + key_len:offset]
+
+    def lookup(self, key):
+        """
+        Find the entry of a key
+
+        :param key: Cache key of the query
+        :return: tuple (stored at, expires at, reply) or None if not found
+        """
+        data = encode_key(key)
+        digest = key_hash(data)
+        snapshot = self._map
+        slot = digest & (self.slots - 1)
+        for _ in range(self.slots):
+            slot_hash, offset = INDEX_SLOT.unpack_from(
+                snapshot, FILE_HEADER.size + slot * INDEX_SLOT.size)
+            if not offset:
+                return None
+            if slot_hash == digest:
+                stored_at, expires_at, key_len, reply_len = \
+                    ENTRY_HEADER.unpack_from(snapshot, offset)
+                start = offset + ENTRY_HEADER.size
+                if snapshot[start:start + key_len] == data:
+                    start += key_len
+                    return stored_at, expires_at, snapshot[start:start + reply_len]
+            slot = (slot + 1) & (self.slots - 1)
+        return None
+
+    def close(self):
+        self._map.close()
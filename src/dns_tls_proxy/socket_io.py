@@ -4,53 +4,129 @@
 Socket_io module
 """
 
+import struct
 import logging
 from gevent import time
+from gevent import socket
 from gevent import ssl
-from gevent.select import select
+from .deadline import Deadline
 
 
+# Initial size of the read buffer of every socket, it grows for bigger messages
 RECV_BUFFER_LEN = 16384
-RECV_READ_TIMEOUT = 500 / 1000
-RECV_TOTAL_TIMEOUT = 5000
-SEND_WRITE_TIMEOUT = 500 / 1000
-SEND_TOTAL_TIMEOUT = 5000
+FRAME_HEADER = struct.Struct('!H')
+RECV_TOTAL_TIMEOUT = 5.0
+SEND_TOTAL_TIMEOUT = 5.0
+# Buffers written with a single sendmsg() call, the usual IOV_MAX
+SENDMSG_MAX_BUFFERS = 1024
 
 
 class SocketIO:
     """
     Use sockets with better send and receive methods
-    Supports non-blocking socket reads also for SSL socks
+
+    Reads go through a buffer preallocated for every socket, filled with
+    recv_into() and handed out as memoryview slices, so reading a message
+    takes few system calls and no intermediate copies. Several buffers can
+    be written at once with scatter/gather writes.
     """
 
-    def __init__(self, sock):
+    def __init__(self, sock, address=None, connect_time=None):
         """
         Construct a new 'SocketIO' object
 
         :param sock: The socket to use for IO
+        :param address: Address tuple of the peer, if known
+        :param connect_time: Seconds it took to connect the socket, including
+                             the TLS handshake, if known
         :return: returns nothing
         """
         self.log = logging.getLogger(__name__)
         self.sock = sock
+        self.address = address
+        self.connect_time = connect_time
+        self.connected_ts = time.time()
+        self._buffer = bytearray(RECV_BUFFER_LEN)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+        self.tls = isinstance(sock, ssl.SSLSocket)
+        self._write_buffer = bytearray()
 
     def fileno(self):
         return self.sock.fileno()
 
-    def send(self, data):
+    def send(self, data, deadline=None):
+        """
+        Write all the data to the socket, continuing with the unsent data
+        after partial writes, and timeout if not able to finish
+
+        :param data: Data to write
+        :param deadline: Deadline to finish writing, SEND_TOTAL_TIMEOUT from
+                         now if not given
         """
-        Write data top the socket
-        Track how much data has been sent and timeout if not able to finish
+        if deadline is None:
+            deadline = Deadline(SEND_TOTAL_TIMEOUT)
+        view = memoryview(data)
+        try:
+            while view:
+                self._set_write_timeout(deadline)
+                view = view[self.sock.send(view):]
+        finally:
+            view.release()
+
+    def send_buffers(self, buffers, deadline=None):
         """
-        length = len(data)
-        total_sent = 0
-        start_time = time.time()
-        while total_sent < length:
+        Write several buffers to the socket as a single stream of data
 
-            if time.time() - start_time > SEND_TOTAL_TIMEOUT:
-                self.log.info('sock #%s write timeout', self.sock.fileno())
-                raise OSError('sock #%s write timeout', self.sock.fileno())
+        Plain sockets write them with sendmsg() without joining them first.
+        TLS sockets do not support it, so the buffers are copied to a write
+        buffer reused for every write, and sent in as few TLS records as
+        possible.
 
-            total_sent += self.sock.send(data)
+        :param buffers: List of bytes-like objects to write
+        :param deadline: Deadline to finish writing, SEND_TOTAL_TIMEOUT from
+                         now if not given
+        """
+        if deadline is None:
+            deadline = Deadline(SEND_TOTAL_TIMEOUT)
+        if len(buffers) == 1:
+            self.send(buffers[0], deadline)
+        elif self.tls:
+            write_buffer = self._write_buffer
+            for buffer in buffers:
+                write_buffer += buffer
+            try:
+                self.send(write_buffer, deadline)
+            finally:
+                del write_buffer[:]
+        else:
+            self._sendmsg(buffers, deadline)
+
+    def _sendmsg(self, buffers, deadline):
+        views = [memoryview(x) for x in buffers]
+        try:
+            while views:
+                self._set_write_timeout(deadline)
+                sent = self.sock.sendmsg(views[:SENDMSG_MAX_BUFFERS])
+                # Drop the buffers fully written and continue with the rest
+                written = 0
+                while written < len(views) and sent >= len(views[written]):
+                    sent -= len(views[written])
+                    views[written].release()
+                    written += 1
+                del views[:written]
+                if sent:
+                    views[0] = views[0][sent:]
+        finally:
+            for view in views:
+                view.release()
+
+    def _set_write_timeout(self, deadline):
+        if deadline.expired():
+            self.log.info('sock #%s write timeout', self.sock.fileno())
+            deadline.check('sock #%s write' % self.sock.fileno())
+        self.sock.settimeout(deadline.remaining())
 
     def sendall(self, data):
         """ No customization here, it just uses the original sendall() method """
@@ -60,71 +136,108 @@ class SocketIO:
         """ No customization here, it just uses the original sendto() method """
         return self.sock.sendto(data, address)
 
-    def recv(self, length=RECV_BUFFER_LEN):
-        """
-        Read data from the socket using non-blocking select() with timeout
+    def close(self):
+        """ No customization here, it just uses the original close() method """
+        return self.sock.close()
 
-        If using SSLsocket, try to read right away in case there is data
-        available in the SSL buffer, use select() if not.
-        This is needed because select() checks the underlying socket and it's
-        probable that it has no more data to be read because it was already
-        passed to the SSL buffer in the SSL wraper socket
+    def recv(self, length, deadline=None):
         """
-        chunks = []
-        total_recv = 0
+        Read exactly length bytes from the socket
 
-        start_time = time.time()
+        :param length: Number of bytes to read
+        :param deadline: Deadline to finish reading, RECV_TOTAL_TIMEOUT from
+                         now if not given
+        :return: The data read
+        """
+        return bytes(self._consume(length, deadline))
 
-        while total_recv < length:
+    def recv_frame(self, deadline=None):
+        """
+        Read a message prefixed with a two byte length field, as used by
+        TCP DNS, without copying it
+
+        :param deadline: Deadline to finish reading, RECV_TOTAL_TIMEOUT from
+                         now if not given
+        :return: memoryview of the message, excluding the length field. It
+                 points into the read buffer, so it is only valid until the
+                 next read from this socket
+        """
+        if deadline is None:
+            deadline = Deadline(RECV_TOTAL_TIMEOUT)
+        self._fill(FRAME_HEADER.size, deadline)
+        length, = FRAME_HEADER.unpack_from(self._buffer, self._start)
+        return self._consume(FRAME_HEADER.size + length, deadline)[FRAME_HEADER.size:]
+
+    def _consume(self, length, deadline):
+        if deadline is None:
+            deadline = Deadline(RECV_TOTAL_TIMEOUT)
+        self._fill(length, deadline)
+        start = self._start
+        view = self._view[start:start + length]
+        self._start = start + length
+        if self._start == self._end:
+            # Nothing buffered, start over at the beginning of the buffer
+            self._start = self._end = 0
+        return view
+
+    def _fill(self, length, deadline):
+        """
+        Read from the socket until at least length bytes are buffered
 
-            if time.time() - start_time > RECV_TOTAL_TIMEOUT:
+        Reads wait on gevent's event loop until the socket is readable, also
+        for SSL sockets when the TLS record is incomplete, and take as much
+        data as fits in the buffer, so replies written back to back by the
+        nameserver are read with a single call.
+        """
+        if self._end - self._start >= length:
+            return
+        if self._start + length > len(self._buffer):
+            self._make_room(length)
+        while self._end - self._start < length:
+            if deadline.expired():
                 self.log.info('sock #%s read timeout', self.sock.fileno())
-                raise OSError('sock #%s read timeout', self.sock.fileno())
-
-            if self.sock.__class__.__name__ == 'SSLSocket':
-                try:
-                    chunk = self.sock.recv(
-                        min(length - total_recv, RECV_BUFFER_LEN))
-                except ssl.SSLWantReadError as exc:
-                    self.log.debug('sock #%s SSL needs more data from TCP sock: %s', exc)
-                    pass
-                else:
-                    self.log.debug('sock #%s received %s bytes of SSL data',
-                                   self.sock.fileno(), len(chunk))
-
-                    if chunk == b'':
-                        self.log.info('sock #%s connection broken',
-                                      self.sock.fileno())
-                        raise OSError('sock #%s connection broken',
-                                      self.sock.fileno())
-
-                    chunks.append(chunk)
-                    total_recv += len(chunk)
-                    continue
-
-            (read, write, error) = select(
-                [self.sock], [], [self.sock], RECV_READ_TIMEOUT)
-
-            if self.sock in read:
-                self.log.debug('sock #%s is ready to read: %s',
-                               self.sock.fileno(), read)
-                chunk = self.sock.recv(
-                    min(length - total_recv, RECV_BUFFER_LEN))
-
-                self.log.debug('sock #%s received %s bytes of data',
-                               self.sock.fileno(), len(chunk))
-
-                if chunk == b'':
-                    self.log.info('sock #%s connection broken',
-                                  self.sock.fileno())
-                    raise OSError('sock #%s connection broken',
-                                  self.sock.fileno())
-
-                chunks.append(chunk)
-                total_recv += len(chunk)
-
-            else:
-                self.log.warning('sock #%s not ready to read',
-                                 self.sock.fileno())
-
-        return b''.join(chunks)
+                deadline.check('sock #%s read' % self.sock.fileno())
+            self.sock.settimeout(deadline.remaining())
+            received = self.sock.recv_into(self._view[self._end:])
+            if not received:
+                self.log.info('sock #%s connection broken', self.sock.fileno())
+                raise OSError('sock #%s connection broken' % self.sock.fileno())
+            self._end += received
+
+    def _make_room(self, length):
+        """
+        Move the buffered data to the beginning of the buffer, or to a new
+        bigger buffer if length bytes do not fit in it. Views returned before
+        are not valid anymore.
+        """
+        pending = self._end - self._start
+        if length > len(self._buffer):
+            buffer = bytearray(max(length, 2 * len(self._buffer)))
+            buffer[:pending] = self._view[self._start:self._end]
+            self._buffer = buffer
+            self._view = memoryview(buffer)
+        else:
+            self._buffer[:pending] = self._buffer[self._start:self._end]
+        self._start = 0
+        self._end = pending
+
+
+def reuse_port_socket(address, family, socktype):
+    """
+    Create a socket bound with SO_REUSEPORT, so several processes can listen
+    on the same port and the kernel balances clients between them
+
+    :param address: Address to bind to
+    :param family: Socket family
+    :param socktype: Socket type, SOCK_STREAM or SOCK_DGRAM
+    :return: the bound socket
+    """
+    sock = socket.socket(family, socktype)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    try:
+        sock.bind(address)
+    except Exception:
+        sock.close()
+        raise
+    return sock
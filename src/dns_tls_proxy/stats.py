@@ -7,65 +7,375 @@ stats module
 import logging
 from collections import defaultdict
 
+import gevent
 from gevent import time
-from gevent.queue import Queue
+import dns.rcode
+from .histogram import Histogram
 
 
 STATS_INTERVAL = 10
+# Groups of latency histograms, in report order
+HISTOGRAM_GROUPS = ('listener', 'upstream', 'rcode', 'stage')
+# Stages of a request, timings are recorded in lists indexed by them
+STAGES = ('pool_wait', 'connect', 'upstream_rtt', 'client_write')
+POOL_WAIT, CONNECT, UPSTREAM_RTT, CLIENT_WRITE = range(len(STAGES))
+RCODES = 16
+
+
+class ListenerStats:
+    """
+    Counters of a listener, updated in place for every request
+    """
+
+    __slots__ = ('count', 'interval_count', 'interval_response_time',
+                 'retries', 'servfails', 'shed', 'histogram')
+
+    def __init__(self):
+        self.count = 0
+        self.interval_count = 0
+        self.interval_response_time = 0
+        self.retries = 0
+        self.servfails = 0
+        self.shed = 0
+        self.histogram = Histogram()
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'interval_count': self.interval_count,
+            'interval_response_time': self.interval_response_time,
+            'retries': self.retries,
+            'servfails': self.servfails,
+            'shed': self.shed,
+        }
 
 
 class Stats:
     """
-    Create a 'Stats' collector and reporter
+    Create a 'Stats' recorder and reporter
+
+    Requests are recorded by updating preallocated counters and histograms
+    in place, while a timer greenlet takes a snapshot and reports it every
+    interval.
     """
 
     def __init__(self, interval=STATS_INTERVAL):
         """
         Construct a new 'Stats' object
 
-        :param listeners: List of enabled listeners to collect stats from
+        :param interval: Seconds between reports
         :return: returns nothing
         """
         self.log = logging.getLogger(__name__)
-        self.log.debug('Init stats collector...')
-        self.stats_queue = Queue()
-        self.stats_store = defaultdict(lambda: defaultdict(lambda: 0))
+        self.log.debug('Init stats recorder...')
+        self.interval = interval
+        self.listeners = dict()
+        self.rcode_counts = [0] * RCODES
+        self.rcode_histograms = [Histogram() for _ in range(RCODES)]
+        self.stage_histograms = [Histogram() for _ in STAGES]
+        self.upstream_histograms = dict()
+        self.total_histograms = {group: dict() for group in HISTOGRAM_GROUPS}
+        self.sources = dict()
+        self.publish = None
+        self._reporter = None
         now = time.time()
         self.start_ts = now
         self.stats_ts = now
 
-    def queue(self):
-        return self.stats_queue
+    def listener(self, name):
+        """
+        Counters of a listener, created on first use
 
-    def show(self):
+        :param name: Name of the listener
+        :return: the ListenerStats of the listener
+        """
+        listener = self.listeners.get(name)
+        if listener is None:
+            listener = self.listeners[name] = ListenerStats()
+        return listener
+
+    def register(self, name, source):
+        """
+        Register a component to report its own stats
+
+        :param name: Name shown in the report
+        :param source: Object with a stats() method returning a dict
+        """
+        self.sources[name] = source
+
+    def record(self, listener, response_time, rcode=None, upstream=None,
+               timings=None, retries=0, servfail=False, shed=False):
+        """
+        Record a request answered by a listener
+
+        :param listener: Name of the listener
+        :param response_time: Seconds to answer the request
+        :param rcode: Response code of the reply, if any
+        :param upstream: Name of the nameserver the request was forwarded to
+        :param timings: List of seconds spent in every one of STAGES, None
+                        for the stages the request did not go through
+        :param retries: Number of times the request was retried
+        :param servfail: True if the proxy replied SERVFAIL itself
+        :param shed: True if the request was shed because of overload
+        """
+        stats = self.listeners.get(listener) or self.listener(listener)
+        stats.count += 1
+        stats.interval_count += 1
+        stats.interval_response_time += response_time
+        stats.retries += retries
+        stats.servfails += servfail
+        stats.shed += shed
+        stats.histogram.record(response_time)
+
+        if rcode is not None:
+            self.rcode_counts[rcode] += 1
+            self.rcode_histograms[rcode].record(response_time)
+
+        if timings is not None:
+            for stage, elapsed in enumerate(timings):
+                if elapsed is not None:
+                    self.stage_histograms[stage].record(elapsed)
+            rtt = timings[UPSTREAM_RTT]
+            if upstream is not None and rtt is not None:
+                histogram = self.upstream_histograms.get(upstream)
+                if histogram is None:
+                    histogram = self.upstream_histograms[upstream] = Histogram()
+                histogram.record(rtt)
+
+    def record_shed(self, listener):
+        """
+        Record a request shed by a listener before being handled
+
+        :param listener: Name of the listener
+        """
+        stats = self.listeners.get(listener) or self.listener(listener)
+        stats.shed += 1
+
+    def _histograms(self):
+        """
+        Interval histograms of every group by name
+        """
+        return {
+            'listener': {k: v.histogram for k, v in self.listeners.items()},
+            'upstream': self.upstream_histograms,
+            'rcode': {
+                dns.rcode.to_text(rcode): histogram
+                for rcode, histogram in enumerate(self.rcode_histograms)
+            },
+            'stage': dict(zip(STAGES, self.stage_histograms)),
+        }
+
+    @property
+    def rcodes(self):
+        """
+        Number of replies by response code name
+        """
+        return {
+            dns.rcode.to_text(rcode): count
+            for rcode, count in enumerate(self.rcode_counts) if count
+        }
+
+    def snapshot(self):
+        """
+        Take the stats collected since the previous snapshot, resetting the
+        interval counters
+
+        :return: dict with the elapsed interval, listeners and sources stats
+        """
         now = time.time()
-        interval_elapsed = now - self.stats_ts
+        histograms = self._histograms()
+        snapshot = {
+            'interval': now - self.stats_ts,
+            'listeners': {
+                name: listener.to_dict()
+                for name, listener in self.listeners.items()
+            },
+            'sources': {
+                name: source.stats()
+                for name, source in self.sources.items()
+            },
+            'histograms': {
+                group: {name: h.to_dict() for name, h in values.items() if h.count}
+                for group, values in histograms.items()
+            },
+        }
         self.stats_ts = now
 
+        for group, values in histograms.items():
+            for name, histogram in values.items():
+                if not histogram.count:
+                    continue
+                total = self.total_histograms[group].get(name)
+                if total is None:
+                    total = self.total_histograms[group][name] = Histogram()
+                total.merge(histogram)
+                histogram.reset()
+
+        for listener in self.listeners.values():
+            listener.interval_count = 0
+            listener.interval_response_time = 0
+
+        return snapshot
+
+    def start(self):
+        """
+        Start the timer greenlet reporting the stats every interval
+        """
+        if self._reporter is None:
+            self._reporter = gevent.spawn(self._report_loop)
+
+    def _report_loop(self):
+        while True:
+            gevent.sleep(self.interval)
+            try:
+                self.show()
+            except Exception as exc:
+                self.log.error('Unable to report stats: %s', exc)
+
+    def show(self):
+        snapshot = self.snapshot()
+        if self.publish is not None:
+            self.publish(snapshot)
+        else:
+            self.report(snapshot)
+
+    def report(self, snapshot):
+        """
+        Log the stats of a snapshot
+        """
+        interval_elapsed = snapshot['interval']
+        listeners = snapshot['listeners']
+        histograms = {
+            group: {name: Histogram.from_dict(h) for name, h in values.items()}
+            for group, values in snapshot.get('histograms', {}).items()
+        }
+        listener_histograms = histograms.get('listener', {})
+
+        proxy_histogram = Histogram()
+        for histogram in listener_histograms.values():
+            proxy_histogram.merge(histogram)
+        interval_count = sum(x.get('interval_count', 0) for x in listeners.values())
+        interval_response_time = sum(x.get('interval_response_time', 0) for x in listeners.values())
+
         self.log.warning(
-            '--- Stats of the proxy: #requests %i / qps %.02f / avg_time %.02fms',
-            self.stats_store['TCP']['count'] + self.stats_store['UDP']['count'],
-            (self.stats_store['TCP']['interval_count'] + self.stats_store['UDP']['interval_count']) / interval_elapsed,
-            (self.stats_store['TCP']['interval_response_time'] + self.stats_store['UDP']['interval_response_time']) / 2 / interval_elapsed
+            '--- Stats of the proxy: #requests %i / qps %.02f / avg_time %.02fms%s',
+            sum(x.get('count', 0) for x in listeners.values()),
+            interval_count / interval_elapsed,
+            interval_response_time / interval_count * 1000 if interval_count else 0,
+            format_latency(proxy_histogram)
         )
 
-        for listener in self.stats_store.keys():
+        for listener, values in listeners.items():
+            interval_count = values.get('interval_count', 0)
             self.log.warning(
-                '--- Stats of %s listener: #requests %i / qps %.02f / avg_time %.02fms',
+                '--- Stats of %s listener: #requests %i / #shed %i / qps %.02f / avg_time %.02fms%s',
                 listener,
-                self.stats_store[listener]['count'],
-                self.stats_store[listener]['interval_count'] / interval_elapsed,
-                self.stats_store[listener]['interval_response_time'] / interval_elapsed
+                values.get('count', 0),
+                values.get('shed', 0),
+                interval_count / interval_elapsed,
+                values.get('interval_response_time', 0) / interval_count * 1000 if interval_count else 0,
+                format_latency(listener_histograms.get(listener, Histogram()))
             )
-            self.stats_store[listener]['interval_count'] = 0
-            self.stats_store[listener]['interval_response_time'] = 0
 
-    def collector(self):
-        for msg in self.stats_queue:
-            listener = msg['listener']
-            self.stats_store[listener]['count'] += 1
-            self.stats_store[listener]['interval_count'] += 1
-            self.stats_store[listener]['interval_response_time'] += msg['response_time']
+        for group in HISTOGRAM_GROUPS[1:]:
+            for name, histogram in sorted(histograms.get(group, {}).items()):
+                self.log.warning(
+                    '--- Latency of %s %s: #samples %i%s',
+                    group, name, histogram.count, format_latency(histogram)
+                )
 
-            if time.time() - self.stats_ts > STATS_INTERVAL:
-                self.show()
+        for name, values in snapshot['sources'].items():
+            self.log.warning(
+                '--- Stats of %s: %s', name,
+                ' / '.join('{} {}'.format(k, v) for k, v in values.items())
+            )
+
+    def histogram_totals(self, group):
+        """
+        Latency histograms of a group since the start, including the values
+        recorded after the last snapshot
+
+        :param group: One of HISTOGRAM_GROUPS
+        :return: dict of histograms by name
+        """
+        totals = dict()
+        for name, histogram in self.total_histograms[group].items():
+            totals[name] = Histogram()
+            totals[name].merge(histogram)
+        for name, histogram in self._histograms()[group].items():
+            if histogram.count:
+                totals.setdefault(name, Histogram()).merge(histogram)
+        return totals
+
+
+def format_latency(histogram):
+    """
+    Format the percentiles of a histogram for the report
+    """
+    if not histogram.count:
+        return ''
+    return ' / p50 {:.02f}ms / p90 {:.02f}ms / p99 {:.02f}ms / max {:.02f}ms'.format(
+        histogram.percentile(0.5) * 1000,
+        histogram.percentile(0.9) * 1000,
+        histogram.percentile(0.99) * 1000,
+        histogram.max / 1000
+    )
+
+
+def merge_histograms(target, source):
+    """
+    Add the histograms of a snapshot to the ones of another snapshot, both
+    in their dict form
+
+    :param target: dict of histogram groups updated in place
+    :param source: dict of histogram groups to add
+    """
+    for group, values in source.items():
+        current = target.setdefault(group, {})
+        for name, histogram in values.items():
+            if name in current:
+                merged = Histogram.from_dict(current[name])
+                merged.merge(Histogram.from_dict(histogram))
+                current[name] = merged.to_dict()
+            else:
+                current[name] = histogram
+
+
+def merge_snapshots(snapshots, interval):
+    """
+    Aggregate the snapshots of several processes into one
+
+    Listener counters and the numeric values of the sources are added up,
+    except times (keys ending in _ms) which are averaged. Latency histograms
+    are merged.
+
+    :param snapshots: List of snapshots as returned by Stats.snapshot()
+    :param interval: Interval covered by the aggregated snapshot
+    :return: the aggregated snapshot
+    """
+    listeners = defaultdict(lambda: defaultdict(lambda: 0))
+    sources = defaultdict(lambda: defaultdict(lambda: 0))
+    samples = defaultdict(lambda: defaultdict(lambda: 0))
+    histograms = dict()
+    for snapshot in snapshots:
+        merge_histograms(histograms, snapshot.get('histograms', {}))
+        for listener, values in snapshot['listeners'].items():
+            for key, value in values.items():
+                listeners[listener][key] += value
+        for name, values in snapshot['sources'].items():
+            for key, value in values.items():
+                if isinstance(value, (int, float)):
+                    sources[name][key] += value
+                    samples[name][key] += 1
+
+    for name, values in sources.items():
+        for key in values:
+            if key.endswith('_ms'):
+                values[key] = round(values[key] / samples[name][key], 2)
+
+    return {
+        'interval': interval,
+        'listeners': {k: dict(v) for k, v in listeners.items()},
+        'sources': {k: dict(v) for k, v in sources.items()},
+        'histograms': histograms,
+    }
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+"""
+supervisor module
+"""
+
+import os
+import json
+import time
+import errno
+import signal
+import select
+import logging
+
+import gevent
+from .stats import Stats, STATS_INTERVAL, merge_snapshots, merge_histograms
+
+
+RESTART_DELAY = 1.0
+POLL_INTERVAL = 1.0
+STOP_TIMEOUT = 5.0
+
+
+class Worker:
+    """
+    State of a worker process kept by the supervisor
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.pid = None
+        self.stats_fd = None
+        self.buffer = b''
+        self.started_ts = 0
+        self.snapshot = None
+
+
+class Supervisor:
+    """
+    Fork and supervise worker processes, restarting them when they die and
+    aggregating the stats they report
+
+    The supervisor itself does not use gevent, so workers are forked from a
+    clean process and each one runs its own event loop.
+
+    :param target: Callable run in every worker, it receives a function to
+                   publish stats snapshots to the supervisor and the index
+                   of the worker
+    :param workers: Number of worker processes
+    :param stats: Enable the aggregated stats report
+    """
+
+    def __init__(self, target, workers, stats=False):
+        self.log = logging.getLogger(__name__)
+        self.target = target
+        self.workers = [Worker(index) for index in range(workers)]
+        self.stats = Stats() if stats else None
+        self.running = False
+
+    def _sig_term(self, signum, frame):
+        self.log.warning('Received SIGTERM signal')
+        raise SystemExit('Received SIGTERM signal')
+
+    def _spawn(self, worker):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # Worker process
+            os.close(read_fd)
+            for other in self.workers:
+                if other.stats_fd is not None:
+                    os.close(other.stats_fd)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            gevent.reinit()
+            code = 0
+            try:
+                self.target(lambda snapshot: self._publish(write_fd, snapshot), worker.index)
+            except SystemExit as exc:
+                code = exc.code if isinstance(exc.code, int) else 0
+            except BaseException as exc:
+                self.log.critical('Worker #%i failed: %s', worker.index, exc)
+                code = 1
+            finally:
+                os._exit(code)
+
+        os.close(write_fd)
+        worker.pid = pid
+        worker.stats_fd = read_fd
+        worker.buffer = b''
+        worker.started_ts = time.time()
+        self.log.warning('Started worker #%i with pid %i', worker.index, pid)
+
+    def _publish(self, fd, snapshot):
+        try:
+            os.write(fd, json.dumps(snapshot).encode() + b'\n')
+        except OSError as exc:
+            self.log.error('Unable to publish stats to supervisor: %s', exc)
+
+    def _reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            for worker in self.workers:
+                if worker.pid == pid:
+                    log = self.log.error if self.running else self.log.info
+                    log('Worker #%i with pid %i exited with status %i',
+                        worker.index, pid, status)
+                    worker.pid = None
+                    if worker.stats_fd is not None:
+                        os.close(worker.stats_fd)
+                        worker.stats_fd = None
+
+    def _restart(self):
+        now = time.time()
+        for worker in self.workers:
+            if worker.pid is None and now - worker.started_ts >= RESTART_DELAY:
+                self._spawn(worker)
+
+    def _read_stats(self, timeout):
+        fds = {w.stats_fd: w for w in self.workers if w.stats_fd is not None}
+        try:
+            readable, _, _ = select.select(list(fds), [], [], timeout)
+        except OSError as exc:
+            if exc.errno == errno.EINTR:
+                return
+            raise
+
+        for fd in readable:
+            worker = fds[fd]
+            data = os.read(fd, 65536)
+            if not data:
+                continue
+            worker.buffer += data
+            *lines, worker.buffer = worker.buffer.split(b'\n')
+            for line in lines:
+                self._add_snapshot(worker, json.loads(line.decode()))
+
+    def _add_snapshot(self, worker, snapshot):
+        """
+        Keep the latest counters of the worker, accumulating the interval
+        counters until the next report
+        """
+        if worker.snapshot is not None:
+            for listener, values in worker.snapshot['listeners'].items():
+                current = snapshot['listeners'].setdefault(listener, {})
+                for key in ('interval_count', 'interval_response_time'):
+                    current[key] = current.get(key, 0) + values.get(key, 0)
+            histograms = worker.snapshot.get('histograms', {})
+            merge_histograms(histograms, snapshot.get('histograms', {}))
+            snapshot['histograms'] = histograms
+        worker.snapshot = snapshot
+
+    def _report(self, interval):
+        snapshots = [w.snapshot for w in self.workers if w.snapshot is not None]
+        self.stats.report(merge_snapshots(snapshots, interval))
+        for snapshot in snapshots:
+            for values in snapshot['listeners'].values():
+                values['interval_count'] = 0
+                values['interval_response_time'] = 0
+            snapshot['histograms'] = {}
+
+    def _stop(self):
+        self.running = False
+        for worker in self.workers:
+            if worker.pid is not None:
+                self.log.info('Stopping worker #%i with pid %i', worker.index, worker.pid)
+                try:
+                    os.kill(worker.pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+
+        deadline = time.time() + STOP_TIMEOUT
+        while any(w.pid is not None for w in self.workers) and time.time() < deadline:
+            self._reap()
+            time.sleep(0.1)
+
+        for worker in self.workers:
+            if worker.pid is not None:
+                self.log.warning('Killing worker #%i with pid %i', worker.index, worker.pid)
+                os.kill(worker.pid, signal.SIGKILL)
+
+    def run(self):
+        """
+        Start the workers and supervise them until SIGTERM or SIGINT
+        """
+        signal.signal(signal.SIGTERM, self._sig_term)
+        report_ts = time.time()
+        self.running = True
+        try:
+            while True:
+                self._reap()
+                self._restart()
+                self._read_stats(POLL_INTERVAL)
+
+                now = time.time()
+                if self.stats is not None and now - report_ts > STATS_INTERVAL:
+                    self._report(now - report_ts)
+                    report_ts = now
+
+        except (SystemExit, KeyboardInterrupt):
+            self.log.warning('Stopping workers...')
+
+        finally:
+            self._stop()
@@ -5,7 +5,7 @@ tcp_dns module
 """
 
 import logging
-import struct
+from .socket_io import FRAME_HEADER
 
 
 class TCPDNS:
@@ -18,40 +18,55 @@ class TCPDNS:
         """
         Construct a new 'TCPDNS' object
 
-        :param sock: The socket to use for IO
+        :param sock: The SocketIO to use for IO
         :return: returns nothing
         """
         self.log = logging.getLogger(__name__)
         self.sock = sock
 
-    def send(self, msg):
+    def send(self, msg, deadline=None):
         """
         Send a TCP DNS message, prefixing the original DNS request with a two
         byte length field which gives the message length, excluding the prefix
 
         :param msg: The DNS message to send, without any extra field
+        :param deadline: Deadline to finish sending the message
         :return: returns nothing
         """
-        msg_len = len(msg)
-        full_msg = struct.pack("!H", msg_len) + msg
-        self.log.debug('Sending TCP DNS message of size 2 + %s', msg_len)
-        return self.sock.send(full_msg)
+        self.send_many((msg,), deadline=deadline)
 
-    def recv(self):
+    def send_many(self, msgs, deadline=None):
+        """
+        Send several TCP DNS messages with a single write, without copying
+        them to prefix their length fields
+
+        :param msgs: The DNS messages to send, without any extra field
+        :param deadline: Deadline to finish sending the messages
+        :return: returns nothing
+        """
+        buffers = list()
+        for msg in msgs:
+            buffers.append(FRAME_HEADER.pack(len(msg)))
+            buffers.append(msg)
+        self.sock.send_buffers(buffers, deadline=deadline)
+
+    def recv(self, deadline=None):
         """
         Receive a DNS request via a TCP DNS message
         The message is prefixed with a twp byte length field which gives the
         message length, excluding the prefix
 
+        :param deadline: Deadline to finish receiving the message
         :return: The DNS request, excluding the length field prefix
         """
-        self.log.debug('Reading TCP DNS length field...')
-        len_field = self.sock.recv(2)
-        msg_len, = struct.unpack('!H', len_field)
-        self.log.debug('Received TCP DNS length field: %s', msg_len)
+        return bytes(self.sock.recv_frame(deadline=deadline))
 
-        self.log.debug('Reading DNS message...')
-        msg = self.sock.recv(msg_len)
-        self.log.debug('Received DNS message of length %s', len(msg))
+    def recv_view(self, deadline=None):
+        """
+        Receive a TCP DNS message without copying it
 
-        return msg
+        :param deadline: Deadline to finish receiving the message
+        :return: memoryview of the DNS message, excluding the length field
+                 prefix, only valid until the next message is received
+        """
+        return self.sock.recv_frame(deadline=deadline)
@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+
+"""
+wire module
+
+Helpers to read DNS messages directly in wire format following RFC 1035,
+without building full dnspython objects
+https://tools.ietf.org/html/rfc1035#section-4.1
+"""
+
+import struct
+
+
+HEADER = struct.Struct('!HHHHHH')
+RR_FIXED = struct.Struct('!HHIH')
+TTL = struct.Struct('!I')
+
+HEADER_LEN = HEADER.size
+
+FLAG_QR = 0x8000
+FLAG_TC = 0x0200
+FLAG_CD = 0x0010
+EDNS_FLAG_DO = 0x8000
+OPCODE_MASK = 0x7800
+RCODE_MASK = 0x000F
+
+RCODE_NOERROR = 0
+RCODE_SERVFAIL = 2
+RCODE_NXDOMAIN = 3
+RCODE_REFUSED = 5
+
+FLAG_RD = 0x0100
+OPCODE_QUERY = 0
+
+MAX_LABEL_LEN = 63
+MAX_NAME_LEN = 255
+
+TYPE_A = 1
+TYPE_NS = 2
+TYPE_SOA = 6
+TYPE_AAAA = 28
+TYPE_OPT = 41
+
+CLASS_IN = 1
+
+EDNS_UDP_SIZE = 4096
+EDNS_OPTION_TCP_KEEPALIVE = 11
+
+# Pointer to the name of the question, at the end of the header
+QNAME_POINTER = b'\xc0\x0c'
+
+# Exceptions raised while reading malformed or truncated messages
+PARSE_ERRORS = (ValueError, IndexError, struct.error)
+
+
+def skip_name(msg, offset):
+    """
+    Skip over a domain name, which may be compressed
+
+    :param msg: DNS message in wire format
+    :param offset: Offset where the name starts
+    :return: Offset of the first byte after the name
+    """
+    while True:
+        length = msg[offset]
+        if length == 0:
+            return offset + 1
+        if length & 0xC0 == 0xC0:
+            return offset + 2
+        if length & 0xC0:
+            raise ValueError('Bad label type at offset %i' % offset)
+        offset += length + 1
+
+
+def check_name(msg, offset):
+    """
+    Check a domain name which must not be compressed, as in the question
+    section of a query
+
+    :param msg: DNS message in wire format
+    :param offset: Offset where the name starts
+    :return: Offset of the first byte after the name
+    """
+    start = offset
+    while True:
+        length = msg[offset]
+        if length == 0:
+            offset += 1
+            break
+        if length > MAX_LABEL_LEN:
+            raise ValueError('Bad label at offset %i' % offset)
+        offset += length + 1
+    if offset - start > MAX_NAME_LEN:
+        raise ValueError('Name too long at offset %i' % start)
+    if offset > len(msg):
+        raise ValueError('Truncated name at offset %i' % start)
+    return offset
+
+
+def validate_query(msg):
+    """
+    Check the sanity of a DNS query: header, a single question and its qname
+
+    :param msg: DNS query in wire format
+    :return: tuple (ID, flags, qname, qtype)
+    """
+    msg_id, flags, qdcount, _, _, _ = HEADER.unpack_from(msg)
+    if flags & FLAG_QR:
+        raise ValueError('Message is not a query')
+    if qdcount != 1:
+        raise ValueError('Expected 1 question, found %i' % qdcount)
+    end = check_name(msg, HEADER_LEN)
+    qtype, _ = struct.unpack_from('!HH', msg, end)
+    return msg_id, flags, bytes(msg[HEADER_LEN:end]), qtype
+
+
+def validate_reply(msg, msg_id=None):
+    """
+    Check the sanity of a DNS reply: header and question section
+
+    :param msg: DNS reply in wire format
+    :param msg_id: Expected message ID, not checked if None
+    :return: tuple (ID, flags)
+    """
+    reply_id, flags, qdcount, _, _, _ = HEADER.unpack_from(msg)
+    if not flags & FLAG_QR:
+        raise ValueError('Message is not a reply')
+    if msg_id is not None and reply_id != msg_id:
+        raise ValueError('Reply ID %i does not match query ID %i' % (reply_id, msg_id))
+    if qdcount > 1:
+        raise ValueError('Expected at most 1 question, found %i' % qdcount)
+    if qdcount and records_offset(msg) > len(msg):
+        raise ValueError('Truncated question section')
+    return reply_id, flags
+
+
+def error_reply(msg, rcode):
+    """
+    Build an error reply using just the header of the query, so it works
+    even for queries which can not be parsed
+
+    :param msg: DNS query in wire format, at least the ID must be present
+    :param rcode: Response code of the reply
+    :return: the reply in wire format, or None if the query is too short
+    """
+    if len(msg) < 2:
+        return None
+    flags = 0
+    if len(msg) >= 4:
+        flags, = struct.unpack_from('!H', msg, 2)
+    flags = FLAG_QR | (flags & (OPCODE_MASK | FLAG_RD | FLAG_CD)) | rcode
+    return bytes(msg[:2]) + struct.pack('!HHHHH', flags, 0, 0, 0, 0)
+
+
+def local_reply(msg, rcode, answers=(), ttl=0):
+    """
+    Build a reply generated by the proxy to a query, with its question and
+    the given answers
+
+    :param msg: DNS query in wire format
+    :param rcode: Response code of the reply
+    :param answers: List of tuples (rtype, rdata) of the answer records
+    :param ttl: TTL of the answer records
+    :return: the reply in wire format
+    """
+    _, flags, _, _, _, _ = HEADER.unpack_from(msg)
+    end = skip_name(msg, HEADER_LEN) + 4
+    flags = FLAG_QR | (flags & (OPCODE_MASK | FLAG_RD | FLAG_CD)) | rcode
+    reply = [bytes(msg[:2]), struct.pack('!HHHHH', flags, 1, len(answers), 0, 0),
+             bytes(msg[HEADER_LEN:end])]
+    for rtype, rdata in answers:
+        reply.append(QNAME_POINTER + RR_FIXED.pack(rtype, CLASS_IN, ttl, len(rdata)) + rdata)
+    return b''.join(reply)
+
+
+def encode_name(name):
+    """
+    Convert a domain name from text to lowercased wire format
+
+    :param name: Domain name, as bytes or str, with or without the final dot
+    :return: the name in wire format
+    """
+    if isinstance(name, str):
+        name = name.encode('ascii')
+    name = name.lower().rstrip(b'.')
+    if not name:
+        return b'\x00'
+    labels = name.split(b'.')
+    lengths = [len(label) for label in labels]
+    if not min(lengths) or max(lengths) > MAX_LABEL_LEN:
+        raise ValueError('Bad label in name %r' % name)
+    encoded = b''.join([bytes((n,)) + label for n, label in zip(lengths, labels)]) + b'\x00'
+    if len(encoded) > MAX_NAME_LEN:
+        raise ValueError('Name too long: %r' % name)
+    return encoded
+
+
+def build_query(msg_id, qname=b'\x00', qtype=TYPE_NS, keepalive=False):
+    """
+    Build a query, by default the cheap root NS query
+
+    :param msg_id: Message ID
+    :param qname: Query name in wire format
+    :param qtype: Query type
+    :param keepalive: Add an EDNS0 OPT record with the edns-tcp-keepalive
+                      option from RFC 7828
+    :return: the query in wire format
+    """
+    query = HEADER.pack(msg_id, FLAG_RD, 1, 0, 0, 1 if keepalive else 0)
+    query += qname + struct.pack('!HH', qtype, CLASS_IN)
+    if keepalive:
+        query += b'\x00' + RR_FIXED.pack(TYPE_OPT, EDNS_UDP_SIZE, 0, 4)
+        query += struct.pack('!HH', EDNS_OPTION_TCP_KEEPALIVE, 0)
+    return query
+
+
+def read_question(msg):
+    """
+    Read the first entry of the question section
+
+    :param msg: DNS message in wire format
+    :return: tuple (qname, qtype, qclass, end offset), qname is returned
+             lowercased and still in wire format
+    """
+    offset = HEADER_LEN
+    end = skip_name(msg, offset)
+    qname = bytes(msg[offset:end]).lower()
+    if qname[-1:] != b'\x00':
+        raise ValueError('Compressed names are not expected in questions')
+    qtype, qclass = struct.unpack_from('!HH', msg, end)
+    return qname, qtype, qclass, end + 4
+
+
+def iter_records(msg, offset, count):
+    """
+    Iterate over resource records
+
+    :param msg: DNS message in wire format
+    :param offset: Offset of the first record
+    :param count: Number of records to read
+    :return: yields tuples (rtype, ttl, ttl offset, rdata offset, rdlength)
+    """
+    for _ in range(count):
+        offset = skip_name(msg, offset)
+        rtype, _, ttl, rdlength = RR_FIXED.unpack_from(msg, offset)
+        ttl_offset = offset + 4
+        offset += RR_FIXED.size
+        if offset + rdlength > len(msg):
+            raise ValueError('Truncated resource record')
+        yield rtype, ttl, ttl_offset, offset, rdlength
+        offset += rdlength
+
+
+def records_offset(msg):
+    """
+    Offset of the first record after the question section
+    """
+    qdcount = HEADER.unpack_from(msg)[2]
+    offset = HEADER_LEN
+    for _ in range(qdcount):
+        offset = skip_name(msg, offset) + 4
+    return offset
+
+
+def question_key(msg):
+    """
+    Build the key identifying a query for caching purposes
+
+    :param msg: DNS query in wire format
+    :return: tuple (qname, qtype, qclass, DO bit, CD bit)
+    """
+    _, flags, qdcount, ancount, nscount, arcount = HEADER.unpack_from(msg)
+    if qdcount != 1:
+        raise ValueError('Expected 1 question, found %i' % qdcount)
+    qname, qtype, qclass, offset = read_question(msg)
+
+    do_bit = False
+    for rtype, ttl, _, _, _ in iter_records(msg, offset, ancount + nscount + arcount):
+        if rtype == TYPE_OPT:
+            do_bit = bool(ttl & EDNS_FLAG_DO)
+
+    return qname, qtype, qclass, do_bit, bool(flags & FLAG_CD)
+
+
+def ttl_info(msg):
+    """
+    Find the TTL fields of a reply and how long it can be cached
+
+    Positive answers use the minimum TTL of the answer section. Negative
+    answers (NXDOMAIN or NODATA) use the minimum of the SOA TTL and the SOA
+    MINIMUM field, following RFC 2308.
+
+    :param msg: DNS reply in wire format
+    :return: tuple (list of TTL field offsets, cacheable TTL), the TTL is None
+             if the reply must not be cached
+    """
+    _, flags, _, ancount, nscount, arcount = HEADER.unpack_from(msg)
+    rcode = flags & RCODE_MASK
+    if flags & FLAG_TC or rcode not in (RCODE_NOERROR, RCODE_NXDOMAIN):
+        return [], None
+
+    offsets = []
+    answer_ttl = None
+    negative_ttl = None
+    records = iter_records(msg, records_offset(msg), ancount + nscount + arcount)
+    for index, (rtype, ttl, ttl_offset, rdata_offset, rdlength) in enumerate(records):
+        if rtype == TYPE_OPT:
+            # The TTL field of the OPT pseudo-record holds EDNS flags
+            continue
+        offsets.append(ttl_offset)
+        if index < ancount:
+            answer_ttl = ttl if answer_ttl is None else min(answer_ttl, ttl)
+        elif index < ancount + nscount and rtype == TYPE_SOA and rdlength >= 20:
+            minimum, = TTL.unpack_from(msg, rdata_offset + rdlength - 4)
+            negative_ttl = min(ttl, minimum)
+
+    if rcode == RCODE_NOERROR and ancount:
+        return offsets, answer_ttl
+    return offsets, negative_ttl
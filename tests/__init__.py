@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+
+"""
+tests package
+"""
+
+import os
+import sys
+
+# Run the tests against the sources without installing the package
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+if SRC not in sys.path:
+    sys.path.insert(0, SRC)
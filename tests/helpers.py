@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+"""
+helpers module
+
+DNS messages, sockets, a nameserver and a fake clock shared by the tests
+"""
+
+import dns.flags
+import dns.message
+import dns.rcode
+import dns.rrset
+import gevent
+from gevent import socket
+from gevent.server import StreamServer
+
+from dns_tls_proxy import wire
+from dns_tls_proxy.socket_io import SocketIO
+from dns_tls_proxy.tcp_dns import TCPDNS
+
+
+class FakeClock:
+    """
+    Replacement of the time module of the tested modules, only advancing
+    when told to
+    """
+
+    def __init__(self, now=1000000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+def make_query(name='example.com.', rdtype='A', msg_id=0x1234, dnssec=False, cd=False):
+    query = dns.message.make_query(name, rdtype, want_dnssec=dnssec)
+    query.id = msg_id
+    if cd:
+        query.flags |= dns.flags.CD
+    return query.to_wire()
+
+
+def make_reply(query, answers=(), rcode=dns.rcode.NOERROR, authority=()):
+    """
+    Reply to a query in wire format
+
+    :param answers: List of tuples (ttl, rdtype, text) for the queried name
+    :param authority: List of tuples (name, ttl, rdtype, text)
+    """
+    message = dns.message.from_wire(query)
+    reply = dns.message.make_response(message)
+    reply.set_rcode(rcode)
+    name = message.question[0].name
+    for ttl, rdtype, text in answers:
+        reply.answer.append(dns.rrset.from_text(name, ttl, 'IN', rdtype, text))
+    for owner, ttl, rdtype, text in authority:
+        reply.authority.append(dns.rrset.from_text(owner, ttl, 'IN', rdtype, text))
+    return reply.to_wire()
+
+
+def key_of(query):
+    return wire.question_key(query)
+
+
+def socket_pair(address=('192.0.2.1', 853)):
+    """
+    Connected pair of sockets wrapped with SocketIO, the first one as a
+    connection to the nameserver at address
+    """
+    client, server = socket.socketpair()
+    return SocketIO(client, address=address), SocketIO(server)
+
+
+class Nameserver:
+    """
+    Local TCP DNS server answering every query with an empty reply, after
+    delay seconds
+
+    :param delays: Delays of the queries for some names, by name in text
+                   format
+    """
+
+    def __init__(self, delay=0, delays=None):
+        self.delay = delay
+        self.delays = delays or dict()
+        self.connections = list()
+        self.queries = 0
+        self.server = StreamServer(('127.0.0.1', 0), self.handle)
+        self.server.start()
+        self.address = self.server.address + ('ns.test',)
+
+    def handle(self, sock, _):
+        self.connections.append(sock)
+        tcp_dns = TCPDNS(SocketIO(sock))
+        try:
+            while True:
+                query = tcp_dns.recv()
+                self.queries += 1
+                name = str(dns.message.from_wire(query).question[0].name)
+                gevent.sleep(self.delays.get(name, self.delay))
+                tcp_dns.send(make_reply(query))
+        except OSError:
+            pass
+
+    def stop(self):
+        self.server.stop()
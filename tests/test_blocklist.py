@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+"""
+test_blocklist module
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from array import array
+from unittest import mock
+
+import dns.message
+import dns.rcode
+
+from dns_tls_proxy import blocklist as blocklist_module, wire
+from dns_tls_proxy.blocklist import Blocklist, BlocklistIndex, add_name, iter_suffixes, sort_keys
+from .helpers import make_query
+
+
+LIST = b"""# Comment
+ads.example.com
+tracker.test  # trailing comment
+0.0.0.0 malware.test other.malware.test
+:: ipv6.block.test
+192.0.2.10 override.test
+2001:db8::1 override.test
+not_an_address.1 broken.test
+bad..name
+||adblock.test^
+"""
+
+
+def index_of(*names):
+    keys, buffer = array('Q'), bytearray()
+    for name in names:
+        add_name(keys, buffer, wire.encode_name(name))
+    return BlocklistIndex(sort_keys(keys, buffer), buffer)
+
+
+class TestBlocklistIndex(unittest.TestCase):
+
+    def test_iter_suffixes(self):
+        self.assertEqual(list(iter_suffixes(wire.encode_name('a.b.c'))),
+                         [b'\x01a\x01b\x01c\x00', b'\x01b\x01c\x00', b'\x01c\x00'])
+        self.assertEqual(list(iter_suffixes(b'\x00')), [])
+
+    def test_blocks_subdomains_only(self):
+        index = index_of('ads.example.com', 'tracker.test')
+        for name in ('ads.example.com', 'x.ads.example.com', 'a.b.tracker.test'):
+            self.assertTrue(index.blocked(wire.encode_name(name)), name)
+        for name in ('example.com', 'bads.example.com', 'test', 'com'):
+            self.assertFalse(index.blocked(wire.encode_name(name)), name)
+
+    def test_fingerprint_collisions_are_not_matches(self):
+        with mock.patch.object(blocklist_module, 'fingerprint', lambda name: 7):
+            index = index_of('ads.example.com', 'tracker.test', 'ads.example.com')
+            self.assertEqual(len(index.keys), 2)
+            self.assertTrue(index.blocked(wire.encode_name('x.tracker.test')))
+            self.assertTrue(index.blocked(wire.encode_name('ads.example.com')))
+            self.assertFalse(index.blocked(wire.encode_name('example.com')))
+            self.assertFalse(index.blocked(wire.encode_name('tracker.tes')))
+
+    @mock.patch.object(blocklist_module, 'LOAD_BATCH', 3)
+    def test_sort_merges_runs_without_duplicates(self):
+        names = ['n{}.test'.format(i % 7) for i in range(20)]
+        index = index_of(*names)
+        self.assertEqual(len(index.keys), 7)
+        self.assertEqual(list(index.keys), sorted(index.keys))
+        for name in set(names):
+            self.assertTrue(index.blocked(wire.encode_name(name)), name)
+        self.assertFalse(index.blocked(wire.encode_name('n7.test')))
+
+    def test_empty(self):
+        index = BlocklistIndex()
+        self.assertFalse(index.blocked(wire.encode_name('example.com')))
+        self.assertGreater(index.memory, 0)
+
+
+class TestBlocklist(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'hosts')
+        with open(self.path, 'wb') as fh:
+            fh.write(LIST)
+
+    def loaded(self, mode='nxdomain'):
+        blocklist = Blocklist([self.path], mode=mode, ttl=120, interval=0)
+        blocklist.load()
+        return blocklist
+
+    def test_load(self):
+        blocklist = self.loaded()
+        stats = blocklist.stats()
+        self.assertEqual((stats['names'], stats['overrides'], stats['invalid'], stats['loads']),
+                         (5, 1, 3, 1))
+
+    def test_invalid_lines_are_counted_per_load(self):
+        blocklist = self.loaded()
+        blocklist.load()
+        self.assertEqual((blocklist.stats()['invalid'], blocklist.stats()['loads']), (3, 2))
+        self.assertIsNone(blocklist.reply(make_query('adblock.test.')))
+
+    def test_unreadable_list_keeps_index(self):
+        blocklist = self.loaded()
+        blocklist.paths = [self.path + '.missing']
+        blocklist.load()
+        self.assertEqual(blocklist.stats()['names'], 5)
+
+    def test_nxdomain(self):
+        blocklist = self.loaded()
+        reply = blocklist.reply(make_query('www.Malware.test.', msg_id=5))
+        message = dns.message.from_wire(reply)
+        self.assertEqual((message.id, message.rcode()), (5, dns.rcode.NXDOMAIN))
+        self.assertIsNone(blocklist.reply(make_query('example.com.')))
+        self.assertEqual(blocklist.blocked, 1)
+
+    def test_zero_mode(self):
+        blocklist = self.loaded('zero')
+        answer = dns.message.from_wire(blocklist.reply(make_query('ads.example.com.'))).answer
+        self.assertEqual((answer[0].ttl, answer[0][0].address), (120, '0.0.0.0'))
+        answer = dns.message.from_wire(
+            blocklist.reply(make_query('ipv6.block.test.', 'AAAA'))).answer
+        self.assertEqual(answer[0][0].address, '::')
+        message = dns.message.from_wire(blocklist.reply(make_query('ads.example.com.', 'MX')))
+        self.assertEqual((message.rcode(), message.answer), (dns.rcode.NOERROR, []))
+
+    def test_overrides(self):
+        blocklist = self.loaded()
+        answer = dns.message.from_wire(blocklist.reply(make_query('override.test.'))).answer
+        self.assertEqual(answer[0][0].address, '192.0.2.10')
+        answer = dns.message.from_wire(
+            blocklist.reply(make_query('override.test.', 'AAAA'))).answer
+        self.assertEqual(answer[0][0].address, '2001:db8::1')
+        # Overrides only apply to the exact name
+        self.assertIsNone(blocklist.reply(make_query('sub.override.test.')))
+        self.assertEqual(blocklist.overridden, 2)
+
+    def test_unparseable_query_is_forwarded(self):
+        self.assertIsNone(self.loaded().reply(b'\x00\x01\x00'))
+
+    def test_bad_mode(self):
+        with self.assertRaises(ValueError):
+            Blocklist([self.path], mode='drop')
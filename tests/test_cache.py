@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+"""
+test_cache module
+"""
+
+import unittest
+from unittest import mock
+
+import dns.rcode
+
+from dns_tls_proxy import cache
+from dns_tls_proxy import wire
+from dns_tls_proxy.cache import ResponseCache, STALE_REPLY_TTL
+from .helpers import FakeClock, make_query, make_reply, key_of
+
+
+def answer_ttls(reply):
+    offsets, _ = wire.ttl_info(reply)
+    return [wire.TTL.unpack_from(reply, offset)[0] for offset in offsets]
+
+
+class TestResponseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch.object(cache, 'time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.query = make_query(msg_id=1)
+        self.key = key_of(self.query)
+        self.reply = make_reply(self.query, [(300, 'A', '1.2.3.4'), (100, 'A', '1.2.3.5')])
+
+    def test_hit_rewrites_id_and_decrements_ttls(self):
+        c = ResponseCache(10)
+        self.assertTrue(c.put(self.key, self.reply))
+        self.clock.advance(30.5)
+        reply = c.get(self.key, b'\xbe\xef')
+        self.assertEqual(reply[:2], b'\xbe\xef')
+        self.assertEqual(reply[2:4], self.reply[2:4])
+        self.assertEqual(answer_ttls(reply), [270, 70])
+        self.assertEqual((c.hits, c.misses), (1, 0))
+
+    def test_expires_with_minimum_ttl(self):
+        c = ResponseCache(10)
+        c.put(self.key, self.reply)
+        self.clock.advance(100)
+        self.assertIsNone(c.get(self.key, b'\x00\x01'))
+        self.assertEqual(c.misses, 1)
+        self.assertEqual(len(c), 0)
+
+    def test_max_ttl(self):
+        c = ResponseCache(10, max_ttl=10)
+        c.put(self.key, self.reply)
+        self.clock.advance(10)
+        self.assertIsNone(c.get(self.key, b'\x00\x01'))
+
+    def test_uncacheable_replies(self):
+        c = ResponseCache(10)
+        servfail = make_reply(self.query, rcode=dns.rcode.SERVFAIL)
+        self.assertFalse(c.put(self.key, servfail))
+        self.assertFalse(c.put(self.key, b'\x00'))
+        self.assertEqual(len(c), 0)
+
+    def test_lru_eviction(self):
+        c = ResponseCache(2)
+        keys = []
+        for name in ('a.test.', 'b.test.', 'c.test.'):
+            query = make_query(name)
+            keys.append(key_of(query))
+            c.put(keys[-1], make_reply(query, [(60, 'A', '1.2.3.4')]))
+            if name == 'b.test.':
+                c.get(keys[0], b'\x00\x01')
+        self.assertIsNotNone(c.get(keys[0], b'\x00\x01'))
+        self.assertIsNone(c.get(keys[1], b'\x00\x01'))
+        self.assertEqual(c.evictions, 1)
+
+    def test_max_bytes(self):
+        c = ResponseCache(10, max_bytes=len(self.reply) + 1)
+        c.put(self.key, self.reply)
+        other = make_query('other.test.')
+        c.put(key_of(other), make_reply(other, [(60, 'A', '1.2.3.4')]))
+        self.assertEqual(len(c), 1)
+        self.assertLessEqual(c.size_bytes, c.max_bytes)
+
+    def test_stale_reply(self):
+        c = ResponseCache(10, stale_ttl=60)
+        c.put(self.key, self.reply)
+        self.clock.advance(130)
+        self.assertIsNone(c.get(self.key, b'\x00\x02'))
+        reply = c.get_stale(self.key, b'\x00\x02')
+        self.assertEqual(answer_ttls(reply), [STALE_REPLY_TTL, STALE_REPLY_TTL])
+        self.assertEqual(c.stale_hits, 1)
+        self.clock.advance(30)
+        self.assertIsNone(c.get_stale(self.key, b'\x00\x02'))
+
+    def test_stale_disabled(self):
+        c = ResponseCache(10)
+        c.put(self.key, self.reply)
+        self.clock.advance(100)
+        self.assertIsNone(c.get_stale(self.key, b'\x00\x02'))
+
+    def test_prefetch_due_once(self):
+        c = ResponseCache(10, prefetch=0.5)
+        c.put(self.key, self.reply)
+        self.clock.advance(40)
+        self.assertFalse(c.prefetch_due(self.key))
+        self.clock.advance(10)
+        self.assertTrue(c.prefetch_due(self.key))
+        self.assertFalse(c.prefetch_due(self.key))
+        # Storing the refreshed reply makes it due again later
+        c.put(self.key, self.reply)
+        self.clock.advance(50)
+        self.assertTrue(c.prefetch_due(self.key))
+        self.assertEqual(c.prefetches, 2)
+
+    def test_prefetch_failed(self):
+        c = ResponseCache(10, prefetch=0.5)
+        c.put(self.key, self.reply)
+        self.clock.advance(50)
+        self.assertTrue(c.prefetch_due(self.key))
+        c.prefetch_failed(self.key)
+        self.assertTrue(c.prefetch_due(self.key))
+        c.prefetch_failed(key_of(make_query('missing.test.')))
+
+    def test_prefetch_disabled(self):
+        c = ResponseCache(10)
+        c.put(self.key, self.reply)
+        self.clock.advance(99)
+        self.assertFalse(c.prefetch_due(self.key))
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+"""
+test_circuit_breaker module
+"""
+
+import unittest
+from unittest import mock
+
+from dns_tls_proxy import circuit_breaker
+from dns_tls_proxy import wire
+from dns_tls_proxy.circuit_breaker import CircuitBreaker, CLOSED, HALF_OPEN, OPEN
+from dns_tls_proxy.connection_pool import TCPConnectionPool, NoUpstreamAvailable
+from dns_tls_proxy.deadline import Deadline
+from dns_tls_proxy.request_handler import RequestHandler
+from .helpers import FakeClock, make_query
+
+
+ADDRESS = ('192.0.2.1', 853)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        patchers = [
+            mock.patch.object(circuit_breaker, 'time', self.clock),
+            # No jitter, so the backoffs can be checked exactly
+            mock.patch.object(circuit_breaker, 'uniform', lambda low, high: 1.0),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.breaker = CircuitBreaker(ADDRESS, failure_threshold=3, backoff=1.0,
+                                      max_backoff=4.0)
+
+    def fail(self, times):
+        for _ in range(times):
+            self.breaker.record_failure()
+
+    def test_opens_after_consecutive_failures(self):
+        self.fail(2)
+        self.assertTrue(self.breaker.closed())
+        self.fail(1)
+        self.assertEqual(self.breaker.state, OPEN)
+        self.assertEqual(self.breaker.open_until, self.clock.now + 1.0)
+
+    def test_success_resets_consecutive_failures(self):
+        self.fail(2)
+        self.breaker.record_success()
+        self.fail(2)
+        self.assertTrue(self.breaker.closed())
+
+    def test_opens_on_error_rate(self):
+        breaker = CircuitBreaker(ADDRESS, failure_threshold=100, error_rate=0.5)
+        for _ in range(circuit_breaker.ERROR_WINDOW // 2 - 1):
+            breaker.record_failure()
+            breaker.record_success()
+        breaker.record_success()
+        self.assertTrue(breaker.closed())
+        # The window is full with half of the outcomes failed
+        breaker.record_failure()
+        self.assertEqual(breaker.state, OPEN)
+
+    def test_error_rate_only_counts_the_window(self):
+        breaker = CircuitBreaker(ADDRESS, failure_threshold=100, error_rate=0.5)
+        for _ in range(circuit_breaker.ERROR_WINDOW // 2 - 1):
+            breaker.record_failure()
+        for _ in range(circuit_breaker.ERROR_WINDOW):
+            breaker.record_success()
+        breaker.record_failure()
+        self.assertTrue(breaker.closed())
+
+    def test_single_probe_after_backoff(self):
+        self.fail(3)
+        self.assertFalse(self.breaker.try_probe())
+        self.clock.advance(1.0)
+        self.assertTrue(self.breaker.try_probe())
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+        self.assertFalse(self.breaker.try_probe())
+        # A probe without outcome is given up after PROBE_TIMEOUT
+        self.clock.advance(circuit_breaker.PROBE_TIMEOUT)
+        self.assertTrue(self.breaker.try_probe())
+
+    def test_probe_success_closes(self):
+        self.fail(3)
+        self.clock.advance(1.0)
+        self.breaker.try_probe()
+        self.breaker.record_success()
+        self.assertTrue(self.breaker.closed())
+        self.assertEqual(self.breaker.opens_in_row, 0)
+        self.assertFalse(self.breaker.try_probe())
+
+    def test_probe_failure_doubles_backoff_up_to_max(self):
+        self.fail(3)
+        for backoff in (2.0, 4.0, 4.0):
+            self.clock.advance(self.breaker.open_until - self.clock.now)
+            self.assertTrue(self.breaker.try_probe())
+            self.breaker.record_failure()
+            self.assertEqual(self.breaker.state, OPEN)
+            self.assertEqual(self.breaker.open_until, self.clock.now + backoff)
+
+    def test_late_success_does_not_close_open_circuit(self):
+        self.fail(3)
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, OPEN)
+
+    def test_only_probe_outcome_decides_half_open(self):
+        before = self.breaker.generation
+        self.fail(3)
+        self.clock.advance(1.0)
+        self.assertTrue(self.breaker.try_probe())
+        probe = self.breaker.generation
+        # Queries sent before the circuit opened
+        self.breaker.record_success(before)
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+        self.breaker.record_failure(before)
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+        self.breaker.record_success(probe)
+        self.assertTrue(self.breaker.closed())
+
+    def test_given_up_probe_does_not_decide(self):
+        self.fail(3)
+        self.clock.advance(1.0)
+        self.breaker.try_probe()
+        first = self.breaker.generation
+        self.clock.advance(circuit_breaker.PROBE_TIMEOUT)
+        self.breaker.try_probe()
+        second = self.breaker.generation
+        self.breaker.record_failure(first)
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+        self.breaker.record_failure(second)
+        self.assertEqual(self.breaker.state, OPEN)
+
+    def test_transitions(self):
+        self.fail(3)
+        self.clock.advance(1.0)
+        self.breaker.try_probe()
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.transitions, [1, 1, 1])
+        self.assertEqual(self.breaker.state_name, 'closed')
+        self.assertEqual(CLOSED, 0)
+
+
+class TestAllCircuitsOpen(unittest.TestCase):
+
+    def setUp(self):
+        self.addresses = [('192.0.2.1', 853, 'one.test'), ('192.0.2.2', 853, 'two.test')]
+        self.pool = TCPConnectionPool(self.addresses, breaker_options={'failure_threshold': 1})
+        for upstream in self.pool.upstreams:
+            upstream.breaker.record_failure()
+
+    def test_get_address_raises(self):
+        with self.assertRaises(NoUpstreamAvailable):
+            self.pool.get_address()
+
+    def test_probe_gets_network_timeout(self):
+        breaker = self.pool.upstreams[0].breaker
+        breaker.open_until = 0
+        self.assertEqual(self.pool.get_address(), self.addresses[0])
+        self.assertEqual(breaker.state, HALF_OPEN)
+        with mock.patch.object(self.pool.policy, 'query_timeout', return_value=0.2):
+            self.assertEqual(self.pool.query_timeout(self.addresses[0]), self.pool.network_timeout)
+            self.assertEqual(self.pool.query_timeout(self.addresses[1]), self.pool.network_timeout)
+
+    def test_request_is_answered_without_retries(self):
+        query = make_query()
+        handler = RequestHandler(address=None, socket=None, conn_pool=self.pool, stats=None)
+        handler.request = query
+        handler.start_ts = 0
+        handler.deadline = Deadline(1.0)
+        with mock.patch.object(self.pool, 'get_address', wraps=self.pool.get_address) as get_address, \
+                self.assertLogs('dns_tls_proxy', 'INFO') as logs:
+            handler.forward_request(query)
+        self.assertEqual(get_address.call_count, 1)
+        self.assertEqual(handler.reply[3] & wire.RCODE_MASK, wire.RCODE_SERVFAIL)
+        self.assertTrue(handler.unavailable)
+        self.assertEqual(handler.retries, 0)
+        self.assertFalse([x for x in logs.records if x.levelname == 'ERROR'])
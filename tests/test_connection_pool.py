@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+"""
+test_connection_pool module
+"""
+
+import unittest
+
+import gevent
+
+from dns_tls_proxy.connection_pool import TCPConnectionPool, PoolExhausted
+from .helpers import Nameserver
+
+
+class PoolTestCase(unittest.TestCase):
+
+    def nameserver(self, delay=0):
+        nameserver = Nameserver(delay)
+        self.addCleanup(nameserver.stop)
+        return nameserver
+
+    def pool(self, nameservers, **options):
+        options.setdefault('health_check_interval', 0)
+        return TCPConnectionPool([x.address for x in nameservers], **options)
+
+
+class TestUpstreamPools(PoolTestCase):
+
+    def test_sub_pool_per_nameserver(self):
+        first, second = self.nameserver(), self.nameserver()
+        pool = self.pool([first, second], size=2)
+        sock = pool.get_socket(first.address)
+        self.assertEqual(sock.address, first.address)
+        upstreams = {x.address: x for x in pool.upstreams}
+        self.assertEqual((upstreams[first.address].in_use, upstreams[second.address].in_use),
+                         (1, 0))
+        pool.return_socket(sock)
+        self.assertEqual(upstreams[first.address].idle.qsize(), 1)
+        self.assertIs(pool.get_socket(first.address), sock)
+        gevent.sleep(0.01)
+        self.assertEqual(len(first.connections), 1)
+        self.assertFalse(second.connections)
+
+    def test_saturated_nameserver_is_avoided(self):
+        first, second = self.nameserver(), self.nameserver()
+        pool = self.pool([first, second], size=1)
+        pool.get_socket(first.address)
+        for _ in range(10):
+            self.assertEqual(pool.get_address(), second.address)
+
+    def test_max_idle(self):
+        nameserver = self.nameserver()
+        pool = self.pool([nameserver], size=3, max_idle=1)
+        socks = [pool.get_socket() for _ in range(3)]
+        for sock in socks:
+            pool.return_socket(sock)
+        self.assertEqual(pool.upstreams[0].idle.qsize(), 1)
+        self.assertEqual(pool.upstreams[0].in_use, 0)
+
+
+class TestHealthChecks(PoolTestCase):
+
+    def test_fill(self):
+        nameserver = self.nameserver()
+        pool = self.pool([nameserver], size=3, min_idle=2)
+        pool.fill(nameserver.address)
+        self.assertEqual(pool.upstreams[0].idle.qsize(), 2)
+        self.assertEqual(pool.upstreams[0].in_use, 0)
+
+    def test_broken_connections_are_replaced(self):
+        nameserver = self.nameserver()
+        pool = self.pool([nameserver], size=3, min_idle=1)
+        pool.fill(nameserver.address)
+        gevent.sleep(0.01)
+        nameserver.connections[0].close()
+        pool.health_check(nameserver.address)
+        self.assertEqual((pool.health_checks, pool.health_check_failures), (1, 1))
+        self.assertEqual(pool.upstreams[0].idle.qsize(), 1)
+        self.assertEqual(pool.upstreams[0].in_use, 0)
+        sock = pool.get_socket()
+        self.assertTrue(pool.probe(sock))
+
+    def test_oldest_idle_connections_are_probed(self):
+        nameserver = self.nameserver()
+        pool = self.pool([nameserver], size=4)
+        socks = [pool.get_socket() for _ in range(4)]
+        for sock in socks:
+            pool.return_socket(sock)
+        pool.health_check(nameserver.address)
+        self.assertEqual(pool.health_checks, 2)
+        self.assertEqual(nameserver.queries, 2)
+        # The probed ones are back on top of the idle stack
+        self.assertEqual({pool.get_socket(), pool.get_socket()}, set(socks[:2]))
+        self.assertEqual(pool.get_socket(), socks[3])
+
+    def test_probes_do_not_hold_connection_slots(self):
+        nameserver = self.nameserver(delay=0.2)
+        pool = self.pool([nameserver], size=1, acquire_timeout=0.05)
+        pool.return_socket(pool.get_socket())
+        check = gevent.spawn(pool.health_check, nameserver.address)
+        gevent.sleep(0.01)
+        self.assertEqual(pool.upstreams[0].in_use, 0)
+        # A new connection is opened while the idle one is probed
+        sock = pool.get_socket()
+        self.assertEqual(pool.upstreams[0].in_use, 1)
+        check.join()
+        self.assertEqual(pool.health_check_failures, 0)
+        pool.return_socket(sock)
+        self.assertEqual(pool.upstreams[0].idle.qsize(), 1)
+
+
+class TestAdmissionControl(PoolTestCase):
+
+    def test_acquire_timeout(self):
+        nameserver = self.nameserver()
+        pool = self.pool([nameserver], size=1, acquire_timeout=0.05)
+        pool.get_socket()
+        with self.assertRaises(PoolExhausted):
+            pool.get_socket()
+        self.assertEqual(pool.upstreams[0].shed, 1)
+
+    def test_waiting_request_gets_returned_socket(self):
+        nameserver = self.nameserver()
+        pool = self.pool([nameserver], size=1, acquire_timeout=1.0)
+        sock = pool.get_socket()
+        waiter = gevent.spawn(pool.get_socket)
+        gevent.sleep(0.01)
+        self.assertEqual(pool.upstreams[0].waiting, 1)
+        pool.return_socket(sock)
+        self.assertIs(waiter.get(timeout=1), sock)
+
+    def test_max_waiting_sheds_at_once(self):
+        nameserver = self.nameserver()
+        pool = self.pool([nameserver], size=1, acquire_timeout=1.0, max_waiting=1)
+        pool.get_socket()
+        waiter = gevent.spawn(pool.get_socket)
+        gevent.sleep(0.01)
+        with gevent.Timeout(0.1):
+            with self.assertRaises(PoolExhausted):
+                pool.get_socket()
+        self.assertEqual(pool.upstreams[0].shed, 1)
+        waiter.kill()
+        self.assertEqual(pool.upstreams[0].waiting, 0)
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+
+"""
+test_deadline module
+"""
+
+import unittest
+from unittest import mock
+
+from dns_tls_proxy import deadline
+from dns_tls_proxy.deadline import Deadline, DeadlineExceeded
+from .helpers import FakeClock
+
+
+class TestDeadline(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch.object(deadline, 'time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_remaining(self):
+        d = Deadline(2.0)
+        self.assertEqual(d.remaining(), 2.0)
+        self.clock.advance(1.5)
+        self.assertEqual(d.remaining(), 0.5)
+        self.clock.advance(1.0)
+        self.assertEqual(d.remaining(), 0.0)
+        self.assertTrue(d.expired())
+
+    def test_timeout_is_capped(self):
+        d = Deadline(2.0)
+        self.assertEqual(d.timeout(), 2.0)
+        self.assertEqual(d.timeout(0.5), 0.5)
+        self.assertEqual(d.timeout(5.0), 2.0)
+
+    def test_limit(self):
+        d = Deadline(2.0)
+        self.assertEqual(d.limit(0.5).expires_at, self.clock.now + 0.5)
+        self.assertEqual(d.limit(5.0).expires_at, d.expires_at)
+
+    def test_check(self):
+        d = Deadline(1.0)
+        d.check()
+        self.clock.advance(1.0)
+        with self.assertRaises(DeadlineExceeded):
+            d.check('reply')
+        self.assertTrue(issubclass(DeadlineExceeded, OSError))
+
+    def test_absolute_expiry(self):
+        self.assertEqual(Deadline(expires_at=5.0).expires_at, 5.0)
+
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+"""
+test_gevent_tcp module
+"""
+
+import time
+import unittest
+
+import dns.message
+import dns.rcode
+import gevent
+from gevent import socket
+
+from dns_tls_proxy.connection_pool import TCPConnectionPool
+from dns_tls_proxy.deadline import Deadline
+from dns_tls_proxy.gevent_tcp import ServerTCP
+from dns_tls_proxy.socket_io import SocketIO
+from dns_tls_proxy.tcp_dns import TCPDNS
+from .helpers import Nameserver, make_query
+
+
+class TestPersistentConnections(unittest.TestCase):
+
+    def setUp(self):
+        self.nameserver = Nameserver(delays={'slow.test.': 0.2})
+        self.addCleanup(self.nameserver.stop)
+
+    def listen(self, **options):
+        pool = TCPConnectionPool([self.nameserver.address], size=5, health_check_interval=0)
+        server = ServerTCP(('127.0.0.1', 0), pool, **options)
+        server.start()
+        self.addCleanup(server.stop)
+        return server
+
+    def connect(self, server):
+        sock = socket.create_connection(server.address)
+        self.addCleanup(sock.close)
+        return TCPDNS(SocketIO(sock))
+
+    def replies(self, client, count):
+        return [dns.message.from_wire(client.recv(Deadline(2))) for _ in range(count)]
+
+    def test_pipelined_queries_answered_out_of_order(self):
+        client = self.connect(self.listen())
+        client.send_many([make_query('slow.test.', msg_id=1), make_query('fast.test.', msg_id=2)])
+        self.assertEqual([r.id for r in self.replies(client, 2)], [2, 1])
+        # The connection stays open for more queries
+        client.send(make_query('again.test.', msg_id=3))
+        self.assertEqual(self.replies(client, 1)[0].id, 3)
+
+    def test_concurrent_replies_keep_framing(self):
+        client = self.connect(self.listen())
+        client.send_many([make_query('q{}.test.'.format(i), msg_id=i) for i in range(30)])
+        replies = self.replies(client, 30)
+        self.assertEqual(sorted(r.id for r in replies), list(range(30)))
+        self.assertTrue(all(r.rcode() == dns.rcode.NOERROR for r in replies))
+
+    def test_idle_connection_is_closed(self):
+        client = self.connect(self.listen(idle_timeout=0.05))
+        start = time.time()
+        with self.assertRaises(OSError):
+            client.recv(Deadline(2))
+        self.assertLess(time.time() - start, 1)
+
+    def test_connection_with_queries_in_progress_is_not_idle(self):
+        client = self.connect(self.listen(idle_timeout=0.05))
+        client.send(make_query('slow.test.', msg_id=1))
+        self.assertEqual(self.replies(client, 1)[0].id, 1)
+
+    def test_refused_when_full(self):
+        client = self.connect(self.listen(max_handlers=1))
+        client.send(make_query('slow.test.', msg_id=1))
+        gevent.sleep(0.05)
+        client.send(make_query('fast.test.', msg_id=2))
+        replies = self.replies(client, 2)
+        self.assertEqual([(r.id, r.rcode()) for r in replies],
+                         [(2, dns.rcode.REFUSED), (1, dns.rcode.NOERROR)])
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+"""
+test_gevent_udp module
+"""
+
+import unittest
+
+import gevent
+from gevent import socket
+
+from dns_tls_proxy.gevent_udp import BatchedServerUDP
+
+
+class FullSocket:
+    """
+    Non-blocking UDP socket whose buffer is full until told otherwise
+    """
+
+    def __init__(self):
+        self.sock, self.peer = socket.socketpair()
+        self.full = True
+        self.sent = list()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def sendto(self, data, address):
+        if self.full:
+            raise BlockingIOError()
+        if address is None:
+            raise OSError('Invalid address')
+        self.sent.append(data)
+
+    def close(self):
+        self.sock.close()
+        self.peer.close()
+
+
+class TestBatchedReplies(unittest.TestCase):
+
+    def setUp(self):
+        self.server = BatchedServerUDP(('127.0.0.1', 0), conn_pool=None)
+        self.server._socket = FullSocket()
+        self.addCleanup(self.server._socket.close)
+        self.flusher = gevent.spawn(self.server._flush_loop)
+        self.addCleanup(self.flusher.kill)
+
+    def test_replies_written_at_once(self):
+        self.server._socket.full = False
+        self.server.sendto(b'one', ('192.0.2.1', 53))
+        self.assertEqual(self.server._socket.sent, [b'one'])
+        self.assertEqual(self.server.replies, [])
+        self.assertEqual((self.server.batch_stats.replies, self.server.batch_stats.deferred),
+                         (1, 0))
+
+    def test_replies_queued_while_buffer_full(self):
+        for data in (b'one', b'two'):
+            self.server.sendto(data, ('192.0.2.1', 53))
+        gevent.sleep(0.01)
+        self.assertEqual(len(self.server.replies), 2)
+        self.server._socket.full = False
+        # Queued replies go before the new ones
+        self.server.sendto(b'three', ('192.0.2.1', 53))
+        gevent.sleep(0.01)
+        self.assertEqual(self.server._socket.sent, [b'one', b'two', b'three'])
+        self.assertEqual((self.server.batch_stats.replies, self.server.batch_stats.deferred),
+                         (3, 3))
+
+    def test_reply_error_is_dropped(self):
+        self.server._socket.full = False
+        self.server.sendto(b'lost', None)
+        self.server.sendto(b'next', ('192.0.2.1', 53))
+        self.assertEqual(self.server._socket.sent, [b'next'])
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+"""
+test_hedging module
+"""
+
+import unittest
+
+import gevent
+
+from dns_tls_proxy.deadline import Deadline
+from dns_tls_proxy.hedging import HedgeBudget
+from dns_tls_proxy.request_handler import RequestHandler
+from dns_tls_proxy.stats import CONNECT, UPSTREAM_RTT
+from .helpers import make_query, make_reply
+
+
+PRIMARY = ('192.0.2.1', 853, 'primary.test')
+SECONDARY = ('192.0.2.2', 853, 'secondary.test')
+HEDGE_DELAY = 0.02
+
+
+CONNECT_TIME = 0.01
+
+
+class FakeSocket:
+    """
+    Socket opened for every query, taking CONNECT_TIME to connect
+    """
+
+    def __init__(self, address):
+        self.address = address
+        self.connect_time = CONNECT_TIME
+        self.connected_ts = float('inf')
+
+
+class FakeConnection:
+    """
+    Pipelined connection replying after a delay
+    """
+
+    def __init__(self, address, delay, reply):
+        self.sock = FakeSocket(address)
+        self.delay = delay
+        self.reply = reply
+        self.queries = 0
+        self.cancelled = False
+
+    def query(self, msg, deadline=None):
+        self.queries += 1
+        try:
+            gevent.sleep(self.delay)
+        except gevent.GreenletExit:
+            self.cancelled = True
+            raise
+        if self.reply is None:
+            raise OSError('connection broken')
+        return self.reply
+
+
+class FakePool:
+    """
+    Pipelined pool of two nameservers
+    """
+
+    pipelining = True
+
+    def __init__(self, connections):
+        self.connections = connections
+
+    def get_address(self, prefer_free=False, exclude=()):
+        for address in (PRIMARY, SECONDARY):
+            if address not in exclude:
+                return address
+        return None
+
+    def get_connection(self, deadline=None, address=None):
+        return self.connections[address]
+
+    def query_timeout(self, address):
+        return 1.0
+
+    def hedge_delay(self, address):
+        return HEDGE_DELAY
+
+
+class TestHedgeBudget(unittest.TestCase):
+
+    def test_ratio(self):
+        budget = HedgeBudget(0.25)
+        self.assertFalse(budget.withdraw())
+        for _ in range(4):
+            budget.deposit()
+        self.assertTrue(budget.withdraw())
+        self.assertFalse(budget.withdraw())
+        self.assertEqual(budget.stats(), {'hedged': 1, 'won': 0, 'denied': 2})
+
+    def test_burst(self):
+        budget = HedgeBudget(1, burst=3)
+        for _ in range(10):
+            budget.deposit()
+        self.assertEqual(budget.balance, 3)
+        self.assertEqual(sum(budget.withdraw() for _ in range(10)), 3)
+
+
+class TestHedgedQuery(unittest.TestCase):
+
+    def setUp(self):
+        self.query = make_query(msg_id=9)
+        self.reply = make_reply(self.query, [(60, 'A', '10.0.0.1')])
+
+    def hedge(self, primary, secondary, ratio=1):
+        self.connections = {
+            PRIMARY: FakeConnection(PRIMARY, *primary),
+            SECONDARY: FakeConnection(SECONDARY, *secondary),
+        }
+        handler = RequestHandler(address=None, socket=None, conn_pool=FakePool(self.connections),
+                                 stats=None, hedging=HedgeBudget(ratio, burst=1))
+        handler.request = self.query
+        handler.deadline = Deadline(1.0)
+        return handler, handler.query_hedged(self.query)
+
+    def test_fast_primary_is_not_hedged(self):
+        handler, reply = self.hedge((0, self.reply), (0, self.reply))
+        self.assertEqual(reply, self.reply)
+        self.assertEqual(self.connections[SECONDARY].queries, 0)
+        self.assertEqual(handler.upstream, '192.0.2.1:853')
+
+    def test_hedge_wins_and_primary_is_cancelled(self):
+        handler, reply = self.hedge((0.5, self.reply), (0, self.reply))
+        self.assertEqual(reply, self.reply)
+        self.assertTrue(self.connections[PRIMARY].cancelled)
+        self.assertEqual(handler.hedging.won, 1)
+        self.assertEqual(handler.upstream, '192.0.2.2:853')
+        # Only the round-trip time of the hedged query is accounted
+        self.assertLess(handler.timings[UPSTREAM_RTT], HEDGE_DELAY)
+        self.assertEqual(handler.timings[CONNECT], CONNECT_TIME)
+
+    def test_primary_wins_over_invalid_hedge(self):
+        invalid = make_reply(make_query(msg_id=10))
+        handler, reply = self.hedge((0.05, self.reply), (0, invalid))
+        self.assertEqual(reply, self.reply)
+        self.assertEqual(handler.hedging.won, 0)
+        self.assertEqual(handler.upstream, '192.0.2.1:853')
+        self.assertGreaterEqual(handler.timings[UPSTREAM_RTT], 0.05)
+        self.assertEqual(handler.timings[CONNECT], CONNECT_TIME)
+
+    def test_failed_hedge_waits_for_primary(self):
+        handler, reply = self.hedge((0.05, self.reply), (0, None))
+        self.assertEqual(reply, self.reply)
+        self.assertEqual(handler.upstream, '192.0.2.1:853')
+
+    def test_budget_exhausted(self):
+        handler, reply = self.hedge((0.05, self.reply), (0, self.reply), ratio=0)
+        self.assertEqual(reply, self.reply)
+        self.assertEqual(self.connections[SECONDARY].queries, 0)
+        self.assertFalse(self.connections[PRIMARY].cancelled)
+        self.assertEqual(handler.hedging.stats(), {'hedged': 0, 'won': 0, 'denied': 1})
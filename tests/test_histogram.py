@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+"""
+test_histogram module
+"""
+
+import unittest
+
+from dns_tls_proxy import histogram
+from dns_tls_proxy.histogram import Histogram, bucket_index, bucket_upper
+
+
+class TestBuckets(unittest.TestCase):
+
+    def test_small_values_are_exact(self):
+        for value in range(histogram.SUB_BUCKETS):
+            self.assertEqual(bucket_upper(bucket_index(value)), value)
+
+    def test_relative_error(self):
+        value = 1
+        while value <= histogram.MAX_VALUE:
+            for candidate in (value, value + 1, value * 3 // 2):
+                upper = bucket_upper(bucket_index(candidate))
+                self.assertGreaterEqual(upper, candidate)
+                self.assertLessEqual(upper - candidate, candidate / histogram.SUB_BUCKETS)
+            value *= 2
+
+    def test_indexes_are_monotonic(self):
+        previous = -1
+        for index in range(histogram.NUM_BUCKETS):
+            upper = bucket_upper(index)
+            self.assertGreater(upper, previous)
+            self.assertEqual(bucket_index(upper), index)
+            previous = upper
+
+
+class TestHistogram(unittest.TestCase):
+
+    def test_empty(self):
+        h = Histogram()
+        self.assertEqual(len(h), 0)
+        self.assertEqual(h.percentile(0.99), 0)
+        self.assertEqual(h.summary(), {'count': 0, 'p50_ms': 0, 'p90_ms': 0,
+                                       'p99_ms': 0, 'max_ms': 0})
+
+    def test_percentiles(self):
+        h = Histogram()
+        for ms in range(1, 1001):
+            h.record(ms / 1000)
+        self.assertEqual(len(h), 1000)
+        for fraction in (0.5, 0.9, 0.99):
+            expected = fraction
+            self.assertGreaterEqual(h.percentile(fraction), expected)
+            self.assertLessEqual(h.percentile(fraction), expected * (1 + 1 / histogram.SUB_BUCKETS))
+        self.assertEqual(h.percentile(1), 1.0)
+        self.assertEqual(h.summary()['max_ms'], 1000)
+        self.assertAlmostEqual(h.summary()['avg_ms'], 500.5)
+
+    def test_out_of_range_values_are_clamped(self):
+        h = Histogram()
+        h.record(-1)
+        h.record(1000)
+        self.assertEqual(h.percentile(0.5), 0)
+        self.assertEqual(h.max, histogram.MAX_VALUE)
+
+    def test_merge_and_reset(self):
+        a, b = Histogram(), Histogram()
+        a.record(0.001)
+        b.record(0.002)
+        b.record(0.004)
+        a.merge(b)
+        self.assertEqual((a.count, a.max), (3, 4000))
+        self.assertEqual(a.percentile(1), 0.004)
+        a.reset()
+        self.assertEqual((len(a), a.total, a.max), (0, 0, 0))
+        self.assertFalse(any(a.counts))
+
+    def test_cumulative(self):
+        h = Histogram()
+        for seconds in (0.001, 0.005, 0.02, 0.5, 10):
+            h.record(seconds)
+        self.assertEqual(h.cumulative([0.002, 0.01, 0.1, 1]), [1, 2, 3, 4])
+
+    def test_dict_round_trip(self):
+        h = Histogram()
+        for seconds in (0.001, 0.003, 0.003, 2):
+            h.record(seconds)
+        restored = Histogram.from_dict(h.to_dict())
+        self.assertEqual(restored.counts, h.counts)
+        self.assertEqual((restored.count, restored.total, restored.max),
+                         (h.count, h.total, h.max))
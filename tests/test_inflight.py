@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+"""
+test_inflight module
+"""
+
+import unittest
+
+import gevent
+
+from dns_tls_proxy.inflight import InflightTable
+from dns_tls_proxy.request_handler import RequestHandler
+from .helpers import make_query, make_reply, key_of
+
+
+class Handler(RequestHandler):
+    """
+    Handler of a UDP query whose forwarding is replaced by a function
+    """
+
+    def __init__(self, data, inflight, forward):
+        super().__init__(
+            address=('198.51.100.1', 5353),
+            socket=None,
+            conn_pool=None,
+            stats=None,
+            inflight=inflight
+        )
+        self.proto = 'UDP'
+        self.data = data
+        self.forward = forward
+        self.sent = None
+
+    def get_request(self):
+        return self.data
+
+    def send_reply(self):
+        self.sent = self.reply
+
+    def forward_request(self, request, key=None, stale=True):
+        self.reply = self.forward(request)
+
+
+class TestInflightTable(unittest.TestCase):
+
+    def test_first_is_leader(self):
+        table = InflightTable()
+        leader, result = table.join('key')
+        self.assertTrue(leader)
+        follower, same = table.join('key')
+        self.assertFalse(follower)
+        self.assertIs(same, result)
+        self.assertTrue(table.join('other')[0])
+        self.assertEqual((table.leaders, table.coalesced, len(table)), (2, 1, 2))
+
+    def test_finish_wakes_followers(self):
+        table = InflightTable()
+        table.join('key')
+        followers = [gevent.spawn(table.join('key')[1].get) for _ in range(3)]
+        gevent.sleep(0)
+        table.finish('key', b'reply')
+        gevent.joinall(followers, timeout=1)
+        self.assertEqual([f.value for f in followers], [b'reply'] * 3)
+        self.assertEqual(len(table), 0)
+        # The next query for the key goes upstream again
+        self.assertTrue(table.join('key')[0])
+
+    def test_finish_unknown_key(self):
+        table = InflightTable()
+        table.finish('key', None)
+        self.assertEqual(len(table), 0)
+
+
+class TestCoalescing(unittest.TestCase):
+
+    def setUp(self):
+        self.inflight = InflightTable()
+        self.forwarded = []
+
+    def forward(self, request):
+        self.forwarded.append(request)
+        gevent.sleep(0.02)
+        return make_reply(request, [(300, 'A', '192.0.2.1')])
+
+    def fail_first(self, request):
+        self.forwarded.append(request)
+        gevent.sleep(0.02)
+        if len(self.forwarded) == 1:
+            raise RuntimeError('leader failed')
+        return make_reply(request, [(300, 'A', '192.0.2.1')])
+
+    def run_handlers(self, forward, count=3):
+        handlers = [Handler(make_query(msg_id=i + 1), self.inflight, forward)
+                    for i in range(count)]
+        greenlets = [gevent.spawn(h.proxy_request) for h in handlers]
+        gevent.joinall(greenlets, timeout=2)
+        return handlers, greenlets
+
+    def test_identical_queries_forwarded_once(self):
+        handlers, _ = self.run_handlers(self.forward)
+        self.assertEqual(len(self.forwarded), 1)
+        # Every client gets the reply with its own message ID
+        self.assertEqual([h.sent[:2] for h in handlers], [b'\x00\x01', b'\x00\x02', b'\x00\x03'])
+        self.assertEqual(len({h.sent[2:] for h in handlers}), 1)
+        self.assertEqual((self.inflight.leaders, self.inflight.coalesced), (1, 2))
+        self.assertEqual(len(self.inflight), 0)
+
+    def test_different_queries_are_not_coalesced(self):
+        handlers = [Handler(make_query(name), self.inflight, self.forward)
+                    for name in ('a.example.', 'b.example.')]
+        gevent.joinall([gevent.spawn(h.proxy_request) for h in handlers], timeout=2)
+        self.assertEqual(len(self.forwarded), 2)
+        self.assertNotEqual(key_of(self.forwarded[0]), key_of(self.forwarded[1]))
+
+    def test_leader_failure_wakes_followers(self):
+        handlers, greenlets = self.run_handlers(self.fail_first)
+        self.assertTrue(all(g.ready() for g in greenlets))
+        self.assertIsInstance(greenlets[0].exception, RuntimeError)
+        # Followers are not left waiting, they forward the query themselves
+        self.assertEqual(len(self.forwarded), 3)
+        self.assertEqual([h.sent[:2] for h in handlers[1:]], [b'\x00\x02', b'\x00\x03'])
+        self.assertEqual(len(self.inflight), 0)
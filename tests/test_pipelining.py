@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+"""
+test_pipelining module
+"""
+
+import unittest
+from unittest import mock
+
+import gevent
+import dns.message
+
+from dns_tls_proxy import pipelining
+from dns_tls_proxy.pipelining import PipelinedConnection
+from dns_tls_proxy.deadline import Deadline
+from dns_tls_proxy.tcp_dns import TCPDNS
+from .helpers import make_query, make_reply, socket_pair
+
+
+class FakePool:
+    """
+    Connection pool tracking the queries and sockets of a connection
+    """
+
+    def __init__(self):
+        self.released = list()
+        self.rtts = list()
+
+    def start_query(self, address):
+        return 0
+
+    def finish_query(self, address, rtt=None, cancelled=False, generation=None):
+        self.rtts.append(rtt)
+
+    def release_socket(self, sock):
+        self.released.append(sock)
+
+
+class TestPipelinedConnection(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = FakePool()
+        client, server = socket_pair()
+        self.addCleanup(client.sock.close)
+        self.addCleanup(server.sock.close)
+        self.server = TCPDNS(server)
+        self.conn = PipelinedConnection(client, self.pool, timeout=1.0)
+
+    def test_colliding_ids_are_rewritten(self):
+        first = gevent.spawn(self.conn.query, make_query('a.test.', msg_id=7))
+        second = gevent.spawn(self.conn.query, make_query('b.test.', msg_id=7))
+        queries = [self.server.recv(), self.server.recv()]
+        self.assertNotEqual(queries[0][:2], queries[1][:2])
+        for query in queries:
+            self.server.send(make_reply(query, [(60, 'A', '10.0.0.1')]))
+        gevent.joinall([first, second], raise_error=True)
+        for greenlet, name in ((first, 'a.test.'), (second, 'b.test.')):
+            reply = dns.message.from_wire(greenlet.value)
+            self.assertEqual(reply.id, 7)
+            self.assertEqual(str(reply.question[0].name), name)
+        self.assertEqual(self.conn.pending, 0)
+
+    def test_replies_out_of_order(self):
+        names = ['q{}.test.'.format(x) for x in range(5)]
+        greenlets = [gevent.spawn(self.conn.query, make_query(name, msg_id=x))
+                     for x, name in enumerate(names)]
+        queries = [self.server.recv() for _ in names]
+        for query in reversed(queries):
+            self.server.send(make_reply(query))
+        gevent.joinall(greenlets, raise_error=True)
+        for x, (greenlet, name) in enumerate(zip(greenlets, names)):
+            reply = dns.message.from_wire(greenlet.value)
+            self.assertEqual((reply.id, str(reply.question[0].name)), (x, name))
+        self.assertEqual(len(self.pool.rtts), len(names))
+        self.assertNotIn(None, self.pool.rtts)
+
+    def test_batched_write_takes_latest_deadline(self):
+        writes = list()
+        send_many = self.conn.tcp_dns.send_many
+
+        def record(queries, deadline=None):
+            writes.append((len(queries), deadline))
+            send_many(queries, deadline=deadline)
+
+        late = Deadline(5.0)
+        with mock.patch.object(self.conn.tcp_dns, 'send_many', record):
+            # Both queries wait for the writer holding the connection
+            with self.conn._write_lock:
+                greenlets = [gevent.spawn(self.conn.query, make_query(msg_id=1), Deadline(0.5)),
+                             gevent.spawn(self.conn.query, make_query(msg_id=2), late)]
+                gevent.sleep(0)
+            for _ in greenlets:
+                self.server.send(make_reply(self.server.recv()))
+            gevent.joinall(greenlets, raise_error=True)
+        self.assertEqual(writes, [(2, late)])
+
+    def test_connection_lost_fails_pending_queries(self):
+        greenlets = [gevent.spawn(self.conn.query, make_query(msg_id=x)) for x in range(3)]
+        for _ in greenlets:
+            self.server.recv()
+        self.server.sock.sock.close()
+        gevent.joinall(greenlets)
+        for greenlet in greenlets:
+            self.assertIsInstance(greenlet.exception, OSError)
+        self.assertTrue(self.conn.closed)
+        self.assertEqual(self.conn.pending, 0)
+        self.assertEqual(self.pool.released, [self.conn.sock])
+        with self.assertRaises(OSError):
+            self.conn.query(make_query())
+
+    @mock.patch.object(pipelining, 'PIPELINE_READ_TIMEOUT', 0.1)
+    def test_quiet_connection_is_kept(self):
+        self.conn.timeout = 0.05
+        with self.assertRaises(OSError):
+            self.conn.query(make_query(msg_id=1))
+        late = self.server.recv()
+        gevent.sleep(0.2)
+        self.assertFalse(self.conn.closed)
+
+        greenlet = gevent.spawn(self.conn.query, make_query(msg_id=2))
+        query = self.server.recv()
+        # The reply to the timed out query is discarded
+        self.server.send(make_reply(late))
+        self.server.send(make_reply(query))
+        self.assertEqual(dns.message.from_wire(greenlet.get(timeout=1)).id, 2)
+        self.assertFalse(self.conn.closed)
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+"""
+test_selection module
+"""
+
+import random
+import unittest
+from collections import Counter
+
+from gevent.server import StreamServer
+
+from dns_tls_proxy.connection_pool import TCPConnectionPool
+from dns_tls_proxy.deadline import Deadline
+from dns_tls_proxy.request_handler import RequestHandler
+from dns_tls_proxy.selection import (RoundRobinPolicy, WeightedPolicy, EwmaPolicy,
+                                     SelectionPolicy, MIN_TIMEOUT, TIMEOUT_MIN_SAMPLES)
+from .helpers import make_query
+
+
+FAST = ('192.0.2.1', 853, 'fast.test')
+SLOW = ('192.0.2.2', 853, 'slow.test')
+
+
+class TestPolicies(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(1)
+
+    def test_round_robin(self):
+        policy = RoundRobinPolicy()
+        self.assertEqual([policy.select([FAST, SLOW]) for _ in range(4)],
+                         [FAST, SLOW, FAST, SLOW])
+
+    def test_weighted_distribution(self):
+        heavy, light = FAST + (9,), SLOW + (1,)
+        policy = WeightedPolicy()
+        counts = Counter(policy.select([heavy, light]) for _ in range(5000))
+        self.assertAlmostEqual(counts[heavy] / 5000, 0.9, delta=0.02)
+
+    def test_weighted_default_weight(self):
+        policy = WeightedPolicy()
+        counts = Counter(policy.select([FAST + (3,), SLOW]) for _ in range(4000))
+        self.assertAlmostEqual(counts[SLOW] / 4000, 0.25, delta=0.03)
+
+    def test_ewma_prefers_faster_nameserver(self):
+        policy = EwmaPolicy()
+        for _ in range(10):
+            for address, rtt in ((FAST, 0.01), (SLOW, 0.1)):
+                policy.start(address)
+                policy.finish(address, rtt)
+        self.assertEqual({policy.select([FAST, SLOW]) for _ in range(20)}, {FAST})
+        self.assertAlmostEqual(policy.rtt[FAST], 0.01)
+
+    def test_ewma_weights_queries_in_flight(self):
+        policy = EwmaPolicy()
+        for address, rtt in ((FAST, 0.01), (SLOW, 0.05)):
+            policy.start(address)
+            policy.finish(address, rtt)
+        for _ in range(10):
+            policy.start(FAST)
+        self.assertEqual(policy.select([FAST, SLOW]), SLOW)
+
+    def test_ewma_probes_unmeasured_nameservers(self):
+        policy = EwmaPolicy()
+        policy.start(FAST)
+        policy.finish(FAST, 0.01)
+        self.assertEqual(policy.select([FAST, SLOW]), SLOW)
+
+    def test_failed_queries_are_not_measured(self):
+        policy = SelectionPolicy()
+        policy.start(FAST)
+        policy.finish(FAST)
+        self.assertEqual(policy.inflight[FAST], 0)
+        self.assertEqual(policy.queries[FAST], 1)
+        self.assertNotIn(FAST, policy.rtt)
+
+
+class TestInflight(unittest.TestCase):
+
+    def test_inflight_back_to_zero_after_errors(self):
+        # Nameserver closing every connection without replying
+        server = StreamServer(('127.0.0.1', 0), lambda sock, _: sock.close())
+        server.start()
+        self.addCleanup(server.stop)
+        address = server.address + ('broken.test',)
+        pool = TCPConnectionPool([address], policy=EwmaPolicy())
+        query = make_query()
+        for _ in range(3):
+            handler = RequestHandler(address=None, socket=None, conn_pool=pool, stats=None)
+            handler.request = query
+            handler.deadline = Deadline(1.0)
+            self.assertIsNone(handler.query(query))
+        self.assertEqual(pool.policy.inflight[address], 0)
+        self.assertEqual(pool.policy.queries[address], 3)
+
+
+class TestAdaptiveTimeout(unittest.TestCase):
+
+    def setUp(self):
+        self.policy = SelectionPolicy()
+
+    def measure(self, rtt, samples=TIMEOUT_MIN_SAMPLES):
+        for _ in range(samples):
+            self.policy.start(FAST)
+            self.policy.finish(FAST, rtt)
+
+    def test_default_until_measured(self):
+        self.measure(0.1, TIMEOUT_MIN_SAMPLES - 1)
+        self.assertEqual(self.policy.query_timeout(FAST, 1.0), 1.0)
+        self.measure(0.1, 1)
+        self.assertAlmostEqual(self.policy.query_timeout(FAST, 1.0), 0.2, delta=0.02)
+        self.assertIsNotNone(self.policy.hedge_delay(FAST))
+
+    def test_bounds(self):
+        self.measure(0.01)
+        self.assertEqual(self.policy.query_timeout(FAST, 1.0), MIN_TIMEOUT)
+        self.measure(0.8, 50)
+        self.assertEqual(self.policy.query_timeout(FAST, 1.0), 1.0)
+
+    def test_backoff_follows_slower_nameserver(self):
+        self.measure(0.03)
+        self.assertEqual(self.policy.query_timeout(FAST, 1.0), MIN_TIMEOUT)
+        timeouts = list()
+        for _ in range(3):
+            self.policy.backoff(FAST, 1.0)
+            timeouts.append(self.policy.query_timeout(FAST, 1.0))
+        self.assertEqual(timeouts, [0.4, 0.8, 1.0])
+        # Measured again from the new round-trip times only
+        self.measure(0.3)
+        self.assertAlmostEqual(self.policy.query_timeout(FAST, 1.0), 0.6, delta=0.05)
+
+    def test_backoff_without_measurements(self):
+        self.policy.backoff(FAST, 1.0)
+        self.assertEqual(self.policy.query_timeout(FAST, 1.0), 1.0)
+
+    def test_pool_backs_off_failed_queries_only(self):
+        pool = TCPConnectionPool([FAST], policy=self.policy)
+        self.measure(0.03)
+        pool.start_query(FAST)
+        pool.finish_query(FAST, None, cancelled=True)
+        self.assertEqual(pool.query_timeout(FAST), MIN_TIMEOUT)
+        pool.start_query(FAST)
+        pool.finish_query(FAST, None)
+        self.assertEqual(pool.query_timeout(FAST), 2 * MIN_TIMEOUT)
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+
+"""
+test_shared_cache module
+"""
+
+import os
+import unittest
+from unittest import mock
+
+from dns_tls_proxy import shared_cache
+from dns_tls_proxy.shared_cache import SharedResponseCache, SEQUENCE, STRIPE
+from dns_tls_proxy.snapshot import encode_key, key_hash
+from .helpers import FakeClock, make_query, make_reply, key_of
+
+
+class TestSharedResponseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = SharedResponseCache(64, prefetch=0.5)
+        self.query = make_query()
+        self.key = key_of(self.query)
+        self.reply = make_reply(self.query, [(300, 'A', '1.2.3.4')])
+
+    def bucket_of(self, key):
+        digest = key_hash(encode_key(key))
+        return digest, self.cache._bucket(digest)
+
+    def test_put_and_get(self):
+        self.assertTrue(self.cache.put(self.key, self.reply))
+        reply = self.cache.get(self.key, b'\x12\x34')
+        self.assertEqual(reply, self.reply)
+        self.assertEqual(len(self.cache), 1)
+        self.assertEqual([key for key, _ in self.cache._items()], [self.key])
+        self.assertIsNone(self.cache.get(key_of(make_query('missing.test.')), b'\x00\x01'))
+
+    def test_replace(self):
+        self.cache.put(self.key, self.reply)
+        newer = make_reply(self.query, [(300, 'A', '5.6.7.8')])
+        self.cache.put(self.key, newer)
+        self.assertEqual(self.cache.get(self.key, self.query[:2]), newer)
+        self.assertEqual(len(self.cache), 1)
+
+    def test_oversized_replies_are_not_cached(self):
+        c = SharedResponseCache(4, slot_size=64)
+        self.assertFalse(c.put(self.key, self.reply))
+        self.assertEqual(c.stats()['oversized'], 1)
+
+    def test_bucket_eviction(self):
+        c = SharedResponseCache(1)
+        for index in range(shared_cache.BUCKET_WAYS + 1):
+            query = make_query('host{}.test.'.format(index))
+            c.put(key_of(query), make_reply(query, [(60 + index, 'A', '1.2.3.4')]))
+        self.assertEqual(len(c), shared_cache.BUCKET_WAYS)
+        self.assertIsNone(c.get(key_of(make_query('host0.test.')), b'\x00\x01'))
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'fork is required')
+    def test_shared_across_processes(self):
+        pid = os.fork()
+        if not pid:
+            # Child process, storing the reply
+            os._exit(0 if self.cache.put(self.key, self.reply) else 1)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+        self.assertEqual(self.cache.get(self.key, self.query[:2]), self.reply)
+
+    def test_hits_take_no_lock(self):
+        self.cache.put(self.key, self.reply)
+        for lock in self.cache._locks:
+            lock.acquire()
+        try:
+            self.assertIsNotNone(self.cache.get(self.key, b'\x00\x01'))
+            self.assertFalse(self.cache.prefetch_due(self.key))
+            self.assertFalse(self.cache.put(self.key, self.reply))
+        finally:
+            for lock in self.cache._locks:
+                lock.release()
+        self.assertEqual(self.cache.contended, 1)
+
+    def test_prefetch_disabled_takes_no_lock(self):
+        c = SharedResponseCache(64)
+        c.put(self.key, self.reply)
+        with mock.patch.object(c, '_acquire') as acquire:
+            self.assertFalse(c.prefetch_due(self.key))
+        acquire.assert_not_called()
+
+    def test_prefetch_due_once_and_failed(self):
+        self.cache.put(self.key, self.reply)
+        self.assertFalse(self.cache.prefetch_due(self.key))
+        clock = mock.Mock()
+        clock.time.return_value = self.cache._find(self.key).prefetch_at
+        with mock.patch.object(shared_cache, 'time', clock):
+            self.assertTrue(self.cache.prefetch_due(self.key))
+            self.assertFalse(self.cache.prefetch_due(self.key))
+            self.cache.prefetch_failed(self.key)
+            self.assertTrue(self.cache.prefetch_due(self.key))
+
+    def test_reads_retry_while_written(self):
+        self.cache.put(self.key, self.reply)
+        _, base = self.bucket_of(self.key)
+        sequence, = SEQUENCE.unpack_from(self.cache._map, base)
+        SEQUENCE.pack_into(self.cache._map, base, sequence + 1)
+        self.assertIsNone(self.cache.get(self.key, b'\x00\x01'))
+        SEQUENCE.pack_into(self.cache._map, base, sequence + 2)
+        self.assertIsNotNone(self.cache.get(self.key, b'\x00\x01'))
+
+    def dead_writer(self, digest):
+        """
+        Take the lock of the stripe of a key in a process which dies holding
+        it, and return the stripe
+        """
+        pid = os.fork()
+        if not pid:
+            # Child process, dying while writing
+            self.cache._acquire(digest)
+            os._exit(0)
+        os.waitpid(pid, 0)
+        return digest % self.cache.buckets % len(self.cache._locks)
+
+    def age_lock(self, stripe, seconds=shared_cache.STALE_LOCK_TIMEOUT):
+        offset = stripe * STRIPE.size
+        locked_at, owner, taken = STRIPE.unpack_from(self.cache._map, offset)
+        STRIPE.pack_into(self.cache._map, offset, locked_at - seconds, owner, taken)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'fork is required')
+    def test_recovers_from_dead_writer(self):
+        self.cache.put(self.key, self.reply)
+        digest, base = self.bucket_of(self.key)
+        stripe = self.dead_writer(digest)
+        # In the middle of a write
+        sequence, = SEQUENCE.unpack_from(self.cache._map, base)
+        SEQUENCE.pack_into(self.cache._map, base, sequence + 1)
+
+        self.assertFalse(self.cache.put(self.key, self.reply))
+        self.assertEqual(self.cache.recovered, 0)
+        self.age_lock(stripe)
+
+        self.assertTrue(self.cache.put(self.key, self.reply))
+        self.assertEqual(self.cache.recovered, 1)
+        self.assertEqual(SEQUENCE.unpack_from(self.cache._map, base)[0] % 2, 0)
+        self.assertEqual(self.cache.get(self.key, self.query[:2]), self.reply)
+        self.assertEqual(len(self.cache), 1)
+
+    def test_live_writer_keeps_its_lock(self):
+        digest, _ = self.bucket_of(self.key)
+        stripe = self.cache._acquire(digest)
+        self.age_lock(stripe, 60)
+        self.assertFalse(self.cache.put(self.key, self.reply))
+        self.assertEqual(self.cache.recovered, 0)
+        self.cache._release(stripe)
+        self.assertTrue(self.cache.put(self.key, self.reply))
+
+    def test_recovers_lock_without_owner(self):
+        digest, _ = self.bucket_of(self.key)
+        stripe = digest % self.cache.buckets % len(self.cache._locks)
+        # Taken by a worker which died before setting itself as owner
+        self.cache._locks[stripe].acquire()
+        clock = FakeClock()
+        with mock.patch.object(shared_cache, 'time', clock):
+            self.assertFalse(self.cache.put(self.key, self.reply))
+            clock.advance(shared_cache.STALE_LOCK_TIMEOUT / 2)
+            self.assertFalse(self.cache.put(self.key, self.reply))
+            clock.advance(shared_cache.STALE_LOCK_TIMEOUT / 2)
+            self.assertTrue(self.cache.put(self.key, self.reply))
+        self.assertEqual(self.cache.recovered, 1)
+
+    def test_release_of_recovered_lock(self):
+        digest, _ = self.bucket_of(self.key)
+        stripe = self.cache._acquire(digest)
+        # Recovered and taken by another worker meanwhile
+        STRIPE.pack_into(self.cache._map, stripe * STRIPE.size, 0.0, os.getpid() + 1, 5)
+        self.cache._release(stripe)
+        self.assertFalse(self.cache._locks[stripe].acquire(block=False))
+        # Already released
+        STRIPE.pack_into(self.cache._map, stripe * STRIPE.size, 0.0, os.getpid(), 5)
+        self.cache._locks[stripe].release()
+        self.cache._release(stripe)
+        self.assertTrue(self.cache.put(self.key, self.reply))
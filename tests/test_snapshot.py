@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+"""
+test_snapshot module
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import dns.message
+
+from dns_tls_proxy import cache
+from dns_tls_proxy import snapshot
+from dns_tls_proxy.cache import ResponseCache
+from dns_tls_proxy.snapshot import Snapshot, write_snapshot, encode_key, decode_key, key_hash
+from .helpers import FakeClock, make_query, make_reply, key_of
+
+
+class TestKeys(unittest.TestCase):
+
+    def test_round_trip(self):
+        key = key_of(make_query(dnssec=True))
+        self.assertEqual(decode_key(encode_key(key)), key)
+
+    def test_hash_is_stable(self):
+        data = encode_key(key_of(make_query()))
+        self.assertEqual(key_hash(data), key_hash(bytes(data)))
+        self.assertLess(key_hash(data), 1 << 64)
+        self.assertNotEqual(key_hash(data), key_hash(encode_key(key_of(make_query(cd=True)))))
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'cache.snapshot')
+
+    def entries(self, count):
+        entries = []
+        for index in range(count):
+            query = make_query('host{}.test.'.format(index))
+            reply = make_reply(query, [(60 + index, 'A', '10.0.0.{}'.format(index % 250))])
+            entries.append((key_of(query), 100.0 + index, 200.0 + index, reply))
+        return entries
+
+    def test_round_trip(self):
+        entries = self.entries(100)
+        write_snapshot(self.path, entries)
+        snap = Snapshot(self.path)
+        self.addCleanup(snap.close)
+        self.assertEqual(len(snap), 100)
+        self.assertEqual(snap.expires_at, 299.0)
+        self.assertEqual(list(snap), entries)
+        for key, stored_at, expires_at, reply in entries:
+            self.assertEqual(snap.lookup(key), (stored_at, expires_at, reply))
+        self.assertIsNone(snap.lookup(key_of(make_query('missing.test.'))))
+
+    def test_empty(self):
+        write_snapshot(self.path, [])
+        snap = Snapshot(self.path)
+        self.addCleanup(snap.close)
+        self.assertEqual(len(snap), 0)
+        self.assertIsNone(snap.lookup(key_of(make_query())))
+        self.assertFalse(os.path.exists(self.path + '.tmp'))
+
+    def test_bad_files(self):
+        write_snapshot(self.path, self.entries(3))
+        with open(self.path, 'rb') as fh:
+            data = fh.read()
+        with open(self.path, 'wb') as fh:
+            fh.write(b'X' + data[1:])
+        with self.assertRaises(ValueError):
+            Snapshot(self.path)
+        with open(self.path, 'wb') as fh:
+            fh.write(data[:snapshot.FILE_HEADER.size + 4])
+        with self.assertRaises(ValueError):
+            Snapshot(self.path)
+
+
+class TestCacheSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch.object(cache, 'time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'cache.snapshot')
+
+    def test_restore_on_miss(self):
+        saved = ResponseCache(10)
+        queries = [make_query('a.test.'), make_query('b.test.')]
+        saved.put(key_of(queries[0]), make_reply(queries[0], [(300, 'A', '1.2.3.4')]))
+        saved.put(key_of(queries[1]), make_reply(queries[1], [(10, 'A', '1.2.3.5')]))
+        saved.save_snapshot(self.path)
+
+        self.clock.advance(20)
+        restored = ResponseCache(10)
+        restored.load_snapshot(self.path)
+        self.addCleanup(restored._snapshot.close)
+        self.assertEqual(len(restored), 0)
+        reply = restored.get(key_of(queries[0]), b'\x00\x09')
+        self.assertEqual(dns.message.from_wire(reply).answer[0].ttl, 280)
+        self.assertIsNone(restored.get(key_of(queries[1]), b'\x00\x09'))
+        self.assertEqual((restored.restored, len(restored)), (1, 1))
+
+    def test_save_keeps_entries_not_restored(self):
+        saved = ResponseCache(10)
+        query = make_query()
+        saved.put(key_of(query), make_reply(query, [(300, 'A', '1.2.3.4')]))
+        saved.save_snapshot(self.path)
+
+        restarted = ResponseCache(10)
+        restarted.load_snapshot(self.path)
+        self.addCleanup(restarted._snapshot.close)
+        other_path = self.path + '.2'
+        restarted.save_snapshot(other_path)
+        snap = Snapshot(other_path)
+        self.addCleanup(snap.close)
+        self.assertIsNotNone(snap.lookup(key_of(query)))
+
+    def test_missing_and_expired_snapshots(self):
+        c = ResponseCache(10)
+        c.load_snapshot(self.path)
+        self.assertIsNone(c._snapshot)
+        query = make_query()
+        c.put(key_of(query), make_reply(query, [(60, 'A', '1.2.3.4')]))
+        c.save_snapshot(self.path)
+        self.clock.advance(60)
+        expired = ResponseCache(10)
+        expired.load_snapshot(self.path)
+        self.assertIsNone(expired._snapshot)
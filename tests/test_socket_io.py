@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+"""
+test_socket_io module
+"""
+
+import unittest
+
+import gevent
+from gevent import socket
+
+from dns_tls_proxy import socket_io
+from dns_tls_proxy.deadline import Deadline, DeadlineExceeded
+from .helpers import socket_pair
+
+
+def frame(msg):
+    return socket_io.FRAME_HEADER.pack(len(msg)) + msg
+
+
+class CountingSocket:
+    """
+    Socket counting its reads
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.reads = 0
+
+    def recv_into(self, buffer):
+        self.reads += 1
+        return self.sock.recv_into(buffer)
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+class TestBufferedReads(unittest.TestCase):
+
+    def setUp(self):
+        self.client, self.server = socket_pair()
+        self.addCleanup(self.client.close)
+        self.addCleanup(self.server.close)
+
+    def dribble(self, data, size=1):
+        """ Write data a few bytes at a time, yielding between writes """
+        for start in range(0, len(data), size):
+            self.server.sock.sendall(data[start:start + size])
+            gevent.sleep(0.001)
+
+    def test_frame_from_partial_reads(self):
+        writer = gevent.spawn(self.dribble, frame(b'reply') + frame(b'second'), 2)
+        self.assertEqual(bytes(self.client.recv_frame(Deadline(1))), b'reply')
+        self.assertEqual(bytes(self.client.recv_frame(Deadline(1))), b'second')
+        writer.join()
+
+    def test_frames_written_back_to_back(self):
+        self.server.sock.sendall(frame(b'one') + frame(b'two') + frame(b''))
+        gevent.sleep(0.01)
+        sock = self.client.sock = CountingSocket(self.client.sock)
+        frames = [bytes(self.client.recv_frame(Deadline(1))) for _ in range(3)]
+        self.assertEqual(frames, [b'one', b'two', b''])
+        self.assertEqual(sock.reads, 1)
+
+    def test_buffer_grows_for_big_frames(self):
+        msg = bytes(range(256)) * 256
+        writer = gevent.spawn(self.server.sock.sendall, frame(msg[:-1]) + frame(b'next'))
+        self.assertEqual(bytes(self.client.recv_frame(Deadline(1))), msg[:-1])
+        self.assertEqual(bytes(self.client.recv_frame(Deadline(1))), b'next')
+        self.assertGreater(len(self.client._buffer), socket_io.RECV_BUFFER_LEN)
+        writer.join()
+
+    def test_timeout_keeps_partial_frame(self):
+        data = frame(b'delayed reply')
+        self.server.sock.sendall(data[:5])
+        with self.assertRaises((DeadlineExceeded, socket.timeout)):
+            self.client.recv_frame(Deadline(0.02))
+        self.server.sock.sendall(data[5:])
+        self.assertEqual(bytes(self.client.recv_frame(Deadline(1))), b'delayed reply')
+
+    def test_recv_exact_length(self):
+        gevent.spawn(self.dribble, b'abcdefgh', 3)
+        self.assertEqual(self.client.recv(5, Deadline(1)), b'abcde')
+        self.assertEqual(self.client.recv(3, Deadline(1)), b'fgh')
+
+    def test_connection_broken(self):
+        self.server.sock.sendall(frame(b'cut')[:3])
+        self.server.close()
+        with self.assertRaises(OSError):
+            self.client.recv_frame(Deadline(1))
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+"""
+test_supervisor module
+"""
+
+import os
+import time
+import unittest
+from unittest import mock
+
+from dns_tls_proxy import supervisor
+from dns_tls_proxy.supervisor import Supervisor
+
+
+def exit_at_once(publish, *args):
+    os._exit(3)
+
+
+def publish_and_wait(publish, *args):
+    publish({'listeners': {}})
+    time.sleep(30)
+
+
+def wait_exited(sup, timeout=5.0):
+    deadline = time.time() + timeout
+    while any(w.pid is not None for w in sup.workers) and time.time() < deadline:
+        sup._reap()
+        time.sleep(0.01)
+
+
+class TestSupervisor(unittest.TestCase):
+
+    def supervisor(self, target, workers=2):
+        sup = Supervisor(target, workers)
+        sup.running = True
+        self.addCleanup(sup._stop)
+        return sup
+
+    def test_dead_workers_are_restarted(self):
+        sup = self.supervisor(exit_at_once)
+        sup._restart()
+        first = [w.pid for w in sup.workers]
+        self.assertTrue(all(first))
+        wait_exited(sup)
+        self.assertEqual([w.pid for w in sup.workers], [None, None])
+        self.assertEqual([w.stats_fd for w in sup.workers], [None, None])
+
+        with mock.patch.object(supervisor, 'RESTART_DELAY', 0):
+            sup._restart()
+        self.assertTrue(all(w.pid for w in sup.workers))
+        self.assertFalse(set(first) & set(w.pid for w in sup.workers))
+
+    def test_restart_waits_for_delay(self):
+        sup = self.supervisor(exit_at_once, workers=1)
+        sup._restart()
+        wait_exited(sup)
+        sup._restart()
+        self.assertIsNone(sup.workers[0].pid)
+
+    def test_stop_terminates_workers(self):
+        sup = self.supervisor(publish_and_wait)
+        sup._restart()
+        sup._read_stats(5.0)
+        sup._stop()
+        self.assertEqual([w.pid for w in sup.workers], [None, None])
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+"""
+test_tcp_dns module
+"""
+
+import unittest
+
+from dns_tls_proxy.deadline import Deadline
+from dns_tls_proxy.socket_io import SocketIO
+from dns_tls_proxy.tcp_dns import TCPDNS
+from .helpers import socket_pair
+
+
+class ShortWritesSocket:
+    """
+    Socket taking a few bytes of every write
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.data = bytearray()
+        self.writes = 0
+
+    def fileno(self):
+        return -1
+
+    def settimeout(self, timeout):
+        pass
+
+    def send(self, data):
+        self.writes += 1
+        self.data += data[:self.size]
+        return min(self.size, len(data))
+
+    def sendmsg(self, buffers):
+        self.writes += 1
+        sent = 0
+        for buffer in buffers:
+            chunk = bytes(buffer[:self.size - sent])
+            self.data += chunk
+            sent += len(chunk)
+            if sent == self.size:
+                break
+        return sent
+
+
+class TestFraming(unittest.TestCase):
+
+    def test_send_many_round_trip(self):
+        client, server = socket_pair()
+        self.addCleanup(client.close)
+        self.addCleanup(server.close)
+        msgs = [b'first', b'', b'x' * 300]
+        TCPDNS(client).send_many(msgs, deadline=Deadline(1))
+        TCPDNS(client).send(b'last', deadline=Deadline(1))
+        reader = TCPDNS(server)
+        self.assertEqual([reader.recv(Deadline(1)) for _ in range(4)], msgs + [b'last'])
+
+    def test_partial_sendmsg_resumes_mid_buffer(self):
+        sock = ShortWritesSocket(3)
+        TCPDNS(SocketIO(sock)).send_many([b'abcde', b'fg'], deadline=Deadline(1))
+        self.assertEqual(bytes(sock.data), b'\x00\x05abcde\x00\x02fg')
+        self.assertEqual(sock.writes, 4)
+
+    def test_partial_send_resumes_with_unsent_data(self):
+        sock = ShortWritesSocket(4)
+        SocketIO(sock).send(b'0123456789', deadline=Deadline(1))
+        self.assertEqual(bytes(sock.data), b'0123456789')
+        self.assertEqual(sock.writes, 3)
+
+    def test_tls_buffers_are_coalesced(self):
+        sock = ShortWritesSocket(1000)
+        sio = SocketIO(sock)
+        sio.tls = True
+        TCPDNS(sio).send_many([b'one', b'two'], deadline=Deadline(1))
+        self.assertEqual(bytes(sock.data), b'\x00\x03one\x00\x03two')
+        self.assertEqual(sock.writes, 1)
+        self.assertEqual(sio._write_buffer, b'')
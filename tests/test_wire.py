@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+"""
+test_wire module
+"""
+
+import struct
+import unittest
+
+import dns.message
+import dns.rcode
+
+from dns_tls_proxy import wire
+from .helpers import make_query, make_reply
+
+
+SOA = ('example.com.', 3600, 'SOA', 'ns.example.com. admin.example.com. 1 7200 900 1209600 60')
+
+
+class TestEncodeName(unittest.TestCase):
+
+    def test_lowercases_and_strips_final_dot(self):
+        self.assertEqual(wire.encode_name('WWW.Example.com.'), b'\x03www\x07example\x03com\x00')
+        self.assertEqual(wire.encode_name(b'example.com'), b'\x07example\x03com\x00')
+
+    def test_root(self):
+        self.assertEqual(wire.encode_name('.'), b'\x00')
+        self.assertEqual(wire.encode_name(''), b'\x00')
+
+    def test_bad_names(self):
+        for name in ('a..b', '.a', 'a' * 64 + '.com', '.'.join(['a' * 63] * 4)):
+            with self.assertRaises(ValueError):
+                wire.encode_name(name)
+
+
+class TestQuestion(unittest.TestCase):
+
+    def test_read_question_lowercases(self):
+        query = make_query('WWW.Example.COM.', 'AAAA')
+        qname, qtype, qclass, end = wire.read_question(query)
+        self.assertEqual(qname, b'\x03www\x07example\x03com\x00')
+        self.assertEqual((qtype, qclass), (wire.TYPE_AAAA, wire.CLASS_IN))
+        self.assertEqual(end, len(query))
+
+    def test_question_key(self):
+        key = wire.question_key(make_query())
+        self.assertEqual(key, (b'\x07example\x03com\x00', wire.TYPE_A, wire.CLASS_IN, False, False))
+
+    def test_question_key_do_and_cd_bits(self):
+        key = wire.question_key(make_query(dnssec=True, cd=True))
+        self.assertEqual(key[3:], (True, True))
+        self.assertNotEqual(key, wire.question_key(make_query()))
+
+    def test_validate_query(self):
+        msg_id, _, qname, qtype = wire.validate_query(make_query(msg_id=7))
+        self.assertEqual((msg_id, qname, qtype), (7, b'\x07example\x03com\x00', wire.TYPE_A))
+
+    def test_validate_query_rejects_replies_and_questions(self):
+        query = make_query()
+        with self.assertRaises(ValueError):
+            wire.validate_query(make_reply(query))
+        two_questions = query[:4] + struct.pack('!H', 2) + query[6:]
+        with self.assertRaises(ValueError):
+            wire.validate_query(two_questions)
+        with self.assertRaises(wire.PARSE_ERRORS):
+            wire.validate_query(query[:-6])
+
+    def test_validate_reply_checks_id(self):
+        reply = make_reply(make_query(msg_id=42))
+        self.assertEqual(wire.validate_reply(reply, 42)[0], 42)
+        with self.assertRaises(ValueError):
+            wire.validate_reply(reply, 43)
+
+
+class TestReplies(unittest.TestCase):
+
+    def test_error_reply(self):
+        reply = wire.error_reply(make_query(msg_id=0xabcd), wire.RCODE_SERVFAIL)
+        message = dns.message.from_wire(reply, question_only=True)
+        self.assertEqual(message.id, 0xabcd)
+        self.assertEqual(message.rcode(), dns.rcode.SERVFAIL)
+        self.assertTrue(message.flags & wire.FLAG_QR)
+        self.assertTrue(message.flags & wire.FLAG_RD)
+
+    def test_error_reply_too_short(self):
+        self.assertIsNone(wire.error_reply(b'\x01', wire.RCODE_SERVFAIL))
+        self.assertEqual(len(wire.error_reply(b'\x01\x02', wire.RCODE_REFUSED)), wire.HEADER_LEN)
+
+    def test_local_reply(self):
+        query = make_query('blocked.test.', msg_id=99)
+        reply = wire.local_reply(query, wire.RCODE_NOERROR,
+                                 [(wire.TYPE_A, bytes((10, 0, 0, 1)))], ttl=300)
+        message = dns.message.from_wire(reply)
+        self.assertEqual(message.id, 99)
+        self.assertEqual(str(message.question[0].name), 'blocked.test.')
+        rrset = message.answer[0]
+        self.assertEqual((rrset.ttl, rrset[0].address), (300, '10.0.0.1'))
+
+    def test_local_reply_nxdomain(self):
+        reply = wire.local_reply(make_query(), wire.RCODE_NXDOMAIN)
+        message = dns.message.from_wire(reply)
+        self.assertEqual(message.rcode(), dns.rcode.NXDOMAIN)
+        self.assertFalse(message.answer)
+
+
+class TestTTLInfo(unittest.TestCase):
+
+    def test_positive_uses_minimum_answer_ttl(self):
+        reply = make_reply(make_query(), [(300, 'A', '1.2.3.4'), (60, 'A', '1.2.3.5')])
+        offsets, ttl = wire.ttl_info(reply)
+        self.assertEqual(ttl, 60)
+        self.assertEqual(sorted(wire.TTL.unpack_from(reply, o)[0] for o in offsets), [60, 300])
+
+    def test_negative_uses_soa_minimum(self):
+        reply = make_reply(make_query(), rcode=dns.rcode.NXDOMAIN, authority=[SOA])
+        offsets, ttl = wire.ttl_info(reply)
+        self.assertEqual(ttl, 60)
+        self.assertEqual(len(offsets), 1)
+
+    def test_nodata_without_soa_is_not_cacheable(self):
+        self.assertIsNone(wire.ttl_info(make_reply(make_query()))[1])
+
+    def test_servfail_is_not_cacheable(self):
+        reply = make_reply(make_query(), rcode=dns.rcode.SERVFAIL)
+        self.assertEqual(wire.ttl_info(reply), ([], None))
+
+    def test_opt_record_is_skipped(self):
+        reply = make_reply(make_query(dnssec=True), [(120, 'A', '1.2.3.4')])
+        offsets, ttl = wire.ttl_info(reply)
+        self.assertEqual((len(offsets), ttl), (1, 120))